@@ -1,7 +1,20 @@
 # coding: utf-8
 import os
+import sys
+import time
+import signal
 import argparse
 import subprocess
+import multiprocessing
+import socket
+import ConfigParser
+
+import bus
+import utils
+
+
+MONITOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'monitor.py')
 
 
 def setenv(configfile):
@@ -9,18 +22,268 @@ def setenv(configfile):
     os.environ['BALAIO_SETTINGS_FILE'] = abspath
 
 
-def run_monitor(stdin=subprocess.PIPE, stdout=subprocess.PIPE):
+def run_monitor(args=(), stdin=subprocess.PIPE, stdout=subprocess.PIPE):
     """
     Runs the monitor process and returns a bound subprocess.Popen
     instance.
+
+    ``args`` is a list of command line arguments to the monitor.
+
+    The monitor runs in its own process group, so signals sent to
+    the terminal are propagated by the supervisor only.
     """
-    cmd = ['python', 'monitor.py']
-    monitor = subprocess.Popen(' '.join(cmd), shell=True, stdin=stdin,
-        stdout=stdout)
+    cmd = [sys.executable, MONITOR_PATH] + list(args)
+    monitor = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+        cwd=os.path.dirname(MONITOR_PATH), preexec_fn=os.setpgrp)
 
     return monitor
 
 
+def run_sender(args=(), stdin=None, stdout=None):
+    """
+    Runs the process that delivers the notifications to SciELO Manager
+    and returns a bound subprocess.Popen instance.
+    See: notifier.OutboxSender
+    """
+    cmd = [sys.executable, '-m', 'balaio.notifier'] + list(args)
+    sender = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+        cwd=os.path.dirname(os.path.dirname(MONITOR_PATH)),
+        preexec_fn=os.setpgrp)
+
+    return sender
+
+
+def _getint(settings, section, option):
+    try:
+        return settings.getint(section, option)
+    except (ValueError, ConfigParser.NoOptionError):
+        return 0
+
+
+def get_monitors_args(settings, cpu_count=multiprocessing.cpu_count):
+    """
+    Returns a list with the command line arguments of each monitor.
+
+    With ``[supervisor] sharding=path`` the watch paths are split among
+    the monitors, that default to one per path. With ``sharding=hash``
+    every monitor watches all paths and handles the packages whose
+    pathname hash falls on its shard. Monitors default to the number
+    of cpus.
+
+    When ``[monitor] workers`` is blank, the cpus are split among
+    the monitors.
+    """
+    watch_paths = [path for path in
+                   settings.get('monitor', 'watch_path').split(',') if path]
+    sharding = settings.get('supervisor', 'sharding')
+    count = _getint(settings, 'supervisor', 'monitors')
+
+    if sharding == 'path':
+        count = min(count or len(watch_paths), len(watch_paths)) or 1
+        monitors_args = [[] for i in range(count)]
+        for i, path in enumerate(watch_paths):
+            monitors_args[i % count].extend(['--watch-path', path])
+
+    elif sharding == 'hash':
+        count = count or cpu_count()
+        monitors_args = [['--shard', '%s/%s' % (i, count)]
+                         for i in range(count)]
+
+    else:
+        raise ValueError('Unknown sharding %r' % sharding)
+
+    if not _getint(settings, 'monitor', 'workers'):
+        workers = str(max(1, cpu_count() // count))
+        for args in monitors_args:
+            args.extend(['--workers', workers])
+
+    return monitors_args
+
+
+class Child(object):
+    """
+    A supervised process, a monitor unless ``spawn`` is given.
+    """
+    def __init__(self, key, args, bus_path=None, spawn=None):
+        self.key = key
+        self.args = list(args)
+        # processes other than monitors send no messages
+        self.spawn = spawn
+        self.bus_path = bus_path
+        if bus_path:
+            self.args.extend(['--bus-path', bus_path])
+        self.process = None
+        # the connection to the bus of the monitor
+        self.subscription = None
+        self.started_at = None
+        self.restart_at = None
+        self.failures = 0
+
+
+class Supervisor(object):
+    """
+    Runs many monitors, restarting the ones that exit with an
+    exponential backoff, and receives their messages. The notifications
+    are delivered by a sender process supervised the same way.
+    """
+    def __init__(self, monitors_args, restart_delay=1, max_restart_delay=60,
+                 bus_path=None, sender=False, spawn_dep=run_monitor,
+                 sender_spawn_dep=run_sender, receiver_dep=None,
+                 clock=time.time):
+        """
+        ``monitors_args`` is a list with the command line arguments of
+        each monitor.
+        ``restart_delay`` is the base delay in seconds before a restart.
+        ``max_restart_delay`` caps the delay before a restart. Monitors
+        that run longer than it have their failures forgotten.
+        ``bus_path`` is the prefix of the pathnames of the unix sockets
+        where the monitors publish their messages, suffixed by their
+        keys. When None, messages are read from their stdout.
+        ``sender`` tells if the notifications sender is run.
+        ``spawn_dep`` starts a monitor given its arguments, returning a
+        subprocess.Popen instance.
+        ``sender_spawn_dep`` starts the notifications sender.
+        ``receiver_dep`` is a utils.FrameReceiver instance.
+        ``clock`` is a callable that returns the current time.
+        """
+        self.children = [Child(key, args,
+                               bus_path and '%s.%s' % (bus_path, key))
+                         for key, args in enumerate(monitors_args)]
+        if sender:
+            self.children.append(Child('sender', [], spawn=sender_spawn_dep))
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._spawn = spawn_dep
+        self.receiver = receiver_dep or utils.FrameReceiver(utils.Signer())
+        self._clock = clock
+
+        self.restarts = 0
+        self.messages = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(get_monitors_args(settings),
+                   settings.getfloat('supervisor', 'restart_delay'),
+                   settings.getfloat('supervisor', 'max_restart_delay'),
+                   settings.get('monitor', 'bus_path') or None,
+                   # nowhere to deliver the notifications to
+                   bool(settings.get('manager', 'api_url')))
+
+    def _start(self, child):
+        if child.spawn is not None:
+            child.process = child.spawn(child.args)
+        elif child.bus_path:
+            child.process = self._spawn(child.args, stdout=None)
+        else:
+            child.process = self._spawn(child.args)
+            self.receiver.register(child.process.stdout, child.key)
+        child.started_at = self._clock()
+        child.restart_at = None
+
+    def _subscribe(self, child):
+        """
+        Connects to the bus of ``child``, which may not be listening
+        yet. Returns True on success.
+        """
+        try:
+            child.subscription = bus.subscribe(child.bus_path)
+        except socket.error:
+            return False
+
+        self.receiver.register(child.subscription, child.key)
+        return True
+
+    def _unsubscribe(self, child):
+        stream = child.subscription or child.process.stdout
+        if stream is not None:
+            self.receiver.unregister(stream)
+            stream.close()
+        child.subscription = None
+
+    def start(self):
+        for child in self.children:
+            self._start(child)
+
+    def backoff(self, failures):
+        """
+        Returns the delay in seconds before restarting a monitor that
+        exited ``failures`` times in a row.
+        """
+        return min(self.max_restart_delay, self.restart_delay * 2 ** failures)
+
+    def check(self):
+        """
+        Schedules the restart of the monitors that exited, and restarts
+        the ones whose delay is over. Returns the number of restarts.
+        """
+        now = self._clock()
+        restarted = 0
+
+        for child in self.children:
+            if child.restart_at is None:
+                returncode = child.process.poll()
+                if returncode is None:
+                    if child.bus_path and child.subscription is None:
+                        self._subscribe(child)
+                    continue
+
+                if now - child.started_at >= self.max_restart_delay:
+                    child.failures = 0
+                child.restart_at = now + self.backoff(child.failures)
+                child.failures += 1
+                sys.stderr.write('Process %s exited with %s, restarting in '
+                                 '%.1fs\n' % (child.key, returncode,
+                                              child.restart_at - now))
+
+            if now >= child.restart_at:
+                # the stream may be kept open by orphaned workers
+                self._unsubscribe(child)
+                self._start(child)
+                restarted += 1
+
+        self.restarts += restarted
+        return restarted
+
+    def poll(self, timeout=1):
+        """
+        Returns a list of (monitor key, message) tuples received within
+        ``timeout`` seconds, restarting the monitors that exited.
+        """
+        messages = self.receiver.poll(timeout)
+        self.messages += len(messages)
+        self.check()
+        return messages
+
+    def stop(self, timeout=10, signum=signal.SIGTERM):
+        """
+        Sends ``signum`` to the monitors and waits up to ``timeout``
+        seconds for them to exit, killing the remaining ones. Returns
+        the messages received meanwhile.
+        """
+        running = [child.process for child in self.children
+                   if child.process.poll() is None]
+        for process in running:
+            process.send_signal(signum)
+
+        messages = []
+        deadline = self._clock() + timeout
+        while running and self._clock() < deadline:
+            messages.extend(self.receiver.poll(0.1))
+            running = [process for process in running
+                       if process.poll() is None]
+
+        for process in running:
+            process.kill()
+            process.wait()
+
+        messages.extend(self.receiver.poll(0))
+        self.messages += len(messages)
+        for child in self.children:
+            self._unsubscribe(child)
+        self.receiver.close()
+        return messages
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=u'Balaio utility')
     parser.add_argument('-c', action='store', dest='configfile',
@@ -29,15 +292,25 @@ if __name__ == '__main__':
     args = parser.parse_args()
     setenv(args.configfile)
 
-    monitor = run_monitor()
+    supervisor = Supervisor.from_settings(utils.Configuration.from_env())
+
+    stopping = []
+    def _stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    supervisor.start()
 
     print 'Start listening'
     try:
-        while True:
-            out = monitor.stdout.readline()
-            print 'OUT: %r' % out
-    except KeyboardInterrupt:
-        pass
+        while not stopping:
+            for key, message in supervisor.poll():
+                print 'OUT[%s]: %r' % (key, message)
     finally:
         print 'Terminating all child processess'
-        monitor.terminate()
+        for key, message in supervisor.stop():
+            print 'OUT[%s]: %r' % (key, message)
+
+        print 'Messages: %s, restarts: %s' % (supervisor.messages,
+                                              supervisor.restarts)
@@ -0,0 +1,106 @@
+# coding: utf-8
+"""
+Micro-benchmarks for the hot paths of balaio.
+
+    python -m balaio.benchmarks
+"""
+import io
+import time
+import argparse
+
+from . import utils
+
+
+SAMPLE_MESSAGE = {
+    'package_md5': 'e5fcf4f4606df6368779205e29b22e58',
+    'package_fingerprint': 'e5fcf4f4606df6368779205e29b22e5851355de3',
+    'articlepkg_id': 1,
+    'filepath': '/var/balaio/inbox/0034-8910-rsp-47-02-0231.zip',
+}
+
+
+def _rate(count, func):
+    started = time.time()
+    func()
+    return count / (time.time() - started)
+
+
+def bench_text_messages(count, message=SAMPLE_MESSAGE):
+    """
+    Returns the messages per second sent and received with
+    ``utils.send_message`` and ``utils.recv_messages``.
+    """
+    stream = io.BytesIO()
+
+    def send():
+        for i in xrange(count):
+            utils.send_message(stream, message, utils.make_digest)
+
+    def recv():
+        stream.seek(0)
+        for received in utils.recv_messages(stream, utils.make_digest):
+            pass
+
+    return _rate(count, send), _rate(count, recv)
+
+
+def bench_binary_frames(count, message=SAMPLE_MESSAGE):
+    """
+    Returns the messages per second sent and received with
+    ``utils.send_frame`` and ``utils.recv_frames``.
+    """
+    stream = io.BytesIO()
+    signer = utils.Signer()
+
+    def send():
+        for i in xrange(count):
+            utils.send_frame(stream, message, signer)
+
+    def recv():
+        stream.seek(0)
+        for received in utils.recv_frames(stream, signer):
+            pass
+
+    return _rate(count, send), _rate(count, recv)
+
+
+def bench_frame_decoder(count, message=SAMPLE_MESSAGE):
+    """
+    Returns the messages per second sent with ``utils.send_frame`` and
+    decoded by ``utils.FrameDecoder`` from pipe-sized chunks.
+    """
+    stream = io.BytesIO()
+    signer = utils.Signer()
+    chunk_size = 64 * 1024
+
+    def send():
+        for i in xrange(count):
+            utils.send_frame(stream, message, signer)
+
+    def recv():
+        decoder = utils.FrameDecoder(signer)
+        data = stream.getvalue()
+        for i in xrange(0, len(data), chunk_size):
+            decoder.feed(data[i:i + chunk_size])
+
+    return _rate(count, send), _rate(count, recv)
+
+
+BENCHMARKS = [
+    ('text messages', bench_text_messages),
+    ('binary frames', bench_binary_frames),
+    ('decoded chunks', bench_frame_decoder),
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=u'Balaio benchmarks')
+    parser.add_argument('-n', type=int, default=100000, dest='count',
+        help='number of messages')
+
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS:
+        sent, received = bench(args.count)
+        print '%s: sent %.0f msgs/s, received %.0f msgs/s' % (
+            name, sent, received)
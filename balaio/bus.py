@@ -0,0 +1,275 @@
+# coding: utf-8
+"""
+A local message bus over a Unix domain socket.
+
+The Publisher is a file-like object, so messages are written to it
+with ``utils.send_frame`` or ``utils.send_message``, and fanned out to
+every connected subscriber. Each subscriber has a bounded buffer, so
+a slow consumer never blocks the publisher. Frames published while no
+subscriber is connected are held for the next one.
+"""
+import os
+import errno
+import fcntl
+import select
+import socket
+import time
+import threading
+from collections import deque
+
+
+# what to do when the buffer of a subscriber is full
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect')
+
+
+class Subscription(object):
+    """
+    A subscriber connected to a Publisher, and its pending frames.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.frames = deque()
+        self.buffered = 0
+        # bytes of the first frame already sent
+        self.offset = 0
+        self.dropped = 0
+
+    def fileno(self):
+        return self.fd
+
+
+class Publisher(object):
+    """
+    Fans out the written frames to the subscribers connected to a
+    Unix domain socket at ``path``. Subscribers are accepted and
+    written by a background thread.
+    """
+    def __init__(self, path, max_buffer=1024 * 1024, policy='drop'):
+        """
+        ``path`` is the pathname of the socket. A stale one is replaced.
+        ``max_buffer`` is the max number of bytes buffered for each
+        subscriber, and held while there is none.
+        ``policy`` is what happens to a subscriber whose buffer is full:
+        'drop' discards the new frames, 'disconnect' closes the
+        connection.
+        """
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('Unknown slow consumer policy %r' % policy)
+
+        self.path = path
+        self.max_buffer = max_buffer
+        self.policy = policy
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(16)
+        self._server.setblocking(0)
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        flags = fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        # disconnected, to be closed by the background thread
+        self._closing = []
+        # published while there were no subscribers
+        self._held = deque()
+        self._held_size = 0
+        self._pending = []
+        self._closed = threading.Event()
+
+        self.published = 0
+        self.dropped = 0
+        self.disconnected = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def from_settings(cls, path, settings):
+        return cls(path, settings.getint('monitor', 'bus_buffer_size'),
+                   settings.get('monitor', 'bus_slow_consumer'))
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def flush(self):
+        """
+        Publishes the data written since the last flush, as a unit.
+        """
+        if self._pending:
+            data = ''.join(self._pending)
+            self._pending = []
+            self.publish(data)
+
+    def publish(self, frame):
+        """
+        Appends ``frame`` to the buffer of each subscriber, applying
+        the slow consumer policy to those that are full. Without
+        subscribers, it is held for the next one to connect.
+        """
+        with self._lock:
+            if not self._subscriptions:
+                if self._held_size + len(frame) > self.max_buffer:
+                    self.dropped += 1
+                else:
+                    self._held.append(frame)
+                    self._held_size += len(frame)
+
+            for subscription in self._subscriptions.values():
+                if subscription.buffered + len(frame) > self.max_buffer:
+                    self.dropped += 1
+                    subscription.dropped += 1
+                    if self.policy == 'disconnect':
+                        self._disconnect(subscription)
+                    continue
+
+                subscription.frames.append(frame)
+                subscription.buffered += len(frame)
+
+            self.published += 1
+
+        self._wakeup()
+
+    @property
+    def subscribers(self):
+        return len(self._subscriptions)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _disconnect(self, subscription):
+        del self._subscriptions[subscription.fd]
+        self._closing.append(subscription)
+        self.disconnected += 1
+
+    def _accept(self):
+        try:
+            sock, address = self._server.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        sock.setblocking(0)
+        subscription = Subscription(sock)
+        if self._held:
+            subscription.frames, self._held = self._held, deque()
+            subscription.buffered, self._held_size = self._held_size, 0
+        self._subscriptions[sock.fileno()] = subscription
+
+    def _send(self, subscription):
+        """
+        Sends as much of the pending frames as the socket accepts.
+        """
+        while subscription.frames:
+            frame = subscription.frames[0]
+            try:
+                sent = subscription.sock.send(
+                    buffer(frame, subscription.offset))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                self._disconnect(subscription)
+                return
+
+            subscription.offset += sent
+            if subscription.offset < len(frame):
+                return
+
+            subscription.frames.popleft()
+            subscription.buffered -= len(frame)
+            subscription.offset = 0
+
+    def _run(self):
+        wakeup_fd = self._wakeup_r
+        while not self._closed.is_set():
+            with self._lock:
+                while self._closing:
+                    self._closing.pop().sock.close()
+                subscriptions = self._subscriptions.values()
+                writable = [subscription for subscription in subscriptions
+                            if subscription.frames]
+
+            try:
+                readable, writable, _ = select.select(
+                    [self._server, wakeup_fd] + subscriptions, writable, [])
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            with self._lock:
+                for item in readable:
+                    if item is self._server:
+                        self._accept()
+                    elif item == wakeup_fd:
+                        os.read(wakeup_fd, 4096)
+                    elif self._subscriptions.get(item.fd) is item:
+                        # subscribers only send when they hang up
+                        try:
+                            data = item.sock.recv(4096)
+                        except socket.error:
+                            data = ''
+                        if not data:
+                            self._disconnect(item)
+
+                for subscription in writable:
+                    if self._subscriptions.get(subscription.fd) is subscription:
+                        self._send(subscription)
+
+    def _is_drained(self):
+        with self._lock:
+            return not self._held and not any(subscription.frames
+                           for subscription in self._subscriptions.values())
+
+    def close(self, timeout=1):
+        """
+        Stops accepting subscribers and closes their connections.
+
+        ``timeout`` is the max number of seconds to wait for the
+        buffered frames to be sent, and the held ones to be taken by a
+        subscriber. The remaining ones are discarded.
+        """
+        deadline = time.time() + timeout
+        while not self._is_drained() and time.time() < deadline:
+            time.sleep(0.01)
+
+        self._closed.set()
+        self._wakeup()
+        self._thread.join()
+
+        for subscription in self._subscriptions.values() + self._closing:
+            subscription.sock.close()
+        self._subscriptions.clear()
+        self._closing = []
+        self._server.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def subscribe(path):
+    """
+    Returns a socket connected to the Publisher at ``path``, from
+    which the published frames are read, e.g. registering it on a
+    utils.FrameReceiver.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+
+    return sock
@@ -1,18 +1,104 @@
 #coding: utf-8
+import io
 import os
 import sys
 import stat
 import zipfile
+import hashlib
+import datetime
 import itertools
 import xml.etree.ElementTree as etree
 
+import integrity
 import models
 import utils
+import validator
 
 
 config = utils.Configuration.from_env()
 
 
+# (field name, parent tag, tag, required attribute)
+META_NODES = (
+    ('journal_title', 'journal-title-group', 'journal-title', None),
+    ('journal_eissn', None, 'issn', ('pub-type', 'epub')),
+    ('journal_pissn', None, 'issn', ('pub-type', 'ppub')),
+    ('article_title', 'title-group', 'article-title', None),
+    ('issue_year', 'pub-date', 'year', None),
+    ('issue_volume', None, 'volume', None),
+    ('issue_number', None, 'issue', None),
+)
+
+_META_NODES_BY_TAG = {}
+for _field, _parent, _tag, _attr in META_NODES:
+    _META_NODES_BY_TAG.setdefault(_tag, []).append((_field, _parent, _attr))
+
+
+def match_meta_node(parent_tag, element):
+    """
+    Returns the name of the meta field ``element`` stands for, or None.
+
+    ``parent_tag`` is the tag of the parent of ``element``.
+    ``element`` is an ElementTree element.
+    """
+    for field, parent, attr in _META_NODES_BY_TAG.get(element.tag, ()):
+        if parent is not None and parent != parent_tag:
+            continue
+        if attr is not None and element.get(attr[0]) != attr[1]:
+            continue
+        return field
+
+
+def iter_with_parent(element):
+    """
+    Walks the tree under ``element`` in document order, yielding
+    (parent, child) pairs.
+    """
+    stack = [(element, iter(element))]
+    while stack:
+        parent, children = stack[-1]
+        for child in children:
+            yield parent, child
+            stack.append((child, iter(child)))
+            break
+        else:
+            stack.pop()
+
+
+def stream_meta(fp, stop_at='front'):
+    """
+    Returns a dict with the fields listed at META_NODES, parsing ``fp``
+    incrementally and stopping as soon as the ``stop_at`` element is
+    closed, so the body and back matter are never read.
+
+    ``fp`` is a file-object with the xml document.
+    ``stop_at`` is the tag of the element that encloses all metadata.
+    """
+    dct_mta = dict((node[0], None) for node in META_NODES)
+    pending = set(dct_mta)
+    tags = []
+
+    for event, element in etree.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            tags.append(element.tag)
+            continue
+
+        tags.pop()
+        parent_tag = tags[-1] if tags else None
+        node_k = match_meta_node(parent_tag, element)
+        if node_k in pending:
+            dct_mta[node_k] = element.text
+            pending.remove(node_k)
+
+        if element.tag == stop_at or not pending:
+            break
+
+        # the text of the element was already consumed
+        element.clear()
+
+    return dct_mta
+
+
 class SPSMixin(object):
 
     @property
@@ -21,30 +107,82 @@ class SPSMixin(object):
         for fp in fps:
             yield etree.parse(fp)
 
+    @property
+    def xml_source(self):
+        """
+        The bytes of the xml document of the package. They are read on
+        the first access and kept for the lifetime of the instance, so
+        other parsers, such as lxml, don't need to read the member again.
+        """
+        try:
+            return self._xml_source
+        except AttributeError:
+            fps = list(itertools.islice(self.get_fps('xml'), 2))
+            if len(fps) != 1:
+                raise AttributeError('there is not a single xml file')
+
+            fp = fps[0]
+            try:
+                self._xml_source = fp.read()
+            finally:
+                fp.close()
+
+            return self._xml_source
+
     @property
     def xml(self):
-        xmls = list(itertools.islice(self.xmls, 2))
-        if len(xmls) == 1:
-            return xmls[0]
-        else:
-            raise AttributeError('there is not a single xml file')
+        """
+        The xml tree of the package. It is parsed on the first access
+        and kept for the lifetime of the instance.
+        """
+        try:
+            return self._xml
+        except AttributeError:
+            self._xml = etree.parse(io.BytesIO(self.xml_source))
+            return self._xml
 
     @property
     def meta(self):
-        dct_mta = {}
+        """
+        Returns a dict with the fields listed at META_NODES.
 
-        xml_nodes = {"journal_title": ".//journal-title-group/journal-title",
-                     "journal_eissn": ".//issn[@pub-type='epub']",
-                     "journal_pissn": ".//issn[@pub-type='ppub']",
-                     "article_title": ".//title-group/article-title",
-                     "issue_year": ".//pub-date/year",
-                     "issue_volume": ".//volume",
-                     "issue_number": ".//issue",
-                     }
+        If the xml tree is already parsed, the fields are collected in a
+        single traversal of it. Otherwise the xml is streamed and only
+        its front matter is read. Either way, they are kept for the
+        lifetime of the instance.
+        """
+        try:
+            return self._meta
+        except AttributeError:
+            pass
+
+        if hasattr(self, '_xml'):
+            self._meta = self._tree_meta()
+            return self._meta
+
+        fps = list(itertools.islice(self.get_fps('xml'), 2))
+        if len(fps) != 1:
+            raise AttributeError('there is not a single xml file')
+
+        fp = fps[0]
+        try:
+            self._meta = stream_meta(fp)
+        finally:
+            fp.close()
+
+        return self._meta
+
+    def _tree_meta(self):
+        dct_mta = dict((node[0], None) for node in META_NODES)
+        pending = set(dct_mta)
 
-        for node_k, node_v in xml_nodes.items():
-            node = self.xml.find(node_v)
-            dct_mta[node_k] = getattr(node, 'text', None)
+        for parent, node in iter_with_parent(self.xml.getroot()):
+            node_k = match_meta_node(parent.tag, node)
+            if node_k in pending:
+                dct_mta[node_k] = node.text
+                pending.remove(node_k)
+                if not pending:
+                    break
 
         return dct_mta
 
@@ -53,8 +191,15 @@ class Xray(object):
 
     def __init__(self, filename):
         self._filename = filename
-        self._zip_pkg = zipfile.ZipFile(filename, 'r')
+        self._fp = io.open(filename, 'rb')
+        try:
+            self._zip_pkg = zipfile.ZipFile(self._fp, 'r')
+        except:
+            self._fp.close()
+            raise
         self._pkg_names = {}
+        self._checksum = None
+        self._filesize = None
 
         self._classify()
 
@@ -62,16 +207,105 @@ class Xray(object):
         self._cleanup_package_fp()
 
     def _cleanup_package_fp(self):
+        # the zip file does not close file objects it didn't open
         self._zip_pkg.close()
+        self._fp.close()
 
     def _classify(self):
+        members = []
+        manifest = []
         for fileinfo, filename in zip(self._zip_pkg.infolist(), self._zip_pkg.namelist()):
-            # ignore directories and empty files
-            if fileinfo.file_size:
-                _, ext = filename.rsplit('.', 1)
+            members.append((filename, fileinfo.CRC, fileinfo.file_size))
+            manifest.append({'name': filename,
+                             'extension': utils.get_extension(filename),
+                             'crc': fileinfo.CRC,
+                             'size': fileinfo.file_size,
+                             'compressed_size': fileinfo.compress_size})
+
+            # ignore directories, empty files and files without extension
+            ext = utils.get_extension(filename)
+            if fileinfo.file_size and ext is not None:
                 ext_node = self._pkg_names.setdefault(ext, [])
                 ext_node.append(filename)
 
+        self._members = members
+        self._manifest = manifest
+        self._fingerprint = self._make_fingerprint(members)
+
+    @staticmethod
+    def _make_fingerprint(members):
+        if not members:
+            return None
+
+        hash = hashlib.sha1()
+        for filename, crc, size in sorted(members):
+            # zipfile gives unicode names when they are flagged as utf-8
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8')
+            hash.update('%s\0%08x\0%d\n' % (filename, crc, size))
+
+        return hash.hexdigest()
+
+    @property
+    def members(self):
+        """
+        A list of (name, CRC32, size) tuples, one for each member of
+        the package, taken from its central directory.
+        """
+        return self._members
+
+    @property
+    def manifest(self):
+        """
+        A list of dicts with the name, lowercase extension, CRC32,
+        size and compressed size of each member of the package, taken
+        from its central directory. See: models.PackageMember
+        """
+        return self._manifest
+
+    @property
+    def fingerprint(self):
+        """
+        A digest of the name, CRC32 and size of every member, taken from
+        the central directory of the package. Identical packages have
+        the same fingerprint, and it is available without decompressing
+        or reading the members. None if the package is empty.
+        """
+        return self._fingerprint
+
+    def _read_package(self):
+        """
+        Reads the whole package once, computing its checksum and size.
+        The read bytes are kept in the page cache, so subsequent
+        reads of its members are cheap.
+        """
+        position = self._fp.tell()
+        try:
+            self._fp.seek(0)
+            self._checksum, self._filesize = utils.make_digest_and_size(self._fp)
+        finally:
+            self._fp.seek(position)
+
+    @property
+    def checksum(self):
+        """
+        The digest of the package file, as in utils.make_digest_file.
+        """
+        if self._checksum is None:
+            self._read_package()
+
+        return self._checksum
+
+    @property
+    def filesize(self):
+        """
+        The size in bytes of the package file.
+        """
+        if self._filesize is None:
+            return os.fstat(self._fp.fileno()).st_size
+
+        return self._filesize
+
     def get_ext(self, ext):
         try:
             return self._pkg_names[ext]
@@ -123,6 +357,27 @@ class PackageAnalyzer(SPSMixin, Xray):
 
         return is_valid
 
+    def validate(self, validators=None, previous=None):
+        """
+        Runs ``validators`` concurrently and returns their results,
+        reusing the ``previous`` ones whose inputs did not change.
+        See: validator.run_validators
+        """
+        return validator.run_validators(self, validators, previous=previous)
+
+    def verify_members(self, destination=None):
+        """
+        Checks that every member decompresses to its CRC32 and size,
+        extracting them to ``destination`` if given. Returns True when
+        all of them are sound.
+        See: integrity.verify_package
+        """
+        errors = integrity.verify_package(self._filename,
+                                          self._zip_pkg.infolist(),
+                                          destination)
+        self._errors.update(errors)
+        return not errors
+
     def lock_package(self):
         """
         Removes the write permission for Others.
@@ -138,23 +393,131 @@ class PackageAnalyzer(SPSMixin, Xray):
         self.is_locked = False
 
 
-def get_attempt(package):
+def inspect_package(package, session=None):
+    """
+    Analyzes ``package`` and returns a dict with what is needed to
+    store its attempt. The database is only read, so all the writes
+    happen at save_attempt:
+
+    * ``articlepkg``: the fields of the models.ArticlePkg.
+    * ``attempt``: the fields of the models.Attempt.
+    * ``validations``: when the validations started and their results.
+      Checks whose input members are the same as in the latest
+      attempt of the article are not run again.
+    * ``members``: the manifest of the package, as in Xray.manifest.
+    * ``duplicate_id``: the id of the attempt of an identical package,
+      if any. In this case the other keys are None, but ``digest``.
+    * ``digest``: the models.stat_key of the package and its checksum,
+      to be cached at models.PackageDigest, or None if already cached.
+
+    The members of new packages are verified, and extracted to a
+    directory named after the package checksum under
+    ``[app] staging_path`` when it is set.
+
+    Invalid packages, including the ones with corrupted members, are
+    marked as failed and None is returned.
+
+    ``package`` is the package file.
+    ``session`` is the session in use by the caller.
     """
-    Always returns a brand new models.Attempt instance, bound to
-    the expected models.ArticlePkg instance.
+    with models.session_scope(session) as ses:
+        with PackageAnalyzer(package) as pkg:
+            is_valid = pkg.is_valid_package()
+
+            if is_valid:
+                # the package is read before its members are parsed, so
+                # they are found at the page cache
+                digest_key = models.stat_key(os.stat(package))
+                checksum = models.find_digest(digest_key, session=ses)
+                new_digest = None
+                if checksum is None:
+                    checksum = pkg.checksum
+                    new_digest = (digest_key, checksum)
+
+                duplicate = models.find_attempt(pkg.fingerprint,
+                    lambda: checksum, session=ses)
+                if duplicate is not None:
+                    return {'articlepkg': None,
+                            'attempt': None,
+                            'validations': None,
+                            'members': None,
+                            'duplicate_id': duplicate.id,
+                            'digest': new_digest}
+
+                attempt_meta = {'package_md5': checksum,
+                                'package_fingerprint': pkg.fingerprint}
+
+                destination = None
+                if config.get('app', 'staging_path'):
+                    destination = os.path.join(config.get('app', 'staging_path'),
+                                               attempt_meta['package_md5'])
+                is_valid = pkg.verify_members(destination)
+
+            if is_valid:
+                started_at = datetime.datetime.now()
+                # the validators need the whole tree, so it is parsed
+                # before the metadata, which is then taken from it
+                # instead of streaming the document again
+                pkg.xml
+                previous = models.get_latest_validations(ses, **pkg.meta)
+                validations = {'started_at': started_at,
+                               'results': pkg.validate(previous=previous)}
+
+                return {'articlepkg': pkg.meta,
+                        'attempt': attempt_meta,
+                        'validations': validations,
+                        'members': pkg.manifest,
+                        'duplicate_id': None,
+                        'digest': new_digest}
+
+    # the package must be released before being renamed
+    sys.stderr.write("Invalid package: %s\n" % (pkg.errors,))
+    utils.mark_as_failed(package)
+
+
+def save_attempt(session, inspection):
     """
-    with PackageAnalyzer(package) as pkg:
+    Stores the attempt described by ``inspection`` and returns it.
+    Nothing is committed.
 
-        if pkg.is_valid_package():
-            article = models.get_or_create(models.ArticlePkg, **pkg.meta)
-            pkg_checksum = utils.make_digest_file(package)
+    Identical packages inspected at the same time get the same attempt,
+    whose members and validations are stored once.
 
-            attempt_meta = {'package_md5': pkg_checksum,
-                            'articlepkg_id': article.id}
-            attempt = models.get_or_create(models.Attempt, **attempt_meta)
+    ``session`` is the session in use by the caller.
+    ``inspection`` is the value returned by inspect_package.
+    """
+    if inspection['digest'] is not None:
+        models.save_digest(session, *inspection['digest'])
 
-            return attempt
-        else:
-            sys.stderr.write("Invalid package: %s\n" % pkg.errors)
-            utils.mark_as_failed(package)
+    if inspection['duplicate_id'] is not None:
+        return session.query(models.Attempt).get(inspection['duplicate_id'])
+
+    articlepkg_id = models.get_articlepkg_id(session,
+                                             **inspection['articlepkg'])
+
+    attempt_meta = dict(inspection['attempt'], articlepkg_id=articlepkg_id)
+    attempt, created = models.get_or_create_with_status(session,
+        models.Attempt, **attempt_meta)
+
+    validations = inspection.get('validations')
+    if created and validations is not None:
+        models.save_members(session, attempt, inspection['members'])
+        models.save_validations(session, attempt, validations['results'],
+                                started_at=validations['started_at'])
+
+    return attempt
+
+
+def get_attempt(package):
+    """
+    Returns a models.Attempt instance bound to the expected
+    models.ArticlePkg instance. Packages identical to an already
+    attempted one get the existing instance.
+
+    All the database work is committed at once.
+    """
+    with models.session_scope() as session:
+        inspection = inspect_package(package, session=session)
 
+        if inspection is not None:
+            return save_attempt(session, inspection)
@@ -0,0 +1,206 @@
+# coding: utf-8
+"""
+A stand-in for the SciELO Manager API, used to exercise and benchmark
+the notifier offline.
+
+Runs a server until interrupted:
+
+    python -m balaio.fakemanager --port 8000 --latency 0.02
+
+Or measures the check-ins throughput, single and bulk:
+
+    python -m balaio.fakemanager --bench 2000 --bulk-size 100 --gzip
+"""
+import time
+import json
+import zlib
+import urlparse
+import argparse
+import threading
+import ConfigParser
+import SocketServer
+import BaseHTTPServer
+
+from . import notifier
+
+
+def validate_checkin(item):
+    """
+    Returns the error message for an invalid check-in message,
+    or None.
+    """
+    if not isinstance(item, dict):
+        return 'expected an object'
+
+    missing = [field for field in notifier.CHECKIN_MESSAGE_FIELDS
+               if field not in item]
+    if missing:
+        return 'missing fields: %s' % ', '.join(missing)
+
+
+class FakeManagerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Accepts form-encoded POSTs to any endpoint, and json-encoded,
+    optionally gzip-compressed, POSTs to ``<endpoint>/bulk/``.
+    """
+    protocol_version = 'HTTP/1.1'
+    # a single write per response, flushed by handle_one_request
+    wbufsize = -1
+
+    def _read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _respond(self, status, body='', content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.path.rstrip('/').endswith('/bulk'):
+            try:
+                items = json.loads(body)['objects']
+            except (ValueError, KeyError, TypeError):
+                return self._respond(400, 'malformed bulk request')
+
+            results = []
+            for item in items:
+                error = validate_checkin(item)
+                if error:
+                    results.append({'status': 'error', 'message': error})
+                else:
+                    results.append({'status': 'created'})
+
+            self.server.count(1, len(items))
+            self._respond(200, json.dumps({'objects': results}),
+                          'application/json')
+        else:
+            item = dict(urlparse.parse_qsl(body))
+            error = validate_checkin(item)
+
+            self.server.count(1, 1)
+            if error:
+                self._respond(400, error)
+            else:
+                self._respond(201, 'created')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeManagerServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    # persistent connections must not block each other
+    daemon_threads = True
+
+    def __init__(self, address, latency=0):
+        """
+        ``address`` is a (host, port) tuple. Port 0 picks a free one.
+        ``latency`` is the number of seconds each request takes.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeManagerHandler)
+        self.latency = latency
+        self.requests = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def count(self, requests, messages):
+        with self._lock:
+            self.requests += requests
+            self.messages += messages
+
+
+class FakeManager(object):
+    """
+    A FakeManagerServer running on a thread.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.httpd = FakeManagerServer((host, port), latency)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def benchmark(url, count, bulk_size, compress=False):
+    """
+    Submits ``count`` check-in messages to the Manager at ``url``,
+    one per request and then ``bulk_size`` per request. Returns a
+    tuple with the messages per second of each mode.
+    """
+    settings = ConfigParser.ConfigParser()
+    settings.add_section('manager')
+    settings.set('manager', 'api_url', url)
+    settings.set('manager', 'api_username', 'bench')
+    settings.set('manager', 'api_key', 'bench')
+    ntf = notifier.Notifier(settings, notifier.Request, notifier.Outbox())
+
+    messages = [dict((field, '%s-%s' % (field, i))
+                     for field in notifier.CHECKIN_MESSAGE_FIELDS)
+                for i in range(count)]
+    endpoint = notifier.BULK_ENDPOINTS[0]
+
+    started = time.time()
+    for message in messages:
+        ntf._submit(endpoint, message)
+    single = count / (time.time() - started)
+
+    started = time.time()
+    for i in range(0, count, bulk_size):
+        errors = ntf._submit_bulk(endpoint, messages[i:i + bulk_size],
+                                  compress=compress)
+        assert not any(errors), errors
+    bulk = count / (time.time() - started)
+
+    return single, bulk
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=u'Fake SciELO Manager')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+        help='seconds taken by each request')
+    parser.add_argument('--bench', type=int, metavar='N',
+        help='submit N messages to a local fake manager and exit')
+    parser.add_argument('--bulk-size', type=int, default=100)
+    parser.add_argument('--gzip', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.bench:
+        manager = FakeManager(args.host, 0, args.latency)
+        try:
+            single, bulk = benchmark(manager.url, args.bench, args.bulk_size,
+                                     args.gzip)
+        finally:
+            manager.shutdown()
+
+        print 'single: %.1f msgs/s' % single
+        print 'bulk (%s per request): %.1f msgs/s' % (args.bulk_size, bulk)
+    else:
+        httpd = FakeManagerServer((args.host, args.port), args.latency)
+        print 'Listening at http://%s:%s' % (args.host, args.port)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
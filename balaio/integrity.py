@@ -0,0 +1,211 @@
+# coding: utf-8
+"""
+Integrity checks of the package members, run before they are parsed.
+
+Every member is decompressed and has its CRC32 and size compared to
+the ones at the central directory of the package, so truncated or
+corrupted uploads are caught even when their names look fine. The
+members are checked concurrently, on a pool of threads, as zlib
+releases the GIL while decompressing.
+"""
+import os
+import zlib
+import errno
+import Queue
+import shutil
+import zipfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import utils
+
+
+config = utils.Configuration.from_env()
+
+# the smallest chunk read from a member at once
+MIN_CHUNK_SIZE = 64 * 1024
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the thread pool of the current process, sized by
+    ``[app] integrity_threads``, creating it on the first use.
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(config.getint('app', 'integrity_threads'))
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def get_chunk_size(threads, memory_budget):
+    """
+    Returns the number of bytes each thread reads from a member at
+    once, so that all of them together stay within ``memory_budget``
+    bytes. Never less than MIN_CHUNK_SIZE.
+    """
+    return max(MIN_CHUNK_SIZE, memory_budget // max(1, threads))
+
+
+def staging_pathname(destination, name):
+    """
+    Returns the pathname where the member ``name`` is extracted to,
+    under the ``destination`` directory. Raises ValueError for names
+    that would escape it.
+    """
+    root = os.path.abspath(destination)
+    pathname = os.path.abspath(os.path.join(root, name))
+    if not pathname.startswith(root + os.sep):
+        raise ValueError('unsafe member name %r' % name)
+
+    return pathname
+
+
+def _makedirs(path):
+    # members are extracted concurrently to the same directories
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def verify_member(zip_pkg, info, chunk_size, destination=None):
+    """
+    Decompresses the member described by ``info`` and returns an error
+    message, or None if its CRC32 and size are right.
+
+    ``zip_pkg`` is a zipfile.ZipFile of the package, used by a single
+    thread at a time.
+    ``info`` is the zipfile.ZipInfo of the member.
+    ``chunk_size`` is the number of bytes read at once.
+    ``destination`` is the directory the member is extracted to, if
+    any.
+    """
+    target = None
+    try:
+        if destination is not None:
+            pathname = staging_pathname(destination, info.filename)
+            if info.filename.endswith('/'):
+                _makedirs(pathname)
+                return None
+
+            _makedirs(os.path.dirname(pathname))
+            target = open(pathname, 'wb')
+
+        size = 0
+        member = zip_pkg.open(info, 'r')
+        # the CRC32 is checked by zipfile when the end is reached
+        while True:
+            chunk = member.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if target is not None:
+                target.write(chunk)
+
+        if size != info.file_size:
+            return '%s: expected %s bytes, got %s' % (info.filename,
+                                                      info.file_size, size)
+
+    # zipfile raises RuntimeError for encrypted members, and
+    # NotImplementedError for unsupported compression methods
+    except (zipfile.BadZipfile, zlib.error, EnvironmentError, EOFError,
+            ValueError, RuntimeError, NotImplementedError), e:
+        return '%s: %s' % (info.filename, e)
+
+    finally:
+        if target is not None:
+            target.close()
+
+    return None
+
+
+def verify_members(filename, infos, chunk_size, destination=None):
+    """
+    Verifies the members taken from ``infos``, a Queue.Queue of
+    zipfile.ZipInfo, until it is empty. Returns a list of error
+    messages.
+
+    The package is opened once, so each thread reads through its own
+    file object without parsing the central directory again.
+    """
+    errors = []
+    try:
+        zip_pkg = zipfile.ZipFile(filename, 'r')
+    except (zipfile.BadZipfile, EnvironmentError), e:
+        return ['%s: %s' % (filename, e)]
+
+    try:
+        while True:
+            try:
+                info = infos.get_nowait()
+            except Queue.Empty:
+                break
+
+            error = verify_member(zip_pkg, info, chunk_size, destination)
+            if error is not None:
+                errors.append(error)
+    finally:
+        zip_pkg.close()
+
+    return errors
+
+
+def verify_package(filename, infos=None, destination=None, pool=None,
+                   chunk_size=None, threads=None):
+    """
+    Verifies the members of the package at ``filename`` concurrently
+    and returns a list of error messages, empty if all are sound.
+
+    Each thread takes the largest member left, so a package is verified
+    in about the time taken by its largest member, given enough threads.
+
+    ``infos`` is a list with the zipfile.ZipInfo of the members to be
+    verified. Defaults to all.
+    ``destination`` is the directory the members are extracted to, if
+    any. It is removed if any member is not sound.
+    ``pool`` is a pool of threads. Defaults to the one of the process.
+    ``chunk_size`` is the number of bytes each thread reads at once.
+    Defaults to ``[app] integrity_memory_budget`` split among
+    ``[app] integrity_threads``.
+    ``threads`` is the number of threads of ``pool`` used. Defaults
+    to ``[app] integrity_threads``.
+    """
+    if infos is None:
+        with zipfile.ZipFile(filename, 'r') as zip_pkg:
+            infos = zip_pkg.infolist()
+
+    if threads is None:
+        threads = config.getint('app', 'integrity_threads')
+
+    if chunk_size is None:
+        chunk_size = get_chunk_size(
+            threads, config.getint('app', 'integrity_memory_budget'))
+
+    queue = Queue.Queue()
+    for info in sorted(infos, key=lambda info: info.compress_size,
+                       reverse=True):
+        queue.put(info)
+
+    pool = pool or get_pool()
+    pending = [pool.apply_async(verify_members,
+                                (filename, queue, chunk_size, destination))
+               for i in range(max(1, min(threads, len(infos))))]
+
+    errors = []
+    for result in pending:
+        errors.extend(result.get())
+
+    if errors and destination is not None:
+        shutil.rmtree(destination, ignore_errors=True)
+
+    return errors
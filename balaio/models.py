@@ -1,13 +1,29 @@
 # coding: utf-8
+import os
+import sys
+import time
 import datetime
+import threading
+from contextlib import contextmanager
 
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     ForeignKey,
     DateTime,
     String,
+    Text,
+    Index,
+    event,
+    inspect,
+    select,
+    func,
+    and_,
+    or_,
 )
+from sqlalchemy.exc import IntegrityError, DisconnectionError
+from sqlalchemy.engine import Connection
 from sqlalchemy.orm import (
     relationship,
     backref,
@@ -20,17 +36,110 @@ import utils
 
 config = utils.Configuration.from_env()
 
-engine = create_engine(config.get('app', 'db_dsn'),
-                       echo=config.getboolean('app', 'debug'))
-Session = sessionmaker(bind=engine)
+# instances outlive their sessions, e.g. when sent to other processes
+session_factory = sessionmaker(expire_on_commit=False)
 Base = declarative_base()
 
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+# engines inherited from the parent process. They are kept referenced
+# so their connections, which belong to the parent, are never closed
+# by the child.
+_inherited_engines = []
+
+
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    # pysqlite handles transactions on its own, breaking savepoints.
+    # See: http://docs.sqlalchemy.org/en/rel_0_8/dialects/sqlite.html
+    dbapi_connection.isolation_level = None
+
+
+def _begin_sqlite_transaction(connection):
+    connection.execute('BEGIN')
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checks if pooled connections are alive before handing them out.
+    Dead connections are discarded and the checkout is retried.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def create_configured_engine(settings):
+    """
+    Returns a new engine set up by the ``[app]`` section of
+    ``settings``.
+
+    ``settings`` is an instance of ConfigParser.ConfigParser.
+    """
+    dsn = settings.get('app', 'db_dsn')
+    options = {'echo': settings.getboolean('app', 'debug'),
+               'pool_recycle': settings.getint('app', 'db_pool_recycle')}
+
+    # sqlite uses pools of a single connection
+    if not dsn.startswith('sqlite'):
+        options['pool_size'] = settings.getint('app', 'db_pool_size')
+        options['max_overflow'] = settings.getint('app', 'db_max_overflow')
+
+    engine = create_engine(dsn, **options)
+
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _disable_pysqlite_transactions)
+        event.listen(engine, 'begin', _begin_sqlite_transaction)
+
+    if settings.getboolean('app', 'db_pool_pre_ping'):
+        event.listen(engine, 'checkout', _ping_connection)
+
+    return engine
+
+
+def get_engine():
+    """
+    Returns the engine of the current process, creating it on the
+    first use. Processes forked after the engine is created get an
+    engine of their own.
+    """
+    global _engine, _engine_pid
+
+    with _engine_lock:
+        if _engine is not None and _engine_pid != os.getpid():
+            _inherited_engines.append(_engine)
+            _engine = None
+
+        if _engine is None:
+            _engine = create_configured_engine(config)
+            _engine_pid = os.getpid()
+
+        return _engine
+
+
+def Session(**kwargs):
+    """
+    Returns a new session bound to the engine of the current process.
+    """
+    return session_factory(bind=get_engine(), **kwargs)
+
 
 class Attempt(Base):
     __tablename__ = 'attempt'
+    __table_args__ = (
+        # the attempts of an article, in chronological order
+        Index('ix_attempt_articlepkg_id_started_at',
+              'articlepkg_id', 'started_at'),
+        Index('ix_attempt_started_at', 'started_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     package_md5 = Column(String(length=32), unique=True)
+    package_fingerprint = Column(String(length=40), index=True)
     articlepkg_id = Column(Integer, ForeignKey('articlepkg.id'))
     started_at = Column(DateTime, nullable=False)
     finished_at = Column(DateTime)
@@ -48,8 +157,19 @@ class Attempt(Base):
         return "<Attempt('%s, %s')>" % (self.id, self.package_md5)
 
 
+# the natural key of ArticlePkg
+ARTICLEPKG_KEY = ('article_title', 'journal_pissn', 'journal_eissn',
+                  'journal_title', 'issue_year', 'issue_volume',
+                  'issue_number')
+
+
 class ArticlePkg(Base):
     __tablename__ = 'articlepkg'
+    __table_args__ = (
+        # an index instead of a constraint, so it can be added to
+        # existing tables by migrate
+        Index('ix_articlepkg_natural_key', *ARTICLEPKG_KEY, unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     article_title = Column(String, nullable=False)
@@ -64,26 +184,742 @@ class ArticlePkg(Base):
         return "<ArticlePkg('%s, %s')>" % (self.id, self.article_title)
 
 
-def get_or_create(model, **kwargs):
+# maps the natural key of ArticlePkg rows to their ids
+articlepkg_ids = utils.LRUCache(config.getint('app', 'articlepkg_cache_size'))
+
+
+@event.listens_for(ArticlePkg, 'after_update')
+@event.listens_for(ArticlePkg, 'after_delete')
+def _forget_articlepkg(mapper, connection, target):
+    articlepkg_ids.invalidate_value(target.id)
+
+
+@event.listens_for(session_factory, 'after_rollback')
+def _forget_articlepkgs(session):
+    # ids read inside the transaction may be gone
+    articlepkg_ids.clear()
+
+
+def invalidate_articlepkg(articlepkg_id):
+    """
+    Removes ``articlepkg_id`` from the ArticlePkg identity cache. It
+    must be called when rows are changed or deleted without the ORM.
+    """
+    articlepkg_ids.invalidate_value(articlepkg_id)
+
+
+class PackageDigest(Base):
+    """
+    The digest of a package file, identified by its stat data so it
+    is computed again only if the file changes.
+    """
+    __tablename__ = 'packagedigest'
+
+    st_dev = Column(BigInteger, primary_key=True, autoincrement=False)
+    st_ino = Column(BigInteger, primary_key=True, autoincrement=False)
+    st_size = Column(BigInteger, primary_key=True, autoincrement=False)
+    st_mtime_ns = Column(BigInteger, primary_key=True, autoincrement=False)
+    digest = Column(String(length=40), nullable=False)
+
+    def __repr__(self):
+        return "<PackageDigest('%s, %s')>" % (self.st_ino, self.digest)
+
+
+class Notification(Base):
+    """
+    A notification waiting to be delivered to SciELO Manager.
+    See: notifier.Outbox
+    """
+    __tablename__ = 'notification'
+    __table_args__ = (
+        # the pending notifications, by the time of the next try
+        Index('ix_notification_delivered_at_next_attempt_at',
+              'delivered_at', 'next_attempt_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    endpoint = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    delivered_at = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    # the sender delivering it, until its next_attempt_at
+    claimed_by = Column(String(length=32))
+
+    def __repr__(self):
+        return "<Notification('%s, %s')>" % (self.id, self.endpoint)
+
+
+class PackageMember(Base):
+    """
+    A member of the package of an attempt, as listed at the central
+    directory of the package.
+    """
+    __tablename__ = 'packagemember'
+    __table_args__ = (
+        # the members of a kind, by size
+        Index('ix_packagemember_extension_size', 'extension', 'size'),
+        Index('ix_packagemember_size', 'size'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    attempt_id = Column(Integer, ForeignKey('attempt.id'), nullable=False,
+                        index=True)
+    name = Column(String, nullable=False)
+    # lowercase, without the dot
+    extension = Column(String)
+    crc = Column(BigInteger, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    compressed_size = Column(BigInteger)
+
+    attempt = relationship('Attempt',
+                           backref=backref('members',
+                           cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return "<PackageMember('%s, %s')>" % (self.attempt_id, self.name)
+
+
+class ValidationSet(Base):
+    """
+    The validations run for an attempt.
+    """
+    __tablename__ = 'validationset'
+
+    id = Column(Integer, primary_key=True)
+    attempt_id = Column(Integer, ForeignKey('attempt.id'), nullable=False,
+                        index=True)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+
+    attempt = relationship('Attempt',
+                           backref=backref('validationsets',
+                           cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return "<ValidationSet('%s, %s')>" % (self.id, self.attempt_id)
+
+
+class Validation(Base):
+    """
+    The result of a validator. See: validator.registry
+    """
+    __tablename__ = 'validation'
+
+    id = Column(Integer, primary_key=True)
+    validationset_id = Column(Integer, ForeignKey('validationset.id'),
+                              nullable=False, index=True)
+    label = Column(String, nullable=False)
+    status = Column(String(length=16), nullable=False)
+    description = Column(Text)
+
+    validationset = relationship('ValidationSet',
+                                 backref=backref('validations',
+                                 cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return "<Validation('%s, %s, %s')>" % (self.id, self.label, self.status)
+
+
+def stat_key(st):
+    """
+    Returns the (st_dev, st_ino, st_size, st_mtime_ns) tuple that
+    identifies a given version of a file.
+
+    ``st`` is the result of os.stat.
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+@contextmanager
+def session_scope(session=None):
+    """
+    Yields ``session`` as is, or a new session that is committed at
+    the end of the block, rolled back on errors and closed.
+    """
+    if session is not None:
+        yield session
+        return
+
+    ses = Session()
+    try:
+        yield ses
+        ses.commit()
+    except:
+        ses.rollback()
+        raise
+    finally:
+        ses.close()
+
+
+def _insert(session, obj):
+    """
+    Inserts ``obj`` inside a savepoint, so a constraint violation does
+    not spoil the transaction. Returns False on violations.
+    """
+    savepoint = session.begin_nested()
+    try:
+        session.add(obj)
+        savepoint.commit()
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+
+    return True
+
+
+def _insert_or_get(session, model, **kwargs):
+    """
+    Inserts a ``model`` instance made of ``kwargs`` inside a savepoint,
+    and returns a tuple with it and True. If a concurrent worker
+    inserted the same row first, that row is returned instead, with
+    False. Other constraint violations are raised.
+    """
+    obj = model(**kwargs)
+    savepoint = session.begin_nested()
+    try:
+        session.add(obj)
+        savepoint.commit()
+    except IntegrityError:
+        exc_info = sys.exc_info()
+        savepoint.rollback()
+
+        existing = session.query(model).filter_by(**kwargs).first()
+        if existing is None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return existing, False
+
+    return obj, True
+
+
+def get_digest(filepath, make_digest=utils.make_digest_file, session=None):
+    """
+    Returns the digest of ``filepath``, looking it up at the
+    PackageDigest cache before reading the file.
+
+    ``filepath`` is the package file.
+    ``make_digest`` is a callable that computes the digest of
+    ``filepath`` on cache misses.
+    ``session`` is the session in use by the caller, who is in charge
+    of committing it. If missing, a new one is used and committed.
+    """
+    key = stat_key(os.stat(filepath))
+
+    with session_scope(session) as ses:
+        digest = find_digest(key, session=ses)
+        if digest is not None:
+            return digest
+
+        digest = make_digest(filepath)
+        save_digest(ses, key, digest)
+        return digest
+
+
+def find_digest(key, session=None):
+    """
+    Returns the digest cached at PackageDigest for the file identified
+    by ``key``, or None. Nothing is written.
+
+    ``key`` is the value returned by stat_key.
+    ``session`` is the session in use by the caller.
+    """
+    with session_scope(session) as ses:
+        cached = ses.query(PackageDigest).get(key)
+        if cached is not None:
+            return cached.digest
+
+
+def save_digest(session, key, digest):
+    """
+    Caches ``digest`` at PackageDigest for the file identified by
+    ``key``, unless it was already cached by a concurrent worker.
+    Nothing is committed.
+
+    ``session`` is the session in use by the caller.
+    ``key`` is the value returned by stat_key.
+    """
+    _insert(session, PackageDigest(st_dev=key[0], st_ino=key[1],
+                                   st_size=key[2], st_mtime_ns=key[3],
+                                   digest=digest))
+
+
+class DigestCache(object):
+    """
+    The PackageDigest cache held in memory, to look up the digests of
+    many packages at once, e.g. when scanning the watch paths. New
+    digests are stored only when ``flush`` is called.
+    """
+    def __init__(self, digests=(), make_digest=utils.make_digest_file):
         """
-        Try get the model by ```kwargs``` otherwise create the model.
+        ``digests`` is an iterable of (stat key, digest) pairs.
+        ``make_digest`` is a callable that computes the digest of a
+        file on cache misses.
         """
-        ses = Session()
+        self._digests = dict(digests)
+        self._new = {}
+        self._make_digest = make_digest
 
-        obj = ses.query(model).filter_by(**kwargs)
+    @classmethod
+    def load(cls, session=None, **kwargs):
+        """
+        Returns a DigestCache with all the stored digests, read with
+        a single query.
+        """
+        with session_scope(session) as ses:
+            return cls((((st_dev, st_ino, st_size, st_mtime_ns), digest)
+                        for st_dev, st_ino, st_size, st_mtime_ns, digest in
+                        ses.query(PackageDigest.st_dev, PackageDigest.st_ino,
+                                  PackageDigest.st_size,
+                                  PackageDigest.st_mtime_ns,
+                                  PackageDigest.digest)),
+                       **kwargs)
 
-        if ses.query(obj.exists()).scalar():
-            return obj.one()
-        else:
-            obj = model(**kwargs)
-            ses.add(obj)
-            ses.commit()
-            return obj
+    def __len__(self):
+        return len(self._digests)
 
+    def get(self, filepath):
+        """
+        Returns the digest of ``filepath``, reading the file only if it
+        is not cached.
+        """
+        key = stat_key(os.stat(filepath))
+        try:
+            return self._digests[key]
+        except KeyError:
+            digest = self._make_digest(filepath)
+            self._digests[key] = self._new[key] = digest
+            return digest
+
+    def flush(self, session=None):
+        """
+        Stores the digests computed since the last flush, inserting
+        them at once. Returns their number.
+
+        ``session`` is the session in use by the caller, who is in charge
+        of committing it. If missing, a new one is used and committed.
+        """
+        rows = [{'st_dev': key[0], 'st_ino': key[1], 'st_size': key[2],
+                 'st_mtime_ns': key[3], 'digest': digest}
+                for key, digest in self._new.iteritems()]
+        if not rows:
+            return 0
+
+        with session_scope(session) as ses:
+            savepoint = ses.begin_nested()
+            try:
+                ses.execute(PackageDigest.__table__.insert(), rows)
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+                # some were cached meanwhile by the workers
+                for row in rows:
+                    _insert(ses, PackageDigest(**row))
+
+        self._new.clear()
+        return len(rows)
+
+
+def find_attempt(fingerprint, get_digest, session=None):
+    """
+    Returns the attempt of a package identical to the one described
+    by ``fingerprint``, or None.
+
+    The fingerprint is checked first, so the digest is computed only
+    if it matches some attempt, or if it is missing.
+
+    ``fingerprint`` is the value of checkin.Xray.fingerprint.
+    ``get_digest`` is a callable that returns the package digest.
+    ``session`` is the session in use by the caller.
+    """
+    with session_scope(session) as ses:
+        if fingerprint is not None:
+            # attempts stored before fingerprints can only be
+            # compared by their digests
+            candidate = ses.query(Attempt.id).filter(or_(
+                Attempt.package_fingerprint == fingerprint,
+                Attempt.package_fingerprint == None)).first()
+            if candidate is None:
+                return None
+
+        return ses.query(Attempt).filter_by(
+            package_md5=get_digest()).first()
+
+
+def get_or_create(session, model, **kwargs):
+    """
+    Try get the model by ```kwargs``` otherwise create the model.
+
+    The lookup is a single query. Creation happens inside a savepoint,
+    so if a concurrent worker creates the same object first, the
+    constraint violation is caught and its object is returned instead.
+    Nothing is committed: ``session`` belongs to the caller.
+
+    ``session`` is the session in use by the caller.
+    ``model`` is a mapped class.
+    """
+    return get_or_create_with_status(session, model, **kwargs)[0]
+
+
+def get_or_create_with_status(session, model, **kwargs):
+    """
+    Like get_or_create, but returns a tuple with the object and a
+    boolean telling if it was created by this call.
+    """
+    obj = session.query(model).filter_by(**kwargs).first()
+    if obj is not None:
+        return obj, False
+
+    return _insert_or_get(session, model, **kwargs)
+
+
+def get_articlepkg_id(session, **kwargs):
+    """
+    Returns the id of the ArticlePkg matching ``kwargs``, creating it
+    if it doesn't exist. Ids of existing rows are kept at an LRU cache
+    keyed by ARTICLEPKG_KEY, so repeated lookups skip the database.
+
+    ``session`` is the session in use by the caller.
+    """
+    key = tuple(kwargs.get(field) for field in ARTICLEPKG_KEY)
+
+    articlepkg_id = articlepkg_ids.get(key)
+    if articlepkg_id is not None:
+        return articlepkg_id
+
+    article = session.query(ArticlePkg).filter_by(**kwargs).first()
+    if article is not None:
+        articlepkg_ids.set(key, article.id)
+        return article.id
+
+    # new rows are not cached until they are found again, as the
+    # transaction that creates them may be rolled back
+    article, _ = _insert_or_get(session, ArticlePkg, **kwargs)
+
+    return article.id
+
+
+def save_validations(session, attempt, results, started_at=None):
+    """
+    Stores ``results`` as the validations of ``attempt``, in a new
+    ValidationSet, and returns it. The validations are inserted at
+    once, without being loaded into the session. Nothing is committed.
+
+    ``session`` is the session in use by the caller.
+    ``attempt`` is a persistent Attempt instance.
+    ``results`` is a list of dicts with the label, status and
+    description of each validation.
+    ``started_at`` is when the validations started. Defaults to now.
+    """
+    now = datetime.datetime.now()
+    validationset = ValidationSet(attempt_id=attempt.id,
+                                  started_at=started_at or now,
+                                  finished_at=now)
+    session.add(validationset)
+    session.flush()
+
+    if results:
+        session.execute(Validation.__table__.insert(),
+                        [dict(result, validationset_id=validationset.id)
+                         for result in results])
+
+    return validationset
+
+
+def save_members(session, attempt, manifest):
+    """
+    Stores the manifest of the package of ``attempt``, inserting its
+    members at once. Nothing is committed.
+
+    ``session`` is the session in use by the caller.
+    ``attempt`` is a persistent Attempt instance.
+    ``manifest`` is a list of dicts with the name, extension, crc, size
+    and compressed_size of each member, as in checkin.Xray.manifest.
+    """
+    if manifest:
+        session.execute(PackageMember.__table__.insert(),
+                        [dict(member, attempt_id=attempt.id)
+                         for member in manifest])
+
+
+def find_members(session, extension=None, min_size=None):
+    """
+    Returns a query for the members of the attempted packages, largest
+    first, e.g. the tiff files over 50MB:
+
+        find_members(session, 'tiff', 50 * 1024 * 1024)
+
+    ``session`` is the session in use by the caller.
+    ``extension`` is the lowercase extension of the members.
+    ``min_size`` is the min uncompressed size in bytes of the members.
+    """
+    query = session.query(PackageMember)
+    if extension is not None:
+        query = query.filter(PackageMember.extension == extension.lower())
+    if min_size is not None:
+        query = query.filter(PackageMember.size >= min_size)
+
+    return query.order_by(PackageMember.size.desc())
+
+
+def get_latest_validations(session, **kwargs):
+    """
+    Returns a tuple with the manifest and the validation results of
+    the latest validated attempt of the ArticlePkg matching ``kwargs``,
+    or None. The manifest is a list of (name, CRC32, size) tuples and
+    the results a dict of label to (status, description).
+
+    Nothing is written, so it may be used before the attempt is saved.
+
+    ``session`` is the session in use by the caller.
+    """
+    key = tuple(kwargs.get(field) for field in ARTICLEPKG_KEY)
+
+    articlepkg_id = articlepkg_ids.get(key)
+    if articlepkg_id is None:
+        articlepkg_id = session.query(ArticlePkg.id).filter_by(**kwargs).scalar()
+        if articlepkg_id is None:
+            return None
+
+    validationset = session.query(ValidationSet).join(Attempt).filter(
+        Attempt.articlepkg_id == articlepkg_id).order_by(
+        ValidationSet.started_at.desc(), ValidationSet.id.desc()).first()
+    if validationset is None:
+        return None
+
+    members = session.query(PackageMember.name, PackageMember.crc,
+        PackageMember.size).filter_by(
+        attempt_id=validationset.attempt_id).all()
+    results = session.query(Validation.label, Validation.status,
+        Validation.description).filter_by(
+        validationset_id=validationset.id).all()
+
+    return ([tuple(member) for member in members],
+            dict((label, (status, description))
+                 for label, status, description in results))
+
+
+def get_package_digests():
+    """
+    Returns a set with the digests of all attempted packages.
+    """
+    with session_scope() as ses:
+        return set(digest for (digest,) in ses.query(Attempt.package_md5))
 
-if __name__ == '__main__':
-    import sys
 
+class BatchWriter(object):
+    """
+    Runs units of work against the database in batches, each batch
+    in a single transaction. A batch is written when ``max_size``
+    units are pending, or ``max_latency`` seconds after the oldest
+    one was added.
+
+    Each unit runs inside its own savepoint, so its failure does not
+    affect the others in the batch.
+    """
+    def __init__(self, max_size, max_latency, session_factory=None,
+                 clock=time.time):
+        """
+        ``max_size`` is the max number of units in a batch.
+        ``max_latency`` is the max number of seconds a unit waits to
+        be written.
+        ``session_factory`` is a callable that returns a new session.
+        ``clock`` is a callable that returns the current time.
+        """
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self._session_factory = session_factory or Session
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._pending = []
+        self._oldest = None
+
+    def add(self, work, callback=None):
+        """
+        Adds a unit of work to the current batch.
+
+        ``work`` is a callable that receives a session and returns the
+        stored object. It must not commit.
+        ``callback`` is called as ``callback(result, error)`` once the
+        batch is written. ``error`` is None on success.
+        """
+        with self._lock:
+            if not self._pending:
+                self._oldest = self._clock()
+            self._pending.append((work, callback))
+
+            if len(self._pending) >= self.max_size:
+                self.flush()
+
+    def is_due(self):
+        """
+        Tells if the oldest pending unit waits for ``max_latency``
+        seconds or more.
+        """
+        with self._lock:
+            return bool(self._pending and
+                self._clock() - self._oldest >= self.max_latency)
+
+    def flush(self):
+        """
+        Writes the pending units of work in a single transaction and
+        calls back each one. Returns a list of (result, error) pairs.
+        """
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._oldest = None
+
+            if not batch:
+                return []
+
+            results = []
+            ses = self._session_factory()
+            try:
+                for work, _ in batch:
+                    savepoint = ses.begin_nested()
+                    try:
+                        result = work(ses)
+                        savepoint.commit()
+                    except Exception, e:
+                        if savepoint.is_active:
+                            savepoint.rollback()
+                        results.append((None, e))
+                    else:
+                        results.append((result, None))
+
+                ses.commit()
+            except Exception, e:
+                ses.rollback()
+                results = [(None, e)] * len(batch)
+            finally:
+                ses.close()
+
+        for (_, callback), (result, error) in zip(batch, results):
+            if callback is not None:
+                callback(result, error)
+
+        return results
+
+    def run(self, stop_event, interval=None):
+        """
+        Writes the due batches until ``stop_event`` is set, then writes
+        what is left.
+
+        ``interval`` is the number of seconds between checks. Defaults
+        to half of ``max_latency``.
+        """
+        if interval is None:
+            interval = self.max_latency / 2.0
+
+        while not stop_event.is_set():
+            if self.is_due():
+                self.flush()
+            stop_event.wait(interval)
+
+        self.flush()
+
+
+def _merge_duplicate_articlepkgs(bind):
+    """
+    Merges the ArticlePkg rows that share the same ARTICLEPKG_KEY,
+    stored before it was unique, into the oldest one of each key, which
+    gets all their attempts. Returns the number of rows removed.
+
+    ``bind`` is an engine or connection.
+    """
+    articlepkg = ArticlePkg.__table__
+    attempt = Attempt.__table__
+    key = [articlepkg.c[name] for name in ARTICLEPKG_KEY]
+
+    duplicates = bind.execute(
+        select(key + [func.min(articlepkg.c.id)])
+        .group_by(*key)
+        .having(func.count(articlepkg.c.id) > 1)).fetchall()
+
+    removed = 0
+    for row in duplicates:
+        values, kept_id = tuple(row[:len(key)]), row[len(key)]
+        others = select([articlepkg.c.id]).where(and_(
+            articlepkg.c.id != kept_id,
+            *[column == value for column, value in zip(key, values)]))
+
+        bind.execute(attempt.update()
+                     .where(attempt.c.articlepkg_id.in_(others))
+                     .values(articlepkg_id=kept_id))
+        removed += bind.execute(articlepkg.delete()
+                                .where(articlepkg.c.id.in_(others))).rowcount
+
+    return removed
+
+
+def migrate(bind):
+    """
+    Upgrades the database structure in place, creating the missing
+    tables, columns and indexes. Existing data is kept, but duplicate
+    ArticlePkg rows, which would violate the unique index of their
+    natural key, are merged. Returns a list describing the changes.
+
+    All the changes are made in a single transaction, so a failed
+    migration leaves the database untouched where DDL is transactional,
+    e.g. PostgreSQL.
+
+    Columns added this way must be nullable or have a server default.
+
+    ``bind`` is an engine or connection.
+    """
+    if not isinstance(bind, Connection):
+        with bind.begin() as conn:
+            return migrate(conn)
+
+    with bind.begin():
+        return _migrate(bind)
+
+
+def _migrate(bind):
+    changes = []
+    inspector = inspect(bind)
+    tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            table.create(bind)
+            changes.append('created table %s' % table.name)
+            continue
+
+        columns = set(col['name'] for col in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                bind.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=bind.dialect)))
+                changes.append('added column %s.%s' % (table.name, column.name))
+
+        indexes = set(idx['name'] for idx in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                if table is ArticlePkg.__table__ and index.unique:
+                    merged = _merge_duplicate_articlepkgs(bind)
+                    if merged:
+                        changes.append('merged %s duplicate rows of %s' % (
+                            merged, table.name))
+                index.create(bind)
+                changes.append('created index %s' % index.name)
+
+    return changes
+
+
+if __name__ == '__main__':
     # Create the DB structure
     if 'syncdb' in sys.argv:
-        Base.metadata.create_all(engine)
+        Base.metadata.create_all(get_engine())
+
+    # Upgrade an existing DB structure
+    elif 'migrate' in sys.argv:
+        for change in migrate(get_engine()):
+            print change
@@ -1,32 +1,499 @@
 #coding: utf-8
+import os
 import sys
+import time
+import zlib
+import signal
+import argparse
+import threading
+import traceback
+import multiprocessing
+import Queue
+import functools
+import ConfigParser
+from collections import OrderedDict
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
+import bus
 import checkin
+import models
 import pyinotify
 
 import utils
+import validator
 
 
 config = utils.Configuration.from_env()
 
-mask = pyinotify.IN_CLOSE_WRITE
+mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+        pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+
+
+class EventCoalescer(object):
+    """
+    Merges the events of each pathname and releases it to ``queue``
+    only after ``quiet_period`` seconds without new events, so a
+    package written in many steps is checked in once.
+    """
+    def __init__(self, queue, quiet_period, clock=time.time):
+        """
+        ``queue`` is where the released pathnames are put.
+        ``quiet_period`` is the number of seconds without events
+        after which a pathname is released.
+        ``clock`` is a callable that returns the current time.
+        """
+        self.queue = queue
+        self.quiet_period = quiet_period
+        self._clock = clock
+        self._lock = threading.Lock()
+        # ordered by the time of the last event
+        self._pending = OrderedDict()
+
+        self.events = 0
+        self.suppressed = 0
+        self.released = 0
+
+    def touch(self, pathname):
+        """
+        Registers an event for ``pathname``.
+        """
+        with self._lock:
+            self.events += 1
+            if self._pending.pop(pathname, None) is not None:
+                self.suppressed += 1
+            self._pending[pathname] = self._clock()
+
+    def discard(self, pathname):
+        """
+        Forgets ``pathname``, e.g. when it is moved away or deleted.
+        """
+        with self._lock:
+            self._pending.pop(pathname, None)
+
+    def release(self, force=False):
+        """
+        Puts into the queue the pathnames that are quiet for at least
+        ``quiet_period`` seconds, or all of them if ``force`` is True.
+        Returns the number of released pathnames.
+        """
+        ready = []
+        with self._lock:
+            deadline = self._clock() - self.quiet_period
+            for pathname, last_seen in self._pending.iteritems():
+                if not force and last_seen > deadline:
+                    break
+                ready.append(pathname)
+
+            for pathname in ready:
+                del self._pending[pathname]
+            self.released += len(ready)
+
+        for pathname in ready:
+            self.queue.put(pathname)
+
+        return len(ready)
+
+    def run(self, stop_event, interval=0.5):
+        """
+        Releases the quiet pathnames every ``interval`` seconds,
+        until ``stop_event`` is set.
+        """
+        while not stop_event.is_set():
+            self.release()
+            stop_event.wait(interval)
+
+        self.release(force=True)
+
+    def stats(self):
+        return {'events': self.events,
+                'suppressed': self.suppressed,
+                'released': self.released,
+                'pending': len(self._pending)}
+
+
+def parse_shard(value):
+    """
+    Parses a shard in the form ``index/count``, e.g. ``0/4``, into an
+    (index, count) tuple.
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected index/count, got %r' % value)
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('index must be in [0, %s)' % count)
+
+    return index, count
+
+
+def owns(pathname, shard):
+    """
+    Tells if ``pathname`` belongs to ``shard``, an (index, count) tuple
+    or None for all pathnames. A stable hash is used, so the monitors
+    sharing the watch paths agree on the owner of each package.
+    """
+    if shard is None:
+        return True
+
+    index, count = shard
+    return (zlib.crc32(pathname) & 0xffffffff) % count == index
+
+
+def get_exclude_filter(settings):
+    """
+    Returns a pyinotify.ExcludeFilter with the regexes listed, comma
+    separated, at ``[monitor] exclude_lst``. They are matched against
+    the pathnames of the packages and of the watched directories.
+    """
+    try:
+        value = settings.get('monitor', 'exclude_lst')
+    except ConfigParser.NoOptionError:
+        value = ''
+
+    return pyinotify.ExcludeFilter([regex for regex in value.split(',')
+                                    if regex])
+
+
+def is_ignored(pathname, exclude=None):
+    """
+    Tells if ``pathname`` must not be checked in, either because it was
+    marked as failed or because it is matched by ``exclude``, a
+    pyinotify.ExcludeFilter.
+    """
+    # packages marked as failed are renamed in place
+    if os.path.basename(pathname).startswith(utils.FAILED_PREFIX):
+        return True
+
+    return exclude is not None and exclude(pathname)
 
 
 class EventHandler(pyinotify.ProcessEvent):
 
+    def my_init(self, coalescer=None, shard=None, exclude=None):
+        """
+        ``coalescer`` is an EventCoalescer instance, that receives the
+        pathnames of the written packages.
+        ``shard`` is the (index, count) of the pathnames handled by
+        this monitor, or None for all of them.
+        ``exclude`` is a pyinotify.ExcludeFilter of the pathnames that
+        are not packages.
+        """
+        self.coalescer = coalescer
+        self.shard = shard
+        self.exclude = exclude
+
+    def _touch(self, pathname):
+        if is_ignored(pathname, self.exclude):
+            return
+
+        if owns(pathname, self.shard):
+            self.coalescer.touch(pathname)
+
     def process_IN_CLOSE_WRITE(self, event):
-        attempt = checkin.get_attempt(event.pathname)
-        utils.send_message(sys.stdout, attempt, utils.make_digest)
+        self._touch(event.pathname)
+
+    def process_IN_MOVED_TO(self, event):
+        self._touch(event.pathname)
+
+    def process_IN_MOVED_FROM(self, event):
+        self.coalescer.discard(event.pathname)
+
+    def process_IN_DELETE(self, event):
+        self.coalescer.discard(event.pathname)
+
+
+def _listdir_entries(path):
+    """
+    Poor man's replacement for scandir, yielding (name, pathname, is_dir)
+    tuples.
+    """
+    for name in os.listdir(path):
+        pathname = os.path.join(path, name)
+        yield name, pathname, os.path.isdir(pathname)
+
+
+def _scandir_entries(path):
+    for entry in scandir(path):
+        yield entry.name, entry.path, entry.is_dir()
+
+
+def scan_packages(path, recursive=False):
+    """
+    Yields the pathnames of the files found under ``path``, except
+    those marked as failed.
+
+    ``path`` is the directory to be scanned.
+    ``recursive`` tells if subdirectories must be scanned too.
+    """
+    list_entries = _scandir_entries if scandir else _listdir_entries
+    dirs = [path]
+
+    while dirs:
+        for name, pathname, is_dir in list_entries(dirs.pop()):
+            if is_dir:
+                if recursive:
+                    dirs.append(pathname)
+            elif not name.startswith(utils.FAILED_PREFIX):
+                yield pathname
+
+
+def reconcile(paths, coalescer, recursive=False, known_digests=None,
+              digest=None, shard=None, exclude=None):
+    """
+    Feeds ``coalescer`` with the packages found under ``paths`` that
+    were not attempted yet, e.g. those that arrived while the monitor
+    was down. Returns the number of packages fed.
+
+    ``paths`` is a list of directories.
+    ``coalescer`` is an EventCoalescer instance.
+    ``known_digests`` is a set with the digests of the attempted
+    packages. Defaults to the ones stored at the database.
+    ``digest`` is a callable that returns the digest of a package.
+    Defaults to a models.DigestCache loaded at once, whose new digests
+    are stored in a single transaction at the end of the scan.
+    ``shard`` is the (index, count) of the packages handled by this
+    monitor, or None for all of them.
+    ``exclude`` is a pyinotify.ExcludeFilter of the pathnames that
+    are not packages.
+
+    Packages that can't be read are reported to stderr and skipped, so
+    the others are still fed.
+    """
+    if known_digests is None:
+        known_digests = models.get_package_digests()
+
+    cache = None
+    if digest is None and known_digests:
+        cache = models.DigestCache.load()
+        digest = cache.get
+
+    count = 0
+    try:
+        for path in paths:
+            for pathname in scan_packages(path, recursive=recursive):
+                if is_ignored(pathname, exclude) or not owns(pathname, shard):
+                    continue
+
+                # the package may be removed or replaced meanwhile
+                try:
+                    if known_digests and digest(pathname) in known_digests:
+                        continue
+                except EnvironmentError, e:
+                    sys.stderr.write('Error while reconciling %s: %s\n' % (
+                        pathname, e))
+                    continue
+
+                coalescer.touch(pathname)
+                count += 1
+    finally:
+        if cache is not None:
+            cache.flush()
+
+    return count
+
+
+def checkin_package(pathname):
+    """
+    Runs checkin.inspect_package for ``pathname`` inside a worker
+    process.
+
+    Errors are written to stderr instead of being raised, so the
+    worker and the dispatcher are kept alive.
+    """
+    try:
+        return checkin.inspect_package(pathname)
+    except Exception:
+        sys.stderr.write('Error while checking in %s:\n%s\n' % (
+            pathname, traceback.format_exc()))
+
+
+signer = utils.Signer()
+
+
+def send_attempt(attempt, stream=None):
+    """
+    Sends ``attempt`` through ``stream``, a bus.Publisher or a pipe.
+    Defaults to stdout.
+    """
+    if attempt is not None:
+        utils.send_frame(stream or sys.stdout, attempt, signer)
+
+
+def _attempt_saved(attempt, error, stream=None):
+    if error is not None:
+        sys.stderr.write('Error while saving attempt: %r\n' % error)
+    else:
+        send_attempt(attempt, stream)
+
+
+def save_attempt(writer, inspection, callback=_attempt_saved):
+    """
+    Adds the attempt described by ``inspection`` to the current
+    batch of ``writer``. ``callback`` is called once it is written.
+
+    ``writer`` is a models.BatchWriter instance.
+    ``inspection`` is the value returned by checkin.inspect_package.
+    """
+    if inspection is not None:
+        writer.add(functools.partial(checkin.save_attempt,
+                                     inspection=inspection),
+                   callback)
+
+
+def dispatch(queue, pool, max_pending, callback):
+    """
+    Consumes pathnames from ``queue`` and checks them in using ``pool``,
+    until None is got.
+
+    ``queue`` is a Queue.Queue instance.
+    ``pool`` is a multiprocessing.Pool instance.
+    ``max_pending`` is the max number of packages submitted to ``pool``
+    and not yet finished. When reached, ``queue`` is not consumed.
+    ``callback`` is called with the result of each check-in.
+    """
+    pending = threading.BoundedSemaphore(max_pending)
+
+    def _done(result):
+        try:
+            callback(result)
+        finally:
+            pending.release()
+
+    while True:
+        pathname = queue.get()
+        if pathname is None:
+            break
+
+        pending.acquire()
+        pool.apply_async(checkin_package, (pathname,), callback=_done)
+
+
+def _interrupt(signum, frame):
+    # once, so the shutdown itself is not interrupted
+    signal.signal(signum, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
+def init_worker():
+    """
+    Runs at the start of each worker process. Signals sent to the
+    process group are ignored, so the tasks in progress are finished
+    while the monitor shuts down.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_workers_count(settings):
+    """
+    Returns the number of worker processes set at ``[monitor] workers``,
+    defaulting to the number of cpus.
+    """
+    try:
+        workers = settings.getint('monitor', 'workers')
+    except (ValueError, ConfigParser.NoOptionError):
+        workers = 0
+
+    return workers or multiprocessing.cpu_count()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=u'Balaio monitor')
+    parser.add_argument('--watch-path', action='append', dest='watch_paths',
+        help='overrides [monitor] watch_path. May be repeated')
+    parser.add_argument('--shard', type=parse_shard,
+        help='handles only the packages of shard index/count')
+    parser.add_argument('--workers', type=int,
+        help='overrides [monitor] workers')
+    parser.add_argument('--bus-path',
+        help='overrides [monitor] bus_path')
+
+    args = parser.parse_args()
+
+    workers = args.workers or get_workers_count(config)
+    queue = Queue.Queue(maxsize=config.getint('monitor', 'queue_size'))
+
+    # compiled once, and inherited by the workers
+    if config.getboolean('app', 'prewarm_schemas'):
+        validator.schemas.warm()
+    pool = multiprocessing.Pool(workers, init_worker)
+
+    # the supervisor stops its monitors with SIGTERM. Installed after
+    # the workers are forked, so they do not inherit it.
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    # attempts are published at a unix socket, or written to stdout.
+    # The publisher is started after the workers are forked.
+    bus_path = args.bus_path or config.get('monitor', 'bus_path')
+    output = bus.Publisher.from_settings(bus_path, config) if bus_path else None
+
+    writer = models.BatchWriter(config.getint('app', 'batch_size'),
+                                config.getfloat('app', 'batch_latency'))
+    stop_writer = threading.Event()
+    writer_thread = threading.Thread(target=writer.run, args=(stop_writer,))
+    writer_thread.daemon = True
+    writer_thread.start()
+
+    dispatcher = threading.Thread(target=dispatch,
+        args=(queue, pool, workers * 2,
+              functools.partial(save_attempt, writer,
+                  callback=functools.partial(_attempt_saved, stream=output))))
+    dispatcher.daemon = True
+    dispatcher.start()
+
+    coalescer = EventCoalescer(queue,
+                               config.getfloat('monitor', 'quiet_period'))
+    stop_coalescer = threading.Event()
+    coalescer_thread = threading.Thread(target=coalescer.run,
+                                        args=(stop_coalescer,))
+    coalescer_thread.daemon = True
+    coalescer_thread.start()
+
+    exclude = get_exclude_filter(config)
     wm = pyinotify.WatchManager()
-    handler = EventHandler()
+    handler = EventHandler(coalescer=coalescer, shard=args.shard,
+                           exclude=exclude)
     notifier = pyinotify.Notifier(wm, handler)
 
-    wm.add_watch(config.get('monitor', 'watch_path').split(','),
+    watch_paths = args.watch_paths or [path for path in
+        config.get('monitor', 'watch_path').split(',') if path]
+    recursive = config.getboolean('monitor', 'recursive')
+
+    wm.add_watch(watch_paths,
                  mask,
-                 rec=config.get('monitor', 'recursive'),
-                 auto_add=config.get('monitor', 'recursive'))
+                 rec=recursive,
+                 auto_add=recursive,
+                 exclude_filter=exclude)
+
+    # packages that arrived while the monitor was down. The watches are
+    # added beforehand so nothing is lost between the scan and the loop.
+    scanner = threading.Thread(target=reconcile,
+                               args=(watch_paths, coalescer, recursive),
+                               kwargs={'shard': args.shard,
+                                       'exclude': exclude})
+    scanner.daemon = True
+    scanner.start()
+
+    try:
+        notifier.loop(pid_file=config.get('monitor', 'pid_file'))
+    finally:
+        stop_coalescer.set()
+        coalescer_thread.join()
+        queue.put(None)
+        dispatcher.join()
+        pool.close()
+        pool.join()
+        stop_writer.set()
+        writer_thread.join()
+        if output is not None:
+            output.close()
 
-    notifier.loop(pid_file=config.get('monitor', 'pid_file'))
+        sys.stderr.write('Events: %(events)s, suppressed: %(suppressed)s, '
+                         'released: %(released)s\n' % coalescer.stats())
@@ -2,8 +2,23 @@
 import ConfigParser
 import urllib2
 import urllib
+import httplib
+import socket
+import threading
+import Queue
+import json
+import uuid
+import errno
+import signal
+import random
+import argparse
+import datetime
+import sys
+import zlib
+from StringIO import StringIO
 
 from .utils import SingletonMixin, Configuration
+from . import models
 
 
 config = Configuration.from_env()
@@ -13,6 +28,9 @@ CHECKIN_MESSAGE_FIELDS = ('checkin_id', 'collection_uri', 'article_title',
     'journal_title', 'issue_label', 'pkgmeta_filename', 'pkgmeta_md5',
     'pkgmeta_filesize', 'pkgmeta_filecount', 'pkgmeta_submitter')
 
+# endpoints that accept many messages per request, at <endpoint>/bulk/
+BULK_ENDPOINTS = ('articlepkg_checkins',)
+
 
 def _extract_settings(settings):
     """
@@ -33,6 +51,211 @@ def _extract_settings(settings):
     return (url, api_username, api_key)
 
 
+def _extract_options(settings, options):
+    """
+    Returns a tuple with the values of ``options`` at the ``[manager]``
+    section of ``settings``, converted to the type of their defaults.
+    Missing options get default values.
+
+    ``options`` is a sequence of (option, default) pairs.
+    """
+    values = []
+    for option, default in options:
+        try:
+            value = settings.get('manager', option)
+        except (ConfigParser.NoSectionError,
+                ConfigParser.NoOptionError):
+            value = None
+
+        if not value:
+            value = default
+        elif isinstance(default, bool):
+            value = value.lower() in ('1', 'yes', 'true', 'on')
+        else:
+            value = type(default)(value)
+
+        values.append(value)
+
+    return tuple(values)
+
+
+def _extract_pool_settings(settings):
+    """
+    Returns a tuple with max connections per host, connect timeout
+    and read timeout values.
+    """
+    return _extract_options(settings, [('max_connections', 4),
+                                       ('connect_timeout', 5.0),
+                                       ('read_timeout', 30.0)])
+
+
+class Response(object):
+    """
+    An HTTP response whose body was fully read.
+    """
+    def __init__(self, code, msg, headers, body):
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+def _is_stale(error):
+    """
+    Tells if ``error``, raised while waiting for a response, means the
+    idle connection was closed by the server before the request was
+    read. Timeouts do not, as the request may have been processed.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return (isinstance(error, socket.error) and
+            error.args[0] in (errno.ECONNRESET, errno.EPIPE))
+
+
+class ConnectionPool(object):
+    """
+    Keeps persistent connections to a single host, with at most
+    ``maxsize`` of them in use at a time.
+    """
+    def __init__(self, host, maxsize, connect_timeout, read_timeout,
+                 connection_dep=httplib.HTTPConnection):
+        """
+        ``host`` is a ``host[:port]`` string.
+        ``maxsize`` is the max number of connections to the host.
+        ``connect_timeout`` and ``read_timeout`` are in seconds.
+        ``connection_dep`` is the httplib connection class.
+        """
+        self.host = host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._connection = connection_dep
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def _new_connection(self):
+        conn = self._connection(self.host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _get_connection(self):
+        """
+        Returns a tuple with a connection and a boolean telling if
+        it was reused.
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            return self._new_connection(), False
+
+    def urlopen(self, method, selector, body=None, headers=None):
+        """
+        Sends a request and returns a Response. The response body is
+        always read, so the connection can be reused.
+
+        Requests that failed on idle connections closed by the server
+        are sent again on another connection. Timeouts are never
+        retried, as the server may have processed the request.
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                conn, reused = self._get_connection()
+                try:
+                    conn.request(method, selector, body, headers or {})
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused and not isinstance(e, socket.timeout):
+                        continue
+                    raise
+
+                try:
+                    resp = conn.getresponse()
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused and _is_stale(e):
+                        continue
+                    raise
+
+                try:
+                    data = resp.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    raise
+
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._idle.put(conn)
+
+                return Response(resp.status, resp.reason,
+                                resp.getheaders(), data)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class PoolManager(object):
+    """
+    Hands out a ConnectionPool per scheme and host.
+    """
+    connection_classes = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+
+    def __init__(self, maxsize, connect_timeout, read_timeout):
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host):
+        with self._lock:
+            try:
+                return self._pools[(scheme, host)]
+            except KeyError:
+                pool = ConnectionPool(host, self.maxsize,
+                                      self.connect_timeout,
+                                      self.read_timeout,
+                                      self.connection_classes[scheme])
+                self._pools[(scheme, host)] = pool
+                return pool
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+
+_pool_manager = None
+_pool_manager_lock = threading.Lock()
+
+
+def get_pool_manager(settings=config):
+    """
+    Returns the PoolManager shared by all Request instances, set up
+    by the ``[manager]`` section of ``settings`` on the first call.
+    """
+    global _pool_manager
+
+    with _pool_manager_lock:
+        if _pool_manager is None:
+            _pool_manager = PoolManager(*_extract_pool_settings(settings))
+
+        return _pool_manager
+
+
 class Request(SingletonMixin):
 
     def __init__(self,
@@ -40,14 +263,18 @@ class Request(SingletonMixin):
                  api_username,
                  api_key,
                  urlencode_dep=urllib.urlencode,
-                 urllib_dep=urllib2):
+                 urllib_dep=urllib2,
+                 pool_manager_dep=None):
         """
         ``url``
         ``api_username``
         ``api_key``
+        ``pool_manager_dep`` is the PoolManager that holds the
+        connections. Defaults to the shared one.
         """
         self._urlencode = urlencode_dep
         self._urllib2 = urllib_dep
+        self._pool_manager = pool_manager_dep
 
         self.url = url
         self.username = api_username
@@ -62,33 +289,357 @@ class Request(SingletonMixin):
         return request
 
     def _prepare_data(self, data):
-        return self._urlencode(data)
+        """
+        Urlencodes ``data``, a dict. Unicode values, such as the ones
+        loaded from json payloads, are encoded to utf-8 first, as
+        urlencode only handles ascii.
+        """
+        return self._urlencode(dict(
+            (key, value.encode('utf-8') if isinstance(value, unicode) else value)
+            for key, value in data.items()))
+
+    def _send(self, req, content_type):
+        """
+        Sends ``req`` through a persistent connection. HTTP errors
+        are raised as urllib2.HTTPError.
+        """
+        pool_manager = self._pool_manager or get_pool_manager()
+        pool = pool_manager.get(req.get_type(), req.get_host())
+
+        headers = dict(req.header_items())
+        headers['Content-Type'] = content_type
+
+        resp = pool.urlopen(req.get_method(), req.get_selector(),
+                            req.get_data(), headers)
+        if resp.code >= 400:
+            raise self._urllib2.HTTPError(req.get_full_url(), resp.code,
+                resp.msg, resp.headers, StringIO(resp.body))
+
+        return resp
 
     def post(self, data):
         """
-        Assembles an HTTP POST and returns a file-object.
+        Assembles an HTTP POST and returns a Response, whose body was
+        already read.
 
         ``data`` is a mapping.
         """
         req = self._new_http_request()
         req.add_data(self._prepare_data(data))
 
-        return self._urllib2.urlopen(req)
+        return self._send(req, 'application/x-www-form-urlencoded')
+
+    def post_json(self, data, compress=False):
+        """
+        Assembles an HTTP POST with ``data`` as compact json, and
+        returns a Response, whose body was already read.
+
+        ``data`` is a json-serializable object.
+        ``compress`` tells if the body is gzip-compressed.
+        """
+        body = json.dumps(data, separators=(',', ':'))
+
+        req = self._new_http_request()
+        if compress:
+            gzipper = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = gzipper.compress(body) + gzipper.flush()
+            req.add_header('Content-Encoding', 'gzip')
+        req.add_data(body)
+
+        return self._send(req, 'application/json')
+
+
+class Outbox(object):
+    """
+    A durable queue of notifications, stored at models.Notification,
+    so they survive restarts and Manager outages.
+    """
+    def __init__(self, clock=datetime.datetime.now):
+        """
+        ``clock`` is a callable that returns the current datetime.
+        """
+        self._clock = clock
+
+    def put(self, endpoint, message, session=None):
+        """
+        Stores a notification to be delivered to ``endpoint``.
+
+        ``message`` is a json-serializable mapping.
+        ``session`` is the session in use by the caller, so the
+        notification is committed along with what it notifies.
+        """
+        now = self._clock()
+        with models.session_scope(session) as ses:
+            ses.add(models.Notification(endpoint=endpoint,
+                                        payload=json.dumps(message),
+                                        created_at=now,
+                                        next_attempt_at=now))
+
+    def due(self, limit):
+        """
+        Returns up to ``limit`` undelivered notifications whose next
+        try is due, the oldest first.
+        """
+        with models.session_scope() as ses:
+            return ses.query(models.Notification).filter(
+                models.Notification.delivered_at == None,
+                models.Notification.next_attempt_at <= self._clock(),
+            ).order_by(models.Notification.next_attempt_at,
+                       models.Notification.id).limit(limit).all()
+
+    def claim(self, notifications, lease):
+        """
+        Claims ``notifications`` for ``lease`` seconds, postponing their
+        next try so they are not due to other senders meanwhile. The
+        ones neither delivered nor failed when the lease expires, e.g.
+        because their sender died, are due again.
+
+        Returns the notifications actually claimed, as some may have
+        been claimed by other senders since they were read.
+        """
+        if not notifications:
+            return []
+
+        token = uuid.uuid4().hex
+        now = self._clock()
+        ids = [notification.id for notification in notifications]
+        with models.session_scope() as ses:
+            ses.query(models.Notification).filter(
+                models.Notification.id.in_(ids),
+                models.Notification.delivered_at == None,
+                models.Notification.next_attempt_at <= now,
+            ).update({'claimed_by': token,
+                      'next_attempt_at': now +
+                          datetime.timedelta(seconds=lease)},
+                     synchronize_session=False)
+
+        with models.session_scope() as ses:
+            claimed = set(id for (id,) in ses.query(models.Notification.id)
+                .filter(models.Notification.id.in_(ids),
+                        models.Notification.claimed_by == token))
+
+        return [notification for notification in notifications
+                if notification.id in claimed]
+
+    def delivered(self, notification_ids):
+        """
+        Marks the given notifications as delivered, at once.
+        """
+        if not notification_ids:
+            return
+
+        with models.session_scope() as ses:
+            ses.query(models.Notification).filter(
+                models.Notification.id.in_(notification_ids)
+            ).update({'delivered_at': self._clock()},
+                     synchronize_session=False)
+
+    def failed(self, notification_id, error, delay):
+        """
+        Records a failed try, scheduling the next one ``delay``
+        seconds from now.
+        """
+        with models.session_scope() as ses:
+            ses.query(models.Notification).filter_by(
+                id=notification_id
+            ).update({'attempts': models.Notification.attempts + 1,
+                      'last_error': error,
+                      'next_attempt_at': self._clock() +
+                          datetime.timedelta(seconds=delay)},
+                     synchronize_session=False)
+
+    def now(self):
+        return self._clock()
+
+    def pending_count(self):
+        with models.session_scope() as ses:
+            return ses.query(models.Notification).filter_by(
+                delivered_at=None).count()
+
+
+def _extract_outbox_settings(settings):
+    """
+    Returns a tuple with batch size, retry delay, max retry delay,
+    bulk max size, bulk max latency, bulk gzip and lease values.
+    """
+    return _extract_options(settings, [('outbox_batch_size', 50),
+                                       ('outbox_retry_delay', 1.0),
+                                       ('outbox_max_retry_delay', 300.0),
+                                       ('bulk_max_size', 1),
+                                       ('bulk_max_latency', 0.0),
+                                       ('bulk_gzip', False),
+                                       ('outbox_lease', 300.0)])
+
+
+class OutboxSender(object):
+    """
+    Delivers the notifications stored at an Outbox in batches, on the
+    background. Failed ones are retried with exponential backoff and
+    full jitter.
+
+    Notifications to BULK_ENDPOINTS are sent many per request when
+    ``bulk_max_size`` is greater than 1.
+
+    Many senders may share an outbox, as each notification is claimed
+    by a single sender before being sent.
+    """
+    def __init__(self, notifier, outbox, batch_size, retry_delay,
+                 max_retry_delay, bulk_max_size=1, bulk_max_latency=0,
+                 bulk_gzip=False, lease=300, random_dep=random.random):
+        """
+        ``notifier`` is the Notifier that delivers the notifications.
+        ``outbox`` is an Outbox instance.
+        ``batch_size`` is the max number of notifications read at once.
+        ``retry_delay`` is the base delay in seconds between tries.
+        ``max_retry_delay`` caps the delay between tries.
+        ``bulk_max_size`` is the max number of messages per bulk request.
+        ``bulk_max_latency`` is the max number of seconds a notification
+        waits for a bulk request to be filled.
+        ``bulk_gzip`` tells if bulk requests are gzip-compressed.
+        ``lease`` is the max number of seconds a batch takes to be
+        sent. Then its notifications are due to other senders.
+        ``random_dep`` returns a random float in [0, 1).
+        """
+        self._notifier = notifier
+        self._outbox = outbox
+        self.batch_size = max(batch_size, bulk_max_size)
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.bulk_max_size = bulk_max_size
+        self.bulk_max_latency = bulk_max_latency
+        self.bulk_gzip = bulk_gzip
+        self.lease = lease
+        self._random = random_dep
+
+    @classmethod
+    def from_settings(cls, notifier, settings=config, outbox=None):
+        return cls(notifier, outbox or Outbox(),
+                   *_extract_outbox_settings(settings))
+
+    @property
+    def is_bulk(self):
+        return self.bulk_max_size > 1
+
+    def backoff(self, attempts):
+        """
+        Returns the delay in seconds before the next try, after
+        ``attempts`` failed ones.
+        """
+        ceiling = min(self.max_retry_delay, self.retry_delay * 2 ** attempts)
+        return ceiling * self._random()
+
+    def _must_wait(self, notifications):
+        """
+        Tells if a partial bulk request should wait for more
+        notifications, as its oldest one is younger than
+        ``bulk_max_latency``.
+        """
+        if not self.is_bulk or len(notifications) >= self.bulk_max_size:
+            return False
+
+        bulk = [ntf for ntf in notifications if ntf.endpoint in BULK_ENDPOINTS]
+        if len(bulk) != len(notifications) or not bulk:
+            return False
+
+        age = self._outbox.now() - min(ntf.created_at for ntf in bulk)
+        return age < datetime.timedelta(seconds=self.bulk_max_latency)
+
+    def _send_bulk(self, endpoint, notifications):
+        """
+        Returns a list with the error of each notification, or None.
+        """
+        messages = [json.loads(ntf.payload) for ntf in notifications]
+        try:
+            return self._notifier._submit_bulk(endpoint, messages,
+                                               compress=self.bulk_gzip)
+        except Exception, e:
+            return [repr(e)] * len(notifications)
+
+    def _send_single(self, notification):
+        try:
+            self._notifier._submit(notification.endpoint,
+                                   json.loads(notification.payload))
+        except Exception, e:
+            return repr(e)
+
+    def send_batch(self):
+        """
+        Delivers a batch of due notifications. Returns a tuple with
+        the number of delivered and failed ones.
+        """
+        notifications = self._outbox.due(self.batch_size)
+        if self._must_wait(notifications):
+            return 0, 0
+
+        notifications = self._outbox.claim(notifications, self.lease)
+
+        results = []
+        bulks = {}
+        for notification in notifications:
+            if self.is_bulk and notification.endpoint in BULK_ENDPOINTS:
+                bulks.setdefault(notification.endpoint, []).append(notification)
+            else:
+                results.append((notification, self._send_single(notification)))
+
+        for endpoint, bulk in bulks.items():
+            for i in range(0, len(bulk), self.bulk_max_size):
+                chunk = bulk[i:i + self.bulk_max_size]
+                results.extend(zip(chunk, self._send_bulk(endpoint, chunk)))
+
+        delivered = []
+        for notification, error in results:
+            if error is None:
+                delivered.append(notification.id)
+            else:
+                self._outbox.failed(notification.id, error,
+                                    self.backoff(notification.attempts))
+
+        self._outbox.delivered(delivered)
+        return len(delivered), len(results) - len(delivered)
+
+    def run(self, stop_event, interval=None):
+        """
+        Delivers the due notifications until ``stop_event`` is set.
+        Full batches are followed by the next one right away.
+
+        ``interval`` is the number of seconds to wait when there is
+        nothing to deliver. Defaults to 1, or less if bulk requests
+        must be sent sooner.
+        """
+        if interval is None:
+            interval = 1.0
+            if self.is_bulk and self.bulk_max_latency:
+                interval = min(interval, self.bulk_max_latency / 2.0)
+
+        while not stop_event.is_set():
+            try:
+                delivered, failed = self.send_batch()
+            except Exception, e:
+                sys.stderr.write('Error while sending notifications: %r\n' % e)
+                delivered = failed = 0
+
+            if delivered + failed < self.batch_size:
+                stop_event.wait(interval)
 
 
 class Notifier(SingletonMixin):
 
-    def __init__(self, settings=config, request_dep=Request):
+    def __init__(self, settings=config, request_dep=Request, outbox_dep=None):
         """
         ``settings`` is an instance of ConfigParser.ConfigParser.
+        ``outbox_dep`` is where notifications are stored before being
+        delivered by an OutboxSender. Defaults to a new Outbox.
         """
-        assert isinstance(request_dep, Request)
+        assert callable(request_dep)
 
         self._request = request_dep
+        self._outbox = outbox_dep or Outbox()
         self._url, self._username, self._apikey = _extract_settings(settings)
 
     def _prepare_url(self, endpoint):
-        return '%s/%s/' % (self._url, endpoint)
+        # endpoints read from the outbox are unicode, and httplib fails
+        # to join a unicode request line to a binary body
+        return str('%s/%s/' % (self._url, endpoint))
 
     def _submit(self, endpoint, data):
         """
@@ -104,17 +655,42 @@ class Notifier(SingletonMixin):
         req = self._request(full_url, self._username, self._apikey)
         req.post(data)
 
-    def checkin(self, message):
+    def _submit_bulk(self, endpoint, messages, compress=False):
+        """
+        Submits many messages to the bulk version of the given
+        endpoint, in a single json-encoded request. Returns a list
+        with the error of each message, or None if it was accepted.
+
+        ``endpoint`` is one of BULK_ENDPOINTS.
+        ``messages`` is a list of mappings.
+        ``compress`` tells if the request body is gzip-compressed.
+        """
+        full_url = self._prepare_url(endpoint + '/bulk')
+        req = self._request(full_url, self._username, self._apikey)
+        resp = req.post_json({'objects': messages}, compress=compress)
+
+        results = json.loads(resp.read())['objects']
+        if len(results) != len(messages):
+            raise ValueError('expected %s results, got %s' % (
+                len(messages), len(results)))
+
+        return [None if result.get('status') == 'created'
+                else result.get('message', 'unknown error')
+                for result in results]
+
+    def checkin(self, message, session=None):
         """
-        Sends a checkin notification event to a remote endpoint.
+        Queues a checkin notification event to a remote endpoint. It
+        is delivered by an OutboxSender.
 
         ``message`` is a mapping with the fields listed at
         CHECKIN_MESSAGE_FIELDS.
+        ``session`` is the session in use by the caller.
         """
         if not validate_notification_message(message, CHECKIN_MESSAGE_FIELDS):
             raise ValueError('invalid message')
 
-        self._submit('articlepkg_checkins', message)
+        self._outbox.put('articlepkg_checkins', message, session=session)
 
     def validation_event(self, message):
         """
@@ -135,3 +711,23 @@ def validate_notification_message(message, fields):
     msg_fields_set = set(message.keys())
 
     return fields_set == msg_fields_set
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=u'Delivers the notifications stored at the outbox')
+    parser.parse_args()
+
+    stop_event = threading.Event()
+    def _stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    sender = OutboxSender.from_settings(Notifier())
+    try:
+        sender.run(stop_event)
+    finally:
+        get_pool_manager().close()
+        sys.stderr.write('Pending notifications: %s\n' %
+                         sender._outbox.pending_count())
@@ -1,11 +1,40 @@
 # coding: utf-8
+import io
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import zipfile
+import unittest
 import ConfigParser
+import Queue
+import threading
+import time
+import errno
+import signal
+import socket
+import httplib
+import struct
+import zlib
+import BaseHTTPServer
+import SocketServer
 from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 import mocker
-
+import pyinotify
+
+import balaio
+import bus
+import checkin
+import fakemanager
+import integrity
+import models
+import monitor
 import notifier
 import utils
+import validator
 
 
 class ExtractSettingsFunctionTests(mocker.MockerTestCase):
@@ -306,6 +335,84 @@ class MakeDigestFunctionTests(mocker.MockerTestCase):
         )
 
 
+class MakeDigestAndSizeFunctionTests(mocker.MockerTestCase):
+
+    def test_same_digest_as_make_digest(self):
+        self.assertEqual(
+            utils.make_digest_and_size(StringIO('Some content'))[0],
+            utils.make_digest('Some content'))
+
+    def test_size(self):
+        self.assertEqual(
+            utils.make_digest_and_size(StringIO('Some content'))[1],
+            len('Some content'))
+
+    def test_readinto_and_small_buffers(self):
+        fp = io.BytesIO('Some content')
+
+        self.assertEqual(
+            utils.make_digest_and_size(fp, bufsize=5),
+            (utils.make_digest('Some content'), len('Some content')))
+
+
+class GetExtensionFunctionTests(mocker.MockerTestCase):
+
+    def test_extensions_are_lowercase(self):
+        self.assertEqual(utils.get_extension('img/A-GF01.TIF'), 'tif')
+
+    def test_names_without_extension(self):
+        self.assertIsNone(utils.get_extension('README'))
+        self.assertIsNone(utils.get_extension('img.d/README'))
+        self.assertIsNone(utils.get_extension('img/'))
+
+
+class LRUCacheTests(mocker.MockerTestCase):
+
+    def test_missing_keys(self):
+        cache = utils.LRUCache(2)
+
+        self.assertIsNone(cache.get('foo'))
+        self.assertEqual(cache.get('foo', 'bar'), 'bar')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_hits(self):
+        cache = utils.LRUCache(2)
+        cache.set('foo', 1)
+
+        self.assertEqual(cache.get('foo'), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_least_recently_used_keys_are_evicted(self):
+        cache = utils.LRUCache(2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+
+        self.assertIsNone(cache.get('bar'))
+        self.assertEqual(cache.get('foo'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache = utils.LRUCache(2)
+        cache.set('foo', 1)
+        cache.invalidate('foo')
+        cache.invalidate('missing')
+
+        self.assertIsNone(cache.get('foo'))
+
+    def test_invalidate_value(self):
+        cache = utils.LRUCache(3)
+        cache.set('foo', 1)
+        cache.set('bar', 1)
+        cache.set('baz', 2)
+        cache.invalidate_value(1)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('baz'), 2)
+
+
 class SendMessageFunctionTests(mocker.MockerTestCase):
 
     def test_stream_is_flushed(self):
@@ -399,3 +506,2421 @@ class RecvMessageFunctionTests(mocker.MockerTestCase):
         messages = utils.recv_messages(in_stream, utils.make_digest)
 
         self.assertRaises(StopIteration, lambda: messages.next())
+
+
+class SignerTests(mocker.MockerTestCase):
+
+    def test_same_digest_as_make_digest(self):
+        signer = utils.Signer()
+
+        self.assertEqual(signer.sign('foo').encode('hex'),
+                         utils.make_digest('foo'))
+
+    def test_digests_do_not_leak_between_messages(self):
+        signer = utils.Signer()
+        signer.sign('foo')
+
+        self.assertEqual(signer.sign('bar'), utils.Signer().sign('bar'))
+
+    def test_verify(self):
+        signer = utils.Signer()
+
+        self.assertTrue(signer.verify('foo', signer.sign('foo')))
+        self.assertFalse(signer.verify('foo', utils.Signer('bar').sign('foo')))
+
+
+class FramesTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.signer = utils.Signer()
+
+    def _send(self, *messages):
+        stream = io.BytesIO()
+        for message in messages:
+            utils.send_frame(stream, message, self.signer)
+        stream.seek(0)
+        return stream
+
+    def test_header_is_binary_and_versioned(self):
+        stream = self._send('message')
+
+        magic, version, length, digest = utils.FRAME_HEADER.unpack_from(
+            stream.getvalue())
+        self.assertEqual((magic, version), (utils.FRAME_MAGIC, utils.FRAME_VERSION))
+        self.assertEqual(length, len(stream.getvalue()) - utils.FRAME_HEADER.size)
+        self.assertEqual(len(digest), 20)
+
+    def test_messages_are_received(self):
+        stream = self._send('foo', {'bar': 1}, 'baz' * 100000, 'qux')
+
+        self.assertEqual(list(utils.recv_frames(stream, self.signer)),
+                         ['foo', {'bar': 1}, 'baz' * 100000, 'qux'])
+
+    def test_streams_without_readinto(self):
+        stream = StringIO(self._send('foo').getvalue())
+
+        self.assertEqual(list(utils.recv_frames(stream, self.signer)), ['foo'])
+
+    def test_corrupted_data_is_bypassed(self):
+        data = bytearray(self._send('foo', 'bar').getvalue())
+        data[-20] = chr(data[-20] ^ 0xff)
+
+        self.assertEqual(list(utils.recv_frames(io.BytesIO(data), self.signer)),
+                         ['foo'])
+
+    def test_truncated_frames_are_ignored(self):
+        data = self._send('foo', 'bar').getvalue()[:-1]
+
+        self.assertEqual(list(utils.recv_frames(io.BytesIO(data), self.signer)),
+                         ['foo'])
+
+    def test_unknown_versions_are_rejected(self):
+        data = 'XX' + self._send('foo').getvalue()[2:]
+        frames = utils.recv_frames(io.BytesIO(data), self.signer)
+
+        self.assertRaises(ValueError, lambda: frames.next())
+
+
+class FrameDecoderTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.signer = utils.Signer()
+        stream = io.BytesIO()
+        for message in ['foo', {'bar': 1}, 'baz' * 1000]:
+            utils.send_frame(stream, message, self.signer)
+        self.data = stream.getvalue()
+
+    def test_whole_frames(self):
+        decoder = utils.FrameDecoder(self.signer)
+
+        self.assertEqual(decoder.feed(self.data), ['foo', {'bar': 1}, 'baz' * 1000])
+        self.assertEqual(decoder.pending, 0)
+
+    def test_frames_split_across_chunks(self):
+        decoder = utils.FrameDecoder(self.signer)
+        messages = []
+        for i in range(0, len(self.data), 7):
+            messages.extend(decoder.feed(self.data[i:i + 7]))
+
+        self.assertEqual(messages, ['foo', {'bar': 1}, 'baz' * 1000])
+
+    def test_partial_frames_are_kept(self):
+        decoder = utils.FrameDecoder(self.signer)
+
+        self.assertEqual(decoder.feed(self.data[:-1]), ['foo', {'bar': 1}])
+        self.assertTrue(decoder.pending > 0)
+        self.assertEqual(decoder.feed(self.data[-1:]), ['baz' * 1000])
+
+    def test_stray_bytes_are_skipped(self):
+        decoder = utils.FrameDecoder(self.signer)
+        messages = decoder.feed('2013-06-11 INFO BEGIN\n' + 'B' * 30)
+        messages.extend(decoder.feed('LOOSE' + self.data[:10]))
+        messages.extend(decoder.feed(self.data[10:]))
+
+        self.assertEqual(messages, ['foo', {'bar': 1}, 'baz' * 1000])
+        self.assertEqual(decoder.skipped, len('2013-06-11 INFO BEGIN\n') + 35)
+
+    def test_corrupted_frames_are_counted(self):
+        decoder = utils.FrameDecoder(utils.Signer('bar'))
+
+        self.assertEqual(decoder.feed(self.data), [])
+        self.assertEqual(decoder.corrupted, 3)
+
+
+class FrameReceiverTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.signer = utils.Signer()
+        self.receiver = utils.FrameReceiver(self.signer)
+        self.pipes = []
+
+    def tearDown(self):
+        for fd in self.pipes:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.receiver.close()
+
+    def _pipe(self, key):
+        rfd, wfd = os.pipe()
+        self.pipes.extend([rfd, wfd])
+        self.receiver.register(rfd, key)
+        return wfd
+
+    def _frame(self, message):
+        stream = io.BytesIO()
+        utils.send_frame(stream, message, self.signer)
+        return stream.getvalue()
+
+    def test_messages_are_tagged_with_the_stream_key(self):
+        wfd = self._pipe('child-1')
+        os.write(wfd, self._frame('foo'))
+
+        self.assertEqual(self.receiver.poll(1), [('child-1', 'foo')])
+
+    def test_stalled_streams_do_not_block_the_others(self):
+        stalled = self._pipe('stalled')
+        active = self._pipe('active')
+        os.write(stalled, self._frame('foo')[:10])
+        os.write(active, self._frame('bar'))
+
+        self.assertEqual(self.receiver.poll(1), [('active', 'bar')])
+        self.assertEqual(self.receiver.poll(0), [])
+
+    def test_exhausted_streams_are_unregistered(self):
+        wfd1 = self._pipe('child-1')
+        wfd2 = self._pipe('child-2')
+        os.write(wfd1, self._frame('foo'))
+        os.write(wfd2, self._frame('bar') + self._frame('baz'))
+        os.close(wfd1)
+        os.close(wfd2)
+
+        self.assertEqual(sorted(self.receiver),
+                         [('child-1', 'foo'), ('child-2', 'bar'),
+                          ('child-2', 'baz')])
+        self.assertEqual(len(self.receiver), 0)
+
+
+SAMPLE_XML = """<article>
+  <front>
+    <journal-meta>
+      <journal-title-group>
+        <journal-title>Revista Foo</journal-title>
+      </journal-title-group>
+      <issn pub-type="ppub">0034-8910</issn>
+      <issn pub-type="epub">1518-8787</issn>
+    </journal-meta>
+    <article-meta>
+      <title-group>
+        <article-title>Foo Bar</article-title>
+      </title-group>
+      <pub-date pub-type="epub"><year>2013</year></pub-date>
+      <volume>47</volume>
+      <issue>2</issue>
+    </article-meta>
+  </front>
+  <body><sec><title>Foo</title></sec></body>
+  <back>
+    <ref-list>
+      <ref><element-citation><year>1999</year><volume>1</volume></element-citation></ref>
+    </ref-list>
+  </back>
+</article>"""
+
+
+class FakeXMLPackage(checkin.SPSMixin):
+    """
+    Stands for an Xray instance serving ``xmls``.
+    """
+    def __init__(self, *xmls):
+        self._xmls = xmls
+        self.opened = 0
+
+    def get_fps(self, ext):
+        for xml in self._xmls:
+            self.opened += 1
+            yield StringIO(xml)
+
+
+class SPSMixinTests(mocker.MockerTestCase):
+
+    def test_meta_fields(self):
+        pkg = FakeXMLPackage(SAMPLE_XML)
+
+        self.assertEqual(pkg.meta, {
+            'journal_title': 'Revista Foo',
+            'journal_eissn': '1518-8787',
+            'journal_pissn': '0034-8910',
+            'article_title': 'Foo Bar',
+            'issue_year': '2013',
+            'issue_volume': '47',
+            'issue_number': '2',
+        })
+
+    def test_missing_meta_fields_are_None(self):
+        pkg = FakeXMLPackage('<article><front><volume>4</volume></front></article>')
+
+        meta = pkg.meta
+        self.assertEqual(meta['issue_volume'], '4')
+        self.assertIsNone(meta['journal_title'])
+        self.assertIsNone(meta['issue_year'])
+
+    def test_xml_is_parsed_once(self):
+        pkg = FakeXMLPackage(SAMPLE_XML)
+
+        self.assertIs(pkg.xml, pkg.xml)
+        _ = pkg.meta
+        _ = pkg.meta
+        self.assertEqual(pkg.opened, 1)
+
+    def test_xml_source_is_shared_with_the_tree(self):
+        pkg = FakeXMLPackage(SAMPLE_XML)
+        _ = pkg.xml
+
+        self.assertEqual(pkg.xml_source, SAMPLE_XML)
+        self.assertEqual(pkg.opened, 1)
+
+    def test_many_xmls_raise_AttributeError(self):
+        pkg = FakeXMLPackage(SAMPLE_XML, SAMPLE_XML)
+
+        self.assertRaises(AttributeError, lambda: pkg.xml)
+
+    def test_meta_from_parsed_tree(self):
+        pkg = FakeXMLPackage(SAMPLE_XML)
+        _ = pkg.xml
+
+        self.assertEqual(pkg.meta['issue_volume'], '47')
+        self.assertEqual(pkg.opened, 1)
+
+    def test_meta_streaming_stops_after_front(self):
+        broken_body = SAMPLE_XML.replace('<body>', '<body><unclosed>')
+        pkg = FakeXMLPackage(broken_body)
+
+        self.assertEqual(pkg.meta['article_title'], 'Foo Bar')
+        self.assertFalse(hasattr(pkg, '_xml'))
+
+    def test_meta_streaming_with_many_xmls_raise_AttributeError(self):
+        pkg = FakeXMLPackage(SAMPLE_XML, SAMPLE_XML)
+
+        self.assertRaises(AttributeError, lambda: pkg.meta)
+
+
+class StreamMetaFunctionTests(mocker.MockerTestCase):
+
+    def test_same_result_as_tree_traversal(self):
+        pkg = FakeXMLPackage(SAMPLE_XML)
+        _ = pkg.xml
+
+        self.assertEqual(checkin.stream_meta(StringIO(SAMPLE_XML)), pkg.meta)
+
+    def test_fields_outside_front_are_ignored(self):
+        xml = '<article><front><volume>4</volume></front><issue>9</issue></article>'
+
+        meta = checkin.stream_meta(StringIO(xml))
+        self.assertEqual(meta['issue_volume'], '4')
+        self.assertIsNone(meta['issue_number'])
+
+
+class IterWithParentFunctionTests(mocker.MockerTestCase):
+
+    def test_document_order(self):
+        root = checkin.etree.fromstring('<a><b><c/></b><d/></a>')
+
+        self.assertEqual(
+            [(p.tag, c.tag) for p, c in checkin.iter_with_parent(root)],
+            [('a', 'b'), ('b', 'c'), ('a', 'd')])
+
+
+class FakePool(object):
+    """
+    Runs the submitted tasks synchronously.
+    """
+    def __init__(self):
+        self.tasks = []
+
+    def apply_async(self, func, args, callback=None):
+        self.tasks.append(args)
+        callback('attempt for %s' % args)
+
+
+class DispatchFunctionTests(mocker.MockerTestCase):
+
+    def test_pathnames_are_submitted_to_pool(self):
+        queue = Queue.Queue()
+        queue.put('/tmp/a.zip')
+        queue.put('/tmp/b.zip')
+        queue.put(None)
+        pool = FakePool()
+        results = []
+
+        monitor.dispatch(queue, pool, 1, callback=results.append)
+
+        self.assertEqual(pool.tasks, [('/tmp/a.zip',), ('/tmp/b.zip',)])
+        self.assertEqual(results,
+            ['attempt for /tmp/a.zip', 'attempt for /tmp/b.zip'])
+
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class EventCoalescerTests(mocker.MockerTestCase):
+
+    def _make_coalescer(self):
+        self.clock = FakeClock()
+        self.queue = Queue.Queue()
+        return monitor.EventCoalescer(self.queue, 2, clock=self.clock)
+
+    def _released(self):
+        released = []
+        while not self.queue.empty():
+            released.append(self.queue.get_nowait())
+        return released
+
+    def test_pathnames_are_held_during_quiet_period(self):
+        coalescer = self._make_coalescer()
+        coalescer.touch('/tmp/a.zip')
+        self.clock.now = 1
+
+        self.assertEqual(coalescer.release(), 0)
+        self.assertEqual(self._released(), [])
+
+    def test_quiet_pathnames_are_released(self):
+        coalescer = self._make_coalescer()
+        coalescer.touch('/tmp/a.zip')
+        self.clock.now = 1
+        coalescer.touch('/tmp/b.zip')
+        self.clock.now = 2
+
+        self.assertEqual(coalescer.release(), 1)
+        self.assertEqual(self._released(), ['/tmp/a.zip'])
+
+    def test_repeated_events_are_released_once(self):
+        coalescer = self._make_coalescer()
+        for i in range(3):
+            coalescer.touch('/tmp/a.zip')
+        self.clock.now = 5
+        coalescer.release()
+
+        self.assertEqual(self._released(), ['/tmp/a.zip'])
+        self.assertEqual(coalescer.stats(),
+            {'events': 3, 'suppressed': 2, 'released': 1, 'pending': 0})
+
+    def test_new_events_restart_quiet_period(self):
+        coalescer = self._make_coalescer()
+        coalescer.touch('/tmp/a.zip')
+        self.clock.now = 1.5
+        coalescer.touch('/tmp/a.zip')
+        self.clock.now = 3
+
+        self.assertEqual(coalescer.release(), 0)
+
+    def test_discarded_pathnames_are_not_released(self):
+        coalescer = self._make_coalescer()
+        coalescer.touch('/tmp/a.zip.part')
+        coalescer.discard('/tmp/a.zip.part')
+        coalescer.touch('/tmp/a.zip')
+
+        coalescer.release(force=True)
+        self.assertEqual(self._released(), ['/tmp/a.zip'])
+
+    def test_event_handler_touches_pathnames(self):
+        coalescer = self._make_coalescer()
+        mock_event = self.mocker.mock()
+        mock_event.pathname
+        self.mocker.result('/tmp/a.zip')
+        self.mocker.count(2)
+        self.mocker.replay()
+
+        handler = monitor.EventHandler(coalescer=coalescer)
+        handler.process_IN_CLOSE_WRITE(mock_event)
+        handler.process_IN_MOVED_TO(mock_event)
+
+        self.assertEqual(coalescer.stats()['suppressed'], 1)
+
+    def test_event_handler_skips_failed_packages(self):
+        coalescer = self._make_coalescer()
+        handler = monitor.EventHandler(coalescer=coalescer)
+        event = pyinotify.Event({'pathname': '/tmp/_failed_a.zip',
+                                 'mask': pyinotify.IN_MOVED_TO})
+        handler.process_IN_MOVED_TO(event)
+        handler.process_IN_CLOSE_WRITE(event)
+
+        self.assertEqual(coalescer.stats()['events'], 0)
+        self.assertEqual(coalescer.release(force=True), 0)
+
+    def test_event_handler_skips_excluded_pathnames(self):
+        coalescer = self._make_coalescer()
+        handler = monitor.EventHandler(coalescer=coalescer,
+            exclude=pyinotify.ExcludeFilter([r'.*\.py$']))
+        for pathname in ['/tmp/a.py', '/tmp/a.zip']:
+            handler.process_IN_CLOSE_WRITE(pyinotify.Event(
+                {'pathname': pathname, 'mask': pyinotify.IN_CLOSE_WRITE}))
+
+        self.assertEqual(coalescer.release(force=True), 1)
+
+
+class ScanPackagesFunctionTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'sub'))
+        for name in ['a.zip', '_failed_b.zip', os.path.join('sub', 'c.zip')]:
+            open(os.path.join(self.path, name), 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _scan(self, **kwargs):
+        return sorted(os.path.relpath(pathname, self.path)
+            for pathname in monitor.scan_packages(self.path, **kwargs))
+
+    def test_failed_packages_are_skipped(self):
+        self.assertEqual(self._scan(), ['a.zip'])
+
+    def test_recursive(self):
+        self.assertEqual(self._scan(recursive=True),
+                         ['a.zip', os.path.join('sub', 'c.zip')])
+
+    def test_without_scandir(self):
+        scandir = monitor.scandir
+        monitor.scandir = None
+        try:
+            self.assertEqual(self._scan(recursive=True),
+                             ['a.zip', os.path.join('sub', 'c.zip')])
+        finally:
+            monitor.scandir = scandir
+
+    def test_reconcile_skips_known_packages(self):
+        queue = Queue.Queue()
+        coalescer = monitor.EventCoalescer(queue, 0)
+        digests = {os.path.join(self.path, 'a.zip'): 'known'}
+
+        count = monitor.reconcile([self.path], coalescer, recursive=True,
+            known_digests=set(['known']),
+            digest=lambda pathname: digests.get(pathname, 'new'))
+
+        self.assertEqual(count, 1)
+        coalescer.release(force=True)
+        self.assertEqual(queue.get_nowait(),
+                         os.path.join(self.path, 'sub', 'c.zip'))
+
+
+    def test_reconcile_skips_unreadable_packages(self):
+        queue = Queue.Queue()
+        coalescer = monitor.EventCoalescer(queue, 0)
+
+        def digest(pathname):
+            if pathname.endswith('a.zip'):
+                raise OSError(errno.ENOENT, 'No such file or directory')
+            return 'new'
+
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            count = monitor.reconcile([self.path], coalescer, recursive=True,
+                known_digests=set(['known']), digest=digest)
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+        self.assertEqual(count, 1)
+        self.assertIn('a.zip', errors)
+
+    def test_reconcile_skips_excluded_packages(self):
+        queue = Queue.Queue()
+        coalescer = monitor.EventCoalescer(queue, 0)
+
+        count = monitor.reconcile([self.path], coalescer, recursive=True,
+            known_digests=set(),
+            exclude=pyinotify.ExcludeFilter(['.*/sub/']))
+
+        self.assertEqual(count, 1)
+        coalescer.release(force=True)
+        self.assertEqual(queue.get_nowait(), os.path.join(self.path, 'a.zip'))
+
+    def test_exclude_filter_from_settings(self):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('monitor')
+        settings.set('monitor', 'exclude_lst', r'.*\.py$,.*/tmp/')
+
+        exclude = monitor.get_exclude_filter(settings)
+        self.assertTrue(exclude('/srv/a.py'))
+        self.assertTrue(exclude('/srv/tmp/a.zip'))
+        self.assertFalse(exclude('/srv/a.zip'))
+
+    def test_blank_exclude_filter(self):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('monitor')
+        settings.set('monitor', 'exclude_lst', '')
+
+        self.assertFalse(monitor.get_exclude_filter(settings)('/srv/a.zip'))
+
+class ShardTests(mocker.MockerTestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(monitor.parse_shard('1/4'), (1, 4))
+
+    def test_invalid_shards(self):
+        for value in ['1', 'a/4', '4/4']:
+            self.assertRaises(monitor.argparse.ArgumentTypeError,
+                              monitor.parse_shard, value)
+
+    def test_each_pathname_has_a_single_owner(self):
+        for i in range(20):
+            pathname = '/tmp/%s.zip' % i
+            owners = [index for index in range(3)
+                      if monitor.owns(pathname, (index, 3))]
+            self.assertEqual(len(owners), 1)
+
+    def test_event_handler_ignores_other_shards(self):
+        coalescer = monitor.EventCoalescer(Queue.Queue(), 0)
+        handler = monitor.EventHandler(coalescer=coalescer, shard=(0, 2))
+        for i in range(20):
+            event = pyinotify.Event({'pathname': '/tmp/%s.zip' % i,
+                                     'mask': pyinotify.IN_CLOSE_WRITE})
+            handler.process_IN_CLOSE_WRITE(event)
+
+        released = coalescer.release(force=True)
+        self.assertEqual(released, len([i for i in range(20)
+            if monitor.owns('/tmp/%s.zip' % i, (0, 2))]))
+        self.assertTrue(0 < released < 20)
+
+
+class InitWorkerFunctionTests(mocker.MockerTestCase):
+
+    def test_group_signals_are_ignored(self):
+        handlers = [signal.getsignal(signum)
+                    for signum in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            monitor.init_worker()
+
+            self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_IGN)
+            self.assertEqual(signal.getsignal(signal.SIGINT), signal.SIG_IGN)
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+
+class GetWorkersCountFunctionTests(mocker.MockerTestCase):
+
+    def test_blank_means_cpu_count(self):
+        mock_settings = self.mocker.mock()
+        mock_settings.getint('monitor', 'workers')
+        self.mocker.throw(ValueError)
+        self.mocker.replay()
+
+        self.assertEqual(monitor.get_workers_count(mock_settings),
+                         monitor.multiprocessing.cpu_count())
+
+    def test_configured_value(self):
+        mock_settings = self.mocker.mock()
+        mock_settings.getint('monitor', 'workers')
+        self.mocker.result(3)
+        self.mocker.replay()
+
+        self.assertEqual(monitor.get_workers_count(mock_settings), 3)
+
+
+class DatabaseTestCase(mocker.MockerTestCase):
+    """
+    Creates the database structure before each test and drops it
+    afterwards.
+    """
+    def setUp(self):
+        models.Base.metadata.create_all(models.get_engine())
+        models.articlepkg_ids.clear()
+
+    def tearDown(self):
+        models.Base.metadata.drop_all(models.get_engine())
+
+
+class GetDigestFunctionTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(GetDigestFunctionTests, self).setUp()
+        fd, self.filepath = tempfile.mkstemp()
+        os.write(fd, 'Some content')
+        os.close(fd)
+        self.calls = []
+
+    def tearDown(self):
+        os.remove(self.filepath)
+        super(GetDigestFunctionTests, self).tearDown()
+
+    def _make_digest(self, filepath):
+        self.calls.append(filepath)
+        return utils.make_digest_file(filepath)
+
+    def test_digest_is_computed_on_misses(self):
+        self.assertEqual(
+            models.get_digest(self.filepath, make_digest=self._make_digest),
+            utils.make_digest_file(self.filepath))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_unchanged_files_are_not_read_again(self):
+        for i in range(2):
+            models.get_digest(self.filepath, make_digest=self._make_digest)
+
+        self.assertEqual(len(self.calls), 1)
+
+    def test_changed_files_are_read_again(self):
+        models.get_digest(self.filepath, make_digest=self._make_digest)
+        with open(self.filepath, 'ab') as f:
+            f.write('More content')
+
+        self.assertEqual(
+            models.get_digest(self.filepath, make_digest=self._make_digest),
+            utils.make_digest_file(self.filepath))
+        self.assertEqual(len(self.calls), 2)
+
+
+class DigestCacheTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(DigestCacheTests, self).setUp()
+        fd, self.filepath = tempfile.mkstemp()
+        os.write(fd, 'Some content')
+        os.close(fd)
+        self.calls = []
+
+    def tearDown(self):
+        os.remove(self.filepath)
+        super(DigestCacheTests, self).tearDown()
+
+    def _make_digest(self, filepath):
+        self.calls.append(filepath)
+        return utils.make_digest_file(filepath)
+
+    def _count(self):
+        with models.session_scope() as ses:
+            return ses.query(models.PackageDigest).count()
+
+    def test_stored_digests_are_loaded_at_once(self):
+        models.get_digest(self.filepath)
+
+        cache = models.DigestCache.load(make_digest=self._make_digest)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(self.filepath),
+                         utils.make_digest_file(self.filepath))
+        self.assertEqual(self.calls, [])
+
+    def test_new_digests_are_stored_on_flush(self):
+        cache = models.DigestCache.load(make_digest=self._make_digest)
+        for i in range(2):
+            cache.get(self.filepath)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self._count(), 0)
+
+        self.assertEqual(cache.flush(), 1)
+        self.assertEqual(cache.flush(), 0)
+        models.get_digest(self.filepath, make_digest=self._make_digest)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_digests_cached_meanwhile_are_kept(self):
+        cache = models.DigestCache.load(make_digest=self._make_digest)
+        cache.get(self.filepath)
+        models.get_digest(self.filepath)
+
+        self.assertEqual(cache.flush(), 1)
+        self.assertEqual(self._count(), 1)
+
+
+def make_package(members):
+    """
+    Returns the pathname of a new zip file with the given ``members``,
+    a sequence of (name, content) pairs.
+    """
+    fd, filepath = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as pkg:
+        for name, content in members:
+            pkg.writestr(name, content)
+
+    return filepath
+
+
+class XrayTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.filepath = make_package([('a.xml', SAMPLE_XML),
+                                      ('a.pdf', 'PDF content')])
+
+    def tearDown(self):
+        os.remove(self.filepath)
+
+    def test_checksum(self):
+        xray = checkin.Xray(self.filepath)
+
+        self.assertEqual(xray.checksum, utils.make_digest_file(self.filepath))
+
+    def test_filesize(self):
+        xray = checkin.Xray(self.filepath)
+
+        self.assertEqual(xray.filesize, os.stat(self.filepath).st_size)
+        _ = xray.checksum
+        self.assertEqual(xray.filesize, os.stat(self.filepath).st_size)
+
+    def test_fingerprint_of_identical_packages(self):
+        other = make_package([('a.pdf', 'PDF content'),
+                              ('a.xml', SAMPLE_XML)])
+        try:
+            self.assertEqual(checkin.Xray(self.filepath).fingerprint,
+                             checkin.Xray(other).fingerprint)
+        finally:
+            os.remove(other)
+
+    def test_fingerprint_of_different_packages(self):
+        other = make_package([('a.xml', SAMPLE_XML),
+                              ('a.pdf', 'Other PDF content')])
+        try:
+            self.assertNotEqual(checkin.Xray(self.filepath).fingerprint,
+                                checkin.Xray(other).fingerprint)
+        finally:
+            os.remove(other)
+
+    def test_fingerprint_of_non_ascii_names(self):
+        other = make_package([('a.xml', SAMPLE_XML),
+                              (u'artigo-ção.pdf', 'PDF content')])
+        try:
+            xray = checkin.Xray(other)
+        finally:
+            os.remove(other)
+
+        self.assertTrue(isinstance(xray.members[1][0], unicode))
+        self.assertEqual(len(xray.fingerprint), 40)
+
+    def test_members_are_readable_after_checksum(self):
+        xray = checkin.Xray(self.filepath)
+        fp = next(xray.get_fps('xml'))
+        head = fp.read(10)
+        _ = xray.checksum
+
+        self.assertEqual(head + fp.read(), SAMPLE_XML)
+
+    def test_manifest(self):
+        other = make_package([('a.xml', SAMPLE_XML), ('img/A-GF01.TIF', 'TIF'),
+                              ('img/', '')])
+        try:
+            manifest = checkin.Xray(other).manifest
+        finally:
+            os.remove(other)
+
+        self.assertEqual([(m['name'], m['extension'], m['size'])
+                          for m in manifest],
+                         [('a.xml', 'xml', len(SAMPLE_XML)),
+                          ('img/A-GF01.TIF', 'tif', 3),
+                          ('img/', None, 0)])
+        self.assertEqual(manifest[0]['crc'],
+                         zlib.crc32(SAMPLE_XML) & 0xffffffff)
+
+    def test_members_are_classified_by_lowercase_extension(self):
+        other = make_package([('A.XML', SAMPLE_XML), ('a.Pdf', 'PDF'),
+                              ('README', 'foo')])
+        try:
+            xray = checkin.Xray(other)
+        finally:
+            os.remove(other)
+
+        self.assertEqual(xray.get_ext('xml'), ['A.XML'])
+        self.assertEqual(xray.get_ext('pdf'), ['a.Pdf'])
+
+
+class FindAttemptFunctionTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(FindAttemptFunctionTests, self).setUp()
+        self.digests = []
+
+    def _get_digest(self):
+        self.digests.append('digest')
+        return 'digest'
+
+    def _add_attempt(self, **kwargs):
+        ses = models.Session()
+        ses.add(models.Attempt(**kwargs))
+        ses.commit()
+        ses.close()
+
+    def test_unknown_fingerprint_does_not_need_digest(self):
+        self._add_attempt(package_md5='other', package_fingerprint='other')
+
+        self.assertIsNone(models.find_attempt('fingerprint', self._get_digest))
+        self.assertEqual(self.digests, [])
+
+    def test_known_fingerprint_is_confirmed_by_digest(self):
+        self._add_attempt(package_md5='digest', package_fingerprint='fingerprint')
+
+        attempt = models.find_attempt('fingerprint', self._get_digest)
+        self.assertEqual(attempt.package_md5, 'digest')
+        self.assertEqual(self.digests, ['digest'])
+
+    def test_missing_fingerprint_falls_back_to_digest(self):
+        self._add_attempt(package_md5='digest')
+
+        attempt = models.find_attempt(None, self._get_digest)
+        self.assertEqual(attempt.package_md5, 'digest')
+
+    def test_attempts_without_fingerprint_are_compared_by_digest(self):
+        self._add_attempt(package_md5='digest')
+
+        attempt = models.find_attempt('fingerprint', self._get_digest)
+        self.assertEqual(attempt.package_md5, 'digest')
+
+
+class GetOrCreateFunctionTests(DatabaseTestCase):
+
+    def test_created_objects_are_not_committed(self):
+        ses = models.Session()
+        attempt = models.get_or_create(ses, models.Attempt, package_md5='foo')
+        self.assertIsNotNone(attempt.id)
+        ses.rollback()
+
+        self.assertEqual(models.Session().query(models.Attempt).count(), 0)
+
+    def test_existing_objects_are_returned(self):
+        ses = models.Session()
+        first = models.get_or_create(ses, models.Attempt, package_md5='foo')
+        second = models.get_or_create(ses, models.Attempt, package_md5='foo')
+        ses.commit()
+
+        self.assertEqual(first.id, second.id)
+
+    def test_creation_is_reported(self):
+        ses = models.Session()
+        first = models.get_or_create_with_status(ses, models.Attempt,
+                                                 package_md5='foo')
+        second = models.get_or_create_with_status(ses, models.Attempt,
+                                                  package_md5='foo')
+        ses.commit()
+
+        self.assertEqual([created for obj, created in (first, second)],
+                         [True, False])
+
+    def test_constraint_violations_keep_the_transaction(self):
+        ses = models.Session()
+        models.get_or_create(ses, models.Attempt, package_md5='foo')
+
+        self.assertFalse(models._insert(ses,
+            models.Attempt(package_md5='foo', collection_uri='bar')))
+        ses.commit()
+        self.assertEqual(models.Session().query(models.Attempt).count(), 1)
+
+    def test_other_violations_are_raised(self):
+        with models.session_scope() as ses:
+            models.get_or_create(ses, models.Attempt, package_md5='foo')
+
+            # the other fields of the natural key are null
+            self.assertRaises(models.IntegrityError,
+                models.get_or_create_with_status, ses, models.ArticlePkg,
+                article_title='Foo')
+            self.assertRaises(models.IntegrityError,
+                models.get_articlepkg_id, ses, article_title='Foo')
+
+        self.assertEqual(models.Session().query(models.Attempt).count(), 1)
+
+
+class GetAttemptFunctionTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(GetAttemptFunctionTests, self).setUp()
+        self.filepath = make_package([('a.xml', SAMPLE_XML),
+                                      ('a.pdf', 'PDF content')])
+
+    def tearDown(self):
+        os.remove(self.filepath)
+        super(GetAttemptFunctionTests, self).tearDown()
+
+    def test_attempt_is_committed(self):
+        attempt = checkin.get_attempt(self.filepath)
+
+        ses = models.Session()
+        stored = ses.query(models.Attempt).get(attempt.id)
+        self.assertEqual(stored.package_md5,
+                         utils.make_digest_file(self.filepath))
+        self.assertEqual(stored.articlepkg.article_title, 'Foo Bar')
+
+    def test_identical_packages_get_the_same_attempt(self):
+        other = make_package([('a.xml', SAMPLE_XML),
+                              ('a.pdf', 'PDF content')])
+        try:
+            first = checkin.get_attempt(self.filepath)
+            second = checkin.get_attempt(other)
+        finally:
+            os.remove(other)
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(models.Session().query(models.Attempt).count(), 1)
+
+    def test_identical_packages_saved_at_once_are_stored_once(self):
+        other = make_package([('a.xml', SAMPLE_XML),
+                              ('a.pdf', 'PDF content')])
+        try:
+            inspections = [checkin.inspect_package(filepath)
+                           for filepath in (self.filepath, other)]
+        finally:
+            os.remove(other)
+
+        ses = models.Session()
+        first, second = [checkin.save_attempt(ses, inspection)
+                         for inspection in inspections]
+        ses.commit()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(ses.query(models.ValidationSet).count(), 1)
+        self.assertEqual(ses.query(models.PackageMember).count(), 2)
+        ses.close()
+
+    def test_digest_is_cached_when_the_attempt_is_saved(self):
+        inspection = checkin.inspect_package(self.filepath)
+
+        with models.session_scope() as ses:
+            self.assertEqual(ses.query(models.PackageDigest).count(), 0)
+            self.assertEqual(inspection['digest'][1],
+                             utils.make_digest_file(self.filepath))
+
+            checkin.save_attempt(ses, inspection)
+
+        with models.session_scope() as ses:
+            self.assertEqual(ses.query(models.PackageDigest).count(), 1)
+        self.assertIsNone(checkin.inspect_package(self.filepath)['digest'])
+
+    def test_xml_is_parsed_once(self):
+        streamed = []
+        stream_meta = checkin.stream_meta
+        checkin.stream_meta = lambda fp: streamed.append(fp)
+        try:
+            inspection = checkin.inspect_package(self.filepath)
+        finally:
+            checkin.stream_meta = stream_meta
+
+        self.assertEqual(streamed, [])
+        self.assertEqual(inspection['articlepkg']['article_title'], 'Foo Bar')
+
+    def test_validations_are_stored(self):
+        attempt = checkin.get_attempt(self.filepath)
+
+        ses = models.Session()
+        validationset = ses.query(models.ValidationSet).filter_by(
+            attempt_id=attempt.id).one()
+        self.assertEqual(sorted(v.label for v in validationset.validations),
+                         sorted(validator.registry))
+
+    def test_members_are_stored(self):
+        attempt = checkin.get_attempt(self.filepath)
+
+        ses = models.Session()
+        members = ses.query(models.PackageMember).filter_by(
+            attempt_id=attempt.id).all()
+        self.assertEqual(sorted((m.name, m.extension, m.size) for m in members),
+                         [('a.pdf', 'pdf', 11),
+                          ('a.xml', 'xml', len(SAMPLE_XML))])
+        self.assertTrue(all(m.compressed_size for m in members))
+
+    def test_resubmitted_packages_are_compared_to_the_latest_attempt(self):
+        first = checkin.get_attempt(self.filepath)
+        other = make_package([('a.xml', SAMPLE_XML),
+                              ('a.pdf', 'other PDF content')])
+        try:
+            second = checkin.get_attempt(other)
+        finally:
+            os.remove(other)
+
+        self.assertNotEqual(first.id, second.id)
+        ses = models.Session()
+        manifest, results = models.get_latest_validations(ses,
+            article_title='Foo Bar')
+        self.assertTrue(('a.pdf', zlib.crc32('other PDF content') & 0xffffffff,
+                         17) in manifest)
+        self.assertEqual(sorted(results), sorted(validator.registry))
+
+
+class IsValidISSNFunctionTests(mocker.MockerTestCase):
+
+    def test_valid(self):
+        for issn in ['0034-8910', '1518-8787', '0000-006X']:
+            self.assertTrue(validator.is_valid_issn(issn))
+
+    def test_invalid(self):
+        for issn in [None, '', '0034-8911', '00348910', '0034-891']:
+            self.assertFalse(validator.is_valid_issn(issn))
+
+
+class ValidatorsTests(mocker.MockerTestCase):
+
+    def _validate(self, label, members):
+        filepath = make_package(members)
+        try:
+            with checkin.PackageAnalyzer(filepath) as pkg:
+                result, = pkg.validate([validator.registry[label]])
+        finally:
+            os.remove(filepath)
+
+        return result['status'], result['description']
+
+    def test_sample_package_is_valid(self):
+        filepath = make_package([('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')])
+        try:
+            with checkin.PackageAnalyzer(filepath) as pkg:
+                results = pkg.validate()
+        finally:
+            os.remove(filepath)
+
+        self.assertEqual([(r['label'], r['status']) for r in results],
+                         [(label, 'ok') for label in validator.registry])
+
+    def test_invalid_issn(self):
+        xml = SAMPLE_XML.replace('0034-8910', '0034-8911')
+
+        self.assertEqual(
+            self._validate('journal_issn', [('a.xml', xml), ('a.pdf', 'PDF')]),
+            ('error', 'invalid issn: 0034-8911'))
+
+    def test_missing_article_title(self):
+        xml = SAMPLE_XML.replace('Foo Bar', ' ')
+
+        self.assertEqual(
+            self._validate('article_title', [('a.xml', xml), ('a.pdf', 'PDF')])[0],
+            'error')
+
+    def test_unpaired_pdf(self):
+        self.assertEqual(
+            self._validate('xml_pdf_pair', [('a.xml', SAMPLE_XML),
+                                            ('b.pdf', 'PDF')]),
+            ('warning', 'missing pdf for: a.xml'))
+
+    def test_missing_referenced_members(self):
+        xml = SAMPLE_XML.replace('<article>',
+            '<article xmlns:xlink="http://www.w3.org/1999/xlink">').replace(
+            '<body>', '<body><graphic xlink:href="a-gf01"/>'
+                      '<graphic xlink:href="a-gf02.tif"/>')
+
+        self.assertEqual(
+            self._validate('member_references', [('a.xml', xml),
+                ('a.pdf', 'PDF'), ('a-gf01.jpg', 'JPG')]),
+            ('error', 'missing members: a-gf02.tif'))
+
+    def test_failing_validators_get_an_error_status(self):
+        class Broken(validator.Validator):
+            label = 'broken'
+
+            def validate(self, package):
+                raise ValueError('foo')
+
+        filepath = make_package([('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')])
+        try:
+            with checkin.PackageAnalyzer(filepath) as pkg:
+                result, = pkg.validate([Broken()])
+        finally:
+            os.remove(filepath)
+
+        self.assertEqual(result['status'], 'error')
+        self.assertTrue('ValueError' in result['description'])
+
+
+class RecordingValidator(validator.Validator):
+    label = 'recording'
+    inputs = ('xml',)
+
+    def __init__(self):
+        self.calls = 0
+
+    def validate(self, package):
+        self.calls += 1
+        return 'ok', None
+
+
+class IncrementalValidationTests(mocker.MockerTestCase):
+
+    def _run(self, members, previous):
+        recording = RecordingValidator()
+        filepath = make_package(members)
+        try:
+            with checkin.PackageAnalyzer(filepath) as pkg:
+                results = pkg.validate([recording], previous=previous)
+                manifest = pkg.members
+        finally:
+            os.remove(filepath)
+
+        return recording.calls, results, manifest
+
+    def test_unchanged_inputs_reuse_the_previous_results(self):
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')], None)
+        self.assertEqual(calls, 1)
+
+        previous = (manifest, {'recording': ('warning', 'foo')})
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML), ('a.pdf', 'other PDF')], previous)
+
+        self.assertEqual(calls, 0)
+        self.assertEqual(results, [{'label': 'recording',
+                                    'status': 'warning',
+                                    'description': 'foo'}])
+
+    def test_changed_inputs_are_validated_again(self):
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')], None)
+
+        previous = (manifest, {'recording': ('warning', 'foo')})
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML.replace('Foo Bar', 'Bar')),
+             ('a.pdf', 'PDF')], previous)
+
+        self.assertEqual(calls, 1)
+        self.assertEqual(results[0]['status'], 'ok')
+
+    def test_validators_missing_from_the_previous_results_are_run(self):
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')], None)
+
+        calls, results, manifest = self._run(
+            [('a.xml', SAMPLE_XML), ('a.pdf', 'PDF')], (manifest, {}))
+
+        self.assertEqual(calls, 1)
+
+    def test_input_members(self):
+        members = [('b.pdf', 2, 2), ('a.xml', 1, 1), ('a.jpg', 3, 3)]
+
+        self.assertEqual(validator.input_members(RecordingValidator, members),
+                         [('a.xml', 1, 1)])
+        self.assertEqual(validator.input_members(RecordingValidator,
+                                                 [('A.XML', 1, 1), ('README', 2, 2)]),
+                         [('A.XML', 1, 1)])
+        self.assertEqual(validator.input_members(validator.Validator, members),
+                         sorted(members))
+
+
+SAMPLE_XSD = """<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="article">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="front">
+          <xs:complexType>
+            <xs:sequence>
+              <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+            </xs:sequence>
+          </xs:complexType>
+        </xs:element>
+        <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+      </xs:sequence>
+      <xs:anyAttribute processContents="skip"/>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>"""
+
+
+class SchemaCacheTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.loaded = []
+
+        def loader(path):
+            self.loaded.append(path)
+            return object()
+
+        self.cache = validator.SchemaCache({'sps-1.0': 'a.xsd',
+                                            'sps-1.1': 'b.xsd'}, loader)
+
+    def test_schemas_are_compiled_once(self):
+        first = self.cache.get('sps-1.0')
+        second = self.cache.get('sps-1.0')
+
+        self.assertTrue(first is second)
+        self.assertEqual(self.loaded, ['a.xsd'])
+
+    def test_warm(self):
+        self.cache.warm()
+        self.cache.get('sps-1.1')
+
+        self.assertEqual(sorted(self.loaded), ['a.xsd', 'b.xsd'])
+        self.assertEqual(self.cache.loads, 2)
+
+    def test_unknown_versions(self):
+        self.assertRaises(KeyError, self.cache.get, 'sps-2.0')
+
+    def test_from_settings(self):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('schemas')
+        settings.set('schemas', 'sps-1.1', '/tmp/b.xsd')
+
+        self.assertEqual(validator.SchemaCache.from_settings(settings).paths,
+                         {'sps-1.1': '/tmp/b.xsd'})
+
+
+@unittest.skipIf(validator.lxml_etree is None, 'lxml is not installed')
+class SchemaValidatorTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        fd, self.xsd = tempfile.mkstemp(suffix='.xsd')
+        os.write(fd, SAMPLE_XSD)
+        os.close(fd)
+        self.cache = validator.SchemaCache({'sps-1.1': self.xsd})
+        self.validator = validator.SchemaValidator(self.cache, 'sps-1.1')
+
+    def tearDown(self):
+        os.remove(self.xsd)
+
+    def _validate(self, xml):
+        filepath = make_package([('a.xml', xml), ('a.pdf', 'PDF')])
+        try:
+            with checkin.PackageAnalyzer(filepath) as pkg:
+                return pkg.validate([self.validator])[0]['status']
+        finally:
+            os.remove(filepath)
+
+    def test_valid_document(self):
+        self.assertEqual(self._validate(SAMPLE_XML), 'ok')
+        self.assertEqual(self._validate(SAMPLE_XML), 'ok')
+        self.assertEqual(self.cache.loads, 1)
+
+    def test_invalid_document(self):
+        self.assertEqual(self._validate('<article><body/></article>'), 'error')
+
+    def test_declared_version_is_used(self):
+        xml = SAMPLE_XML.replace('<article>', '<article specific-use="sps-1.0">')
+
+        self.assertEqual(self._validate(xml), 'warning')
+
+
+def corrupt_member(filepath, name):
+    """
+    Flips a byte in the middle of the compressed data of the member
+    ``name`` of the package at ``filepath``.
+    """
+    with zipfile.ZipFile(filepath) as pkg:
+        info = pkg.getinfo(name)
+
+    with open(filepath, 'r+b') as fp:
+        fp.seek(info.header_offset + 26)
+        name_size, extra_size = struct.unpack('<HH', fp.read(4))
+        offset = (info.header_offset + 30 + name_size + extra_size +
+                  info.compress_size // 2)
+        fp.seek(offset)
+        byte = fp.read(1)
+        fp.seek(offset)
+        fp.write(chr(ord(byte) ^ 0xff))
+
+
+class IntegrityTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(IntegrityTests, self).setUp()
+        self.pool = ThreadPool(2)
+        self.filepath = make_package([('a.xml', SAMPLE_XML),
+                                      ('a.pdf', os.urandom(300 * 1024)),
+                                      ('img/', ''),
+                                      ('img/a-gf01.jpg', 'JPG' * 1000)])
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.filepath)
+        super(IntegrityTests, self).tearDown()
+
+    def test_sound_package(self):
+        self.assertEqual(integrity.verify_package(self.filepath,
+                                                  pool=self.pool), [])
+
+    def test_corrupted_members(self):
+        corrupt_member(self.filepath, 'a.xml')
+
+        errors = integrity.verify_package(self.filepath, pool=self.pool)
+
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('a.xml: '))
+
+    def test_encrypted_members(self):
+        with zipfile.ZipFile(self.filepath) as pkg:
+            info = pkg.getinfo('a.xml')
+        info.flag_bits |= 0x1
+
+        errors = integrity.verify_package(self.filepath, [info],
+                                          pool=self.pool)
+
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('a.xml: '))
+
+    def test_unsupported_compression_methods(self):
+        with zipfile.ZipFile(self.filepath) as pkg:
+            info = pkg.getinfo('a.xml')
+        info.compress_type = 14
+
+        errors = integrity.verify_package(self.filepath, [info],
+                                          pool=self.pool)
+
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('a.xml: '))
+
+    def test_truncated_members(self):
+        with zipfile.ZipFile(self.filepath) as pkg:
+            info = pkg.getinfo('a.xml')
+        info.file_size += 1
+
+        errors = integrity.verify_package(self.filepath, [info],
+                                          pool=self.pool)
+
+        self.assertEqual(errors, ['a.xml: expected %s bytes, got %s' % (
+            len(SAMPLE_XML) + 1, len(SAMPLE_XML))])
+
+    def test_members_are_extracted(self):
+        destination = os.path.join(tempfile.mkdtemp(), 'pkg')
+        try:
+            errors = integrity.verify_package(self.filepath,
+                destination=destination, pool=self.pool, chunk_size=1024)
+
+            self.assertEqual(errors, [])
+            with open(os.path.join(destination, 'img', 'a-gf01.jpg')) as fp:
+                self.assertEqual(fp.read(), 'JPG' * 1000)
+        finally:
+            shutil.rmtree(os.path.dirname(destination))
+
+    def test_extracted_members_are_removed_on_errors(self):
+        corrupt_member(self.filepath, 'a.pdf')
+        destination = os.path.join(tempfile.mkdtemp(), 'pkg')
+        try:
+            errors = integrity.verify_package(self.filepath,
+                destination=destination, pool=self.pool)
+
+            self.assertEqual(len(errors), 1)
+            self.assertFalse(os.path.exists(destination))
+        finally:
+            shutil.rmtree(os.path.dirname(destination))
+
+    def test_package_is_opened_once_per_thread(self):
+        opened = []
+        ZipFile = zipfile.ZipFile
+
+        def open_package(*args, **kwargs):
+            opened.append(args[0])
+            return ZipFile(*args, **kwargs)
+
+        with ZipFile(self.filepath) as pkg:
+            infos = pkg.infolist()
+
+        integrity.zipfile.ZipFile = open_package
+        try:
+            errors = integrity.verify_package(self.filepath, infos,
+                                              pool=self.pool, threads=2)
+        finally:
+            integrity.zipfile.ZipFile = ZipFile
+
+        self.assertEqual(errors, [])
+        self.assertEqual(opened, [self.filepath] * 2)
+
+    def test_unsafe_member_names(self):
+        self.assertRaises(ValueError, integrity.staging_pathname,
+                          '/tmp/foo', '../bar.xml')
+        self.assertRaises(ValueError, integrity.staging_pathname,
+                          '/tmp/foo', '/bar.xml')
+        self.assertEqual(integrity.staging_pathname('/tmp/foo', 'a/bar.xml'),
+                         '/tmp/foo/a/bar.xml')
+
+    def test_chunk_size_is_split_among_threads(self):
+        self.assertEqual(integrity.get_chunk_size(4, 4 * 1024 * 1024),
+                         1024 * 1024)
+        self.assertEqual(integrity.get_chunk_size(4, 1024),
+                         integrity.MIN_CHUNK_SIZE)
+
+    def test_packages_with_corrupted_members_are_marked_as_failed(self):
+        corrupt_member(self.filepath, 'a.xml')
+
+        self.assertIsNone(checkin.inspect_package(self.filepath))
+
+        path, name = os.path.split(self.filepath)
+        failed = os.path.join(path, utils.FAILED_PREFIX + name)
+        self.assertTrue(os.path.exists(failed))
+        os.rename(failed, self.filepath)
+
+
+class SaveValidationsFunctionTests(DatabaseTestCase):
+
+    def test_validations_are_inserted_at_once(self):
+        ses = models.Session()
+        attempt = models.Attempt(package_md5='foo')
+        ses.add(attempt)
+        ses.flush()
+
+        results = [{'label': 'foo', 'status': 'ok', 'description': None},
+                   {'label': 'bar', 'status': 'error', 'description': 'bar'}]
+        validationset = models.save_validations(ses, attempt, results)
+        ses.commit()
+
+        self.assertEqual(len(ses.identity_map), 2)
+        self.assertEqual(
+            sorted((v.label, v.status) for v in validationset.validations),
+            [('bar', 'error'), ('foo', 'ok')])
+
+
+class MembersFunctionsTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(MembersFunctionsTests, self).setUp()
+        self.ses = models.Session()
+        self.attempt = models.Attempt(package_md5='foo')
+        self.ses.add(self.attempt)
+        self.ses.flush()
+
+    def _member(self, name, extension, size):
+        return {'name': name, 'extension': extension, 'crc': 1,
+                'size': size, 'compressed_size': size // 2}
+
+    def test_members_are_inserted_at_once(self):
+        models.save_members(self.ses, self.attempt,
+            [self._member('a.xml', 'xml', 10), self._member('a.pdf', 'pdf', 20)])
+        self.ses.commit()
+
+        self.assertEqual(len(self.ses.identity_map), 1)
+        self.assertEqual(sorted(m.name for m in self.attempt.members),
+                         ['a.pdf', 'a.xml'])
+
+    def test_find_members_by_extension_and_size(self):
+        models.save_members(self.ses, self.attempt,
+            [self._member('a.tiff', 'tiff', 10),
+             self._member('b.tiff', 'tiff', 30),
+             self._member('c.tiff', 'tiff', 20),
+             self._member('a.pdf', 'pdf', 40)])
+
+        self.assertEqual(
+            [m.name for m in models.find_members(self.ses, 'TIFF', 20)],
+            ['b.tiff', 'c.tiff'])
+        self.assertEqual(
+            [m.name for m in models.find_members(self.ses, min_size=30)],
+            ['a.pdf', 'b.tiff'])
+
+
+class BatchWriterTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(BatchWriterTests, self).setUp()
+        self.clock = FakeClock()
+        self.results = []
+
+    def _make_writer(self, max_size=10, max_latency=1):
+        return models.BatchWriter(max_size, max_latency, clock=self.clock)
+
+    def _callback(self, result, error):
+        self.results.append((result, error))
+
+    def _create(self, md5):
+        return lambda session: models.get_or_create(
+            session, models.Attempt, package_md5=md5)
+
+    def _count(self):
+        return models.Session().query(models.Attempt).count()
+
+    def test_units_wait_for_the_batch(self):
+        writer = self._make_writer()
+        writer.add(self._create('foo'), self._callback)
+
+        self.assertEqual(self._count(), 0)
+        self.assertEqual(self.results, [])
+
+    def test_batch_is_written_when_full(self):
+        writer = self._make_writer(max_size=2)
+        writer.add(self._create('foo'), self._callback)
+        writer.add(self._create('bar'), self._callback)
+
+        self.assertEqual(self._count(), 2)
+        self.assertEqual([r.package_md5 for r, e in self.results],
+                         ['foo', 'bar'])
+
+    def test_batch_is_due_after_max_latency(self):
+        writer = self._make_writer(max_latency=1)
+        self.assertFalse(writer.is_due())
+
+        writer.add(self._create('foo'))
+        self.assertFalse(writer.is_due())
+        self.clock.now = 1
+        self.assertTrue(writer.is_due())
+
+        writer.flush()
+        self.assertFalse(writer.is_due())
+
+    def test_failures_affect_only_its_unit(self):
+        def fail(session):
+            session.add(models.Attempt(package_md5='baz'))
+            session.flush()
+            raise ValueError('invalid')
+
+        writer = self._make_writer()
+        writer.add(self._create('foo'), self._callback)
+        writer.add(fail, self._callback)
+        writer.add(self._create('bar'), self._callback)
+        writer.flush()
+
+        self.assertEqual(self._count(), 2)
+        self.assertIsNone(self.results[0][1])
+        self.assertIsInstance(self.results[1][1], ValueError)
+        self.assertIsNone(self.results[2][1])
+
+
+ARTICLEPKG_META = {
+    'article_title': 'Foo Bar',
+    'journal_pissn': '0034-8910',
+    'journal_eissn': '1518-8787',
+    'journal_title': 'Revista Foo',
+    'issue_year': 2013,
+    'issue_volume': 47,
+    'issue_number': 2,
+}
+
+
+class GetArticlePkgIdFunctionTests(DatabaseTestCase):
+
+    def _commit_articlepkg(self):
+        ses = models.Session()
+        articlepkg_id = models.get_articlepkg_id(ses, **ARTICLEPKG_META)
+        ses.commit()
+        return articlepkg_id
+
+    def test_new_rows_are_not_cached(self):
+        self._commit_articlepkg()
+
+        self.assertEqual(len(models.articlepkg_ids), 0)
+
+    def test_existing_rows_are_cached(self):
+        articlepkg_id = self._commit_articlepkg()
+        self._commit_articlepkg()
+
+        mock_session = self.mocker.mock()
+        self.mocker.replay()
+
+        self.assertEqual(
+            models.get_articlepkg_id(mock_session, **ARTICLEPKG_META),
+            articlepkg_id)
+
+    def test_deleted_rows_are_invalidated(self):
+        self._commit_articlepkg()
+        self._commit_articlepkg()
+
+        ses = models.Session()
+        ses.delete(ses.query(models.ArticlePkg).one())
+        ses.commit()
+
+        self.assertEqual(len(models.articlepkg_ids), 0)
+
+    def test_rollbacks_clear_the_cache(self):
+        self._commit_articlepkg()
+        ses = models.Session()
+        models.get_articlepkg_id(ses, **ARTICLEPKG_META)
+        ses.rollback()
+
+        self.assertEqual(len(models.articlepkg_ids), 0)
+
+
+class MigrateFunctionTests(mocker.MockerTestCase):
+    """
+    Upgrades the database structure of the first release.
+    """
+    def setUp(self):
+        models.get_engine().execute(
+            'CREATE TABLE articlepkg (id INTEGER PRIMARY KEY, '
+            'article_title VARCHAR NOT NULL, journal_pissn VARCHAR NOT NULL, '
+            'journal_eissn VARCHAR NOT NULL, journal_title VARCHAR NOT NULL, '
+            'issue_year INTEGER NOT NULL, issue_volume INTEGER NOT NULL, '
+            'issue_number INTEGER NOT NULL)')
+        models.get_engine().execute(
+            'CREATE TABLE attempt (id INTEGER PRIMARY KEY, '
+            'package_md5 VARCHAR(32) UNIQUE, articlepkg_id INTEGER, '
+            'started_at DATETIME NOT NULL, finished_at DATETIME, '
+            'collection_uri VARCHAR)')
+        models.get_engine().execute(
+            "INSERT INTO attempt (package_md5, started_at) "
+            "VALUES ('foo', '2013-06-11 00:00:00')")
+
+    def tearDown(self):
+        models.Base.metadata.drop_all(models.get_engine())
+
+    def test_missing_structure_is_created(self):
+        changes = models.migrate(models.get_engine())
+
+        self.assertIn('created table packagedigest', changes)
+        self.assertIn('added column attempt.package_fingerprint', changes)
+        self.assertIn('created index ix_attempt_started_at', changes)
+        self.assertIn('created index ix_articlepkg_natural_key', changes)
+
+        inspector = models.inspect(models.get_engine())
+        self.assertIn('package_fingerprint',
+            [col['name'] for col in inspector.get_columns('attempt')])
+
+    def test_data_is_kept(self):
+        models.migrate(models.get_engine())
+
+        attempt = models.Session().query(models.Attempt).one()
+        self.assertEqual(attempt.package_md5, 'foo')
+        self.assertIsNone(attempt.package_fingerprint)
+
+    def test_duplicate_articlepkgs_are_merged(self):
+        engine = models.get_engine()
+        for i in range(3):
+            engine.execute(
+                "INSERT INTO articlepkg (article_title, journal_pissn, "
+                "journal_eissn, journal_title, issue_year, issue_volume, "
+                "issue_number) VALUES ('Foo', '0034-8910', '1518-8787', "
+                "'Revista Foo', 2013, 47, %s)" % (1 if i < 2 else 2))
+            engine.execute(
+                "INSERT INTO attempt (package_md5, articlepkg_id, started_at) "
+                "VALUES ('md5-%s', %s, '2013-06-11 00:00:00')" % (i, i + 1))
+
+        changes = models.migrate(engine)
+
+        self.assertIn('merged 1 duplicate rows of articlepkg', changes)
+        self.assertIn('created index ix_articlepkg_natural_key', changes)
+        self.assertEqual(
+            engine.execute('SELECT id FROM articlepkg ORDER BY id').fetchall(),
+            [(1,), (3,)])
+        self.assertEqual(engine.execute(
+            'SELECT package_md5, articlepkg_id FROM attempt '
+            'WHERE articlepkg_id IS NOT NULL ORDER BY id').fetchall(),
+            [('md5-0', 1), ('md5-1', 1), ('md5-2', 3)])
+
+    def test_up_to_date_structure_is_untouched(self):
+        models.migrate(models.get_engine())
+
+        self.assertEqual(models.migrate(models.get_engine()), [])
+
+
+class GetEngineFunctionTests(mocker.MockerTestCase):
+
+    def test_engine_is_reused(self):
+        self.assertIs(models.get_engine(), models.get_engine())
+
+    def test_forked_processes_get_a_new_engine(self):
+        engine = models.get_engine()
+        mock_os = self.mocker.replace('os.getpid')
+        mock_os()
+        self.mocker.result(-1)
+        self.mocker.count(1, None)
+        self.mocker.replay()
+
+        self.assertIsNot(models.get_engine(), engine)
+        self.assertIn(engine, models._inherited_engines)
+
+
+class CreateConfiguredEngineFunctionTests(mocker.MockerTestCase):
+
+    def _make_settings(self, dsn, pre_ping):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('app')
+        for option, value in [('db_dsn', dsn), ('debug', 'False'),
+                              ('db_pool_size', '2'), ('db_max_overflow', '3'),
+                              ('db_pool_recycle', '60'),
+                              ('db_pool_pre_ping', pre_ping)]:
+            settings.set('app', option, value)
+
+        return settings
+
+    def test_pool_recycle(self):
+        engine = models.create_configured_engine(
+            self._make_settings('sqlite://', 'False'))
+
+        self.assertEqual(engine.pool._recycle, 60)
+
+    def test_pre_ping(self):
+        engine = models.create_configured_engine(
+            self._make_settings('sqlite://', 'True'))
+
+        self.assertEqual(engine.execute('SELECT 2').scalar(), 2)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every POST with 201, recording the requests and the
+    number of connections.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, dict(self.headers), body))
+
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+
+        status = 500 if self.path.startswith('/fail') else 201
+        response = 'created'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    # persistent connections must not block each other
+    daemon_threads = True
+
+
+class StandInServer(object):
+    """
+    An HTTP server running on a thread, at a random local port.
+    """
+    def __init__(self, handler=StandInHandler):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.requests = []
+        self.httpd.connections = 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.httpd.server_port
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class PooledRequestTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.pool_manager = notifier.PoolManager(2, 1, 1)
+
+    def tearDown(self):
+        self.pool_manager.close()
+        self.server.shutdown()
+
+    def _make_request(self, path='/'):
+        return notifier.Request(self.server.url + path, 'foo_user', 'foo_key',
+                                pool_manager_dep=self.pool_manager)
+
+    def test_response_body_is_read(self):
+        resp = self._make_request().post({'foo': 'bar'})
+
+        self.assertEqual(resp.code, 201)
+        self.assertEqual(resp.read(), 'created')
+
+    def test_data_and_headers_are_sent(self):
+        self._make_request('/checkins/').post({'foo': 'bar'})
+
+        path, headers, body = self.server.httpd.requests[0]
+        self.assertEqual(path, '/checkins/')
+        self.assertEqual(body, 'foo=bar')
+        self.assertEqual(headers['http_authorization'], 'ApiKey foo_user:foo_key')
+        self.assertEqual(headers['content-type'],
+                         'application/x-www-form-urlencoded')
+
+    def test_connections_are_reused(self):
+        req = self._make_request()
+        for i in range(3):
+            req.post({'foo': i})
+
+        self.assertEqual(len(self.server.httpd.requests), 3)
+        self.assertEqual(self.server.httpd.connections, 1)
+
+    def test_closed_idle_connections_are_replaced(self):
+        req = self._make_request()
+        req.post({'foo': 'bar'})
+        pool = self.pool_manager.get('http', self.server.url[len('http://'):])
+        pool._idle.queue[0].sock.close()
+
+        self.assertEqual(req.post({'foo': 'bar'}).code, 201)
+
+    def test_read_timeouts_are_not_retried(self):
+        self.pool_manager.read_timeout = 0.1
+        self._make_request().post({'foo': 'bar'})
+
+        self.assertRaises(socket.timeout,
+                          lambda: self._make_request('/slow/').post({'foo': 'bar'}))
+        time.sleep(0.6)
+        self.assertEqual(len(self.server.httpd.requests), 2)
+
+    def test_stale_errors(self):
+        self.assertTrue(notifier._is_stale(httplib.BadStatusLine('')))
+        self.assertTrue(notifier._is_stale(socket.error(errno.ECONNRESET, '')))
+        self.assertFalse(notifier._is_stale(socket.timeout('timed out')))
+
+    def test_http_errors_are_raised(self):
+        req = self._make_request('/fail/')
+
+        self.assertRaises(notifier.urllib2.HTTPError,
+                          lambda: req.post({'foo': 'bar'}))
+
+
+class NotifierStandInServerTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(NotifierStandInServerTests, self).setUp()
+        self.server = StandInServer()
+
+    def tearDown(self):
+        notifier.get_pool_manager().close()
+        self.server.shutdown()
+        super(NotifierStandInServerTests, self).tearDown()
+
+    def _make_settings(self):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('manager')
+        settings.set('manager', 'api_username', 'foo_user')
+        settings.set('manager', 'api_key', 'foo_key')
+        settings.set('manager', 'api_url', self.server.url)
+        return settings
+
+    def test_checkin_is_posted_by_the_sender(self):
+        settings = self._make_settings()
+        message = dict((field, 'foo') for field in notifier.CHECKIN_MESSAGE_FIELDS)
+        outbox = notifier.Outbox()
+        ntf = notifier.Notifier(settings, notifier.Request, outbox)
+        sender = notifier.OutboxSender.from_settings(ntf, settings, outbox)
+
+        ntf.checkin(message)
+        self.assertEqual(self.server.httpd.requests, [])
+
+        self.assertEqual(sender.send_batch(), (1, 0))
+        self.assertEqual(self.server.httpd.requests[0][0],
+                         '/articlepkg_checkins/')
+        self.assertEqual(outbox.pending_count(), 0)
+
+    def test_non_ascii_values_are_posted_as_utf8(self):
+        settings = self._make_settings()
+        message = dict((field, 'foo') for field in notifier.CHECKIN_MESSAGE_FIELDS)
+        message['article_title'] = u'Sa\xfade p\xfablica'
+        outbox = notifier.Outbox()
+        ntf = notifier.Notifier(settings, notifier.Request, outbox)
+        sender = notifier.OutboxSender.from_settings(ntf, settings, outbox)
+
+        ntf.checkin(message)
+
+        self.assertEqual(sender.send_batch(), (1, 0))
+        body = self.server.httpd.requests[0][2]
+        self.assertIn('article_title=Sa%C3%BAde+p%C3%BAblica', body)
+
+
+class FakeNotifier(object):
+    """
+    Fails to submit data to the endpoints starting with 'fail'.
+    """
+    def __init__(self):
+        self.submitted = []
+
+    def _submit(self, endpoint, data):
+        if endpoint.startswith('fail'):
+            raise IOError('Manager is down')
+        self.submitted.append((endpoint, data))
+
+
+class OutboxSenderTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(OutboxSenderTests, self).setUp()
+        self.now = datetime.datetime(2013, 6, 11)
+        self.outbox = notifier.Outbox(clock=lambda: self.now)
+        self.notifier = FakeNotifier()
+        self.sender = notifier.OutboxSender(self.notifier, self.outbox,
+            batch_size=2, retry_delay=1, max_retry_delay=10,
+            random_dep=lambda: 0.5)
+
+    def test_notifications_are_delivered_in_batches(self):
+        for i in range(3):
+            self.outbox.put('checkins', {'id': i})
+
+        self.assertEqual(self.sender.send_batch(), (2, 0))
+        self.assertEqual(self.sender.send_batch(), (1, 0))
+        self.assertEqual(self.sender.send_batch(), (0, 0))
+        self.assertEqual([data['id'] for _, data in self.notifier.submitted],
+                         [0, 1, 2])
+
+    def test_failures_are_retried_later(self):
+        self.outbox.put('fail', {'id': 1})
+
+        self.assertEqual(self.sender.send_batch(), (0, 1))
+        self.assertEqual(self.sender.send_batch(), (0, 0))
+
+        self.now += datetime.timedelta(seconds=1)
+        self.assertEqual(self.sender.send_batch(), (0, 1))
+        self.assertEqual(self.outbox.pending_count(), 1)
+
+    def test_failures_do_not_block_the_batch(self):
+        self.outbox.put('fail', {'id': 1})
+        self.outbox.put('checkins', {'id': 2})
+
+        self.assertEqual(self.sender.send_batch(), (1, 1))
+
+    def test_backoff_is_exponential_and_capped(self):
+        self.assertEqual([self.sender.backoff(attempts) for attempts in range(6)],
+                         [0.5, 1, 2, 4, 5, 5])
+
+    def test_claimed_notifications_are_not_sent_twice(self):
+        self.outbox.put('checkins', {'id': 1})
+        other = notifier.OutboxSender(self.notifier, self.outbox,
+            batch_size=2, retry_delay=1, max_retry_delay=10, lease=60)
+        notifications = self.outbox.due(2)
+
+        self.assertEqual(len(self.outbox.claim(notifications, 60)), 1)
+        self.assertEqual(self.outbox.claim(notifications, 60), [])
+        self.assertEqual(other.send_batch(), (0, 0))
+        self.assertEqual(self.notifier.submitted, [])
+
+    def test_expired_claims_are_due_again(self):
+        self.outbox.put('checkins', {'id': 1})
+        self.outbox.claim(self.outbox.due(2), 60)
+
+        self.now += datetime.timedelta(seconds=60)
+        self.assertEqual(self.sender.send_batch(), (1, 0))
+
+    def test_undelivered_notifications_survive_restarts(self):
+        self.outbox.put('checkins', {'id': 1})
+        sender = notifier.OutboxSender(self.notifier, notifier.Outbox(),
+            batch_size=2, retry_delay=1, max_retry_delay=10)
+
+        self.assertEqual(sender.send_batch(), (1, 0))
+
+
+class FakeBulkNotifier(FakeNotifier):
+    """
+    Fails to submit in bulk the messages without an id.
+    """
+    def __init__(self):
+        super(FakeBulkNotifier, self).__init__()
+        self.bulks = []
+
+    def _submit_bulk(self, endpoint, messages, compress=False):
+        self.bulks.append((endpoint, messages))
+        return [None if 'id' in message else 'missing id'
+                for message in messages]
+
+
+class BulkOutboxSenderTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(BulkOutboxSenderTests, self).setUp()
+        self.now = datetime.datetime(2013, 6, 11)
+        self.outbox = notifier.Outbox(clock=lambda: self.now)
+        self.notifier = FakeBulkNotifier()
+        self.sender = notifier.OutboxSender(self.notifier, self.outbox,
+            batch_size=2, retry_delay=1, max_retry_delay=10,
+            bulk_max_size=3, bulk_max_latency=5, random_dep=lambda: 0.5)
+
+    def test_batch_size_fits_a_bulk_request(self):
+        self.assertEqual(self.sender.batch_size, 3)
+
+    def test_full_bulks_are_sent_in_a_single_request(self):
+        for i in range(4):
+            self.outbox.put('articlepkg_checkins', {'id': i})
+
+        self.assertEqual(self.sender.send_batch(), (3, 0))
+        self.assertEqual(len(self.notifier.bulks), 1)
+        self.assertEqual(self.outbox.pending_count(), 1)
+
+    def test_partial_bulks_wait_for_the_max_latency(self):
+        self.outbox.put('articlepkg_checkins', {'id': 1})
+
+        self.assertEqual(self.sender.send_batch(), (0, 0))
+
+        self.now += datetime.timedelta(seconds=5)
+        self.assertEqual(self.sender.send_batch(), (1, 0))
+        self.assertEqual(self.notifier.bulks,
+                         [('articlepkg_checkins', [{'id': 1}])])
+
+    def test_failures_are_handled_per_item(self):
+        self.outbox.put('articlepkg_checkins', {'id': 1})
+        self.outbox.put('articlepkg_checkins', {'foo': 'bar'})
+        self.outbox.put('articlepkg_checkins', {'id': 3})
+
+        self.assertEqual(self.sender.send_batch(), (2, 1))
+        self.assertEqual(self.outbox.pending_count(), 1)
+
+    def test_other_endpoints_are_sent_one_by_one(self):
+        self.outbox.put('checkins', {'id': 1})
+
+        self.assertEqual(self.sender.send_batch(), (1, 0))
+        self.assertEqual(self.notifier.submitted, [('checkins', {'id': 1})])
+        self.assertEqual(self.notifier.bulks, [])
+
+
+class FakeManagerTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.manager = fakemanager.FakeManager()
+        self.pool_manager = notifier.PoolManager(2, 1, 1)
+
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('manager')
+        settings.set('manager', 'api_username', 'foo_user')
+        settings.set('manager', 'api_key', 'foo_key')
+        settings.set('manager', 'api_url', self.manager.url)
+
+        def request(url, username, apikey):
+            return notifier.Request(url, username, apikey,
+                                    pool_manager_dep=self.pool_manager)
+
+        self.notifier = notifier.Notifier(settings, request, notifier.Outbox())
+        self.message = dict((field, 'foo')
+                            for field in notifier.CHECKIN_MESSAGE_FIELDS)
+
+    def tearDown(self):
+        self.pool_manager.close()
+        self.manager.shutdown()
+
+    def test_single_submission(self):
+        self.notifier._submit('articlepkg_checkins', self.message)
+
+        self.assertEqual(self.manager.httpd.requests, 1)
+        self.assertEqual(self.manager.httpd.messages, 1)
+
+    def test_bulk_submission(self):
+        errors = self.notifier._submit_bulk('articlepkg_checkins',
+                                            [self.message] * 3)
+
+        self.assertEqual(errors, [None, None, None])
+        self.assertEqual(self.manager.httpd.requests, 1)
+        self.assertEqual(self.manager.httpd.messages, 3)
+
+    def test_gzipped_bulk_submission(self):
+        errors = self.notifier._submit_bulk('articlepkg_checkins',
+                                            [self.message], compress=True)
+
+        self.assertEqual(errors, [None])
+
+    def test_gzipped_bulk_submission_to_unicode_endpoints(self):
+        errors = self.notifier._submit_bulk(u'articlepkg_checkins',
+                                            [self.message], compress=True)
+
+        self.assertEqual(errors, [None])
+
+    def test_bulk_results_are_per_item(self):
+        errors = self.notifier._submit_bulk('articlepkg_checkins',
+                                            [self.message, {'foo': 'bar'}])
+
+        self.assertEqual(errors[0], None)
+        self.assertTrue(errors[1].startswith('missing fields'))
+
+
+class GetMonitorsArgsFunctionTests(mocker.MockerTestCase):
+
+    def _make_settings(self, sharding, monitors='', workers=''):
+        settings = ConfigParser.ConfigParser()
+        settings.add_section('monitor')
+        settings.set('monitor', 'watch_path', '/a,/b,/c')
+        settings.set('monitor', 'workers', workers)
+        settings.add_section('supervisor')
+        settings.set('supervisor', 'sharding', sharding)
+        settings.set('supervisor', 'monitors', monitors)
+        return settings
+
+    def test_one_monitor_per_path(self):
+        self.assertEqual(
+            balaio.get_monitors_args(self._make_settings('path', workers='2')),
+            [['--watch-path', '/a'], ['--watch-path', '/b'],
+             ['--watch-path', '/c']])
+
+    def test_paths_are_split_among_the_monitors(self):
+        self.assertEqual(
+            balaio.get_monitors_args(self._make_settings('path', '2', '2')),
+            [['--watch-path', '/a', '--watch-path', '/c'],
+             ['--watch-path', '/b']])
+
+    def test_hash_shards(self):
+        self.assertEqual(
+            balaio.get_monitors_args(self._make_settings('hash', workers='2'),
+                                     cpu_count=lambda: 2),
+            [['--shard', '0/2'], ['--shard', '1/2']])
+
+    def test_cpus_are_split_among_the_monitors(self):
+        self.assertEqual(
+            balaio.get_monitors_args(self._make_settings('hash', '2'),
+                                     cpu_count=lambda: 8),
+            [['--shard', '0/2', '--workers', '4'],
+             ['--shard', '1/2', '--workers', '4']])
+
+    def test_unknown_sharding(self):
+        self.assertRaises(ValueError, balaio.get_monitors_args,
+                          self._make_settings('foo'))
+
+
+class FakeProcess(object):
+    """
+    A monitor process whose stdout is a pipe.
+    """
+    def __init__(self, args):
+        self.args = args
+        rfd, self.wfd = os.pipe()
+        self.stdout = os.fdopen(rfd, 'rb')
+        self.returncode = None
+        self.signals = []
+
+    def poll(self):
+        return self.returncode
+
+    def exit(self, returncode):
+        self.returncode = returncode
+        os.close(self.wfd)
+
+    def send_signal(self, signum):
+        self.signals.append(signum)
+        self.exit(-signum)
+
+    def send(self, message):
+        stream = io.BytesIO()
+        utils.send_frame(stream, message, utils.Signer())
+        os.write(self.wfd, stream.getvalue())
+
+
+class SupervisorTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.processes = []
+
+        def spawn(args, stdout=None):
+            process = FakeProcess(args)
+            self.processes.append(process)
+            return process
+
+        self.supervisor = balaio.Supervisor([['--shard', '0/2'],
+                                             ['--shard', '1/2']],
+            restart_delay=1, max_restart_delay=8, spawn_dep=spawn,
+            clock=self.clock)
+        self.supervisor.start()
+
+    def tearDown(self):
+        for process in self.processes:
+            process.stdout.close()
+            if process.returncode is None:
+                os.close(process.wfd)
+
+    def test_messages_are_aggregated(self):
+        self.processes[0].send('foo')
+        self.processes[1].send('bar')
+
+        messages = []
+        while len(messages) < 2:
+            messages.extend(self.supervisor.poll(1))
+
+        self.assertEqual(sorted(messages), [(0, 'foo'), (1, 'bar')])
+
+    def test_crashed_monitors_are_restarted_with_backoff(self):
+        self.processes[0].exit(1)
+
+        self.supervisor.check()
+        self.assertEqual(len(self.processes), 2)
+
+        self.clock.now = 1
+        self.assertEqual(self.supervisor.check(), 1)
+        self.assertEqual(self.processes[2].args, ['--shard', '0/2'])
+
+        self.processes[2].exit(1)
+        self.supervisor.check()
+        self.clock.now = 2
+        self.assertEqual(self.supervisor.check(), 0)
+        self.clock.now = 3
+        self.assertEqual(self.supervisor.check(), 1)
+
+    def test_failures_are_forgotten_after_a_while(self):
+        self.processes[0].exit(1)
+        self.supervisor.check()
+        self.clock.now = 1
+        self.supervisor.check()
+
+        self.clock.now = 10
+        self.processes[2].exit(1)
+        self.supervisor.check()
+        self.assertEqual(self.supervisor.children[0].restart_at, 11)
+
+    def test_backoff_is_capped(self):
+        self.assertEqual([self.supervisor.backoff(failures)
+                          for failures in range(5)], [1, 2, 4, 8, 8])
+
+    def test_stop_propagates_the_signal(self):
+        self.processes[0].send('foo')
+        messages = self.supervisor.stop()
+
+        self.assertEqual([process.signals for process in self.processes],
+                         [[balaio.signal.SIGTERM], [balaio.signal.SIGTERM]])
+        self.assertEqual(messages, [(0, 'foo')])
+
+
+class SupervisorSenderTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.senders = []
+
+        def spawn_sender(args):
+            process = FakeProcess(args)
+            self.senders.append(process)
+            return process
+
+        self.supervisor = balaio.Supervisor([], restart_delay=1,
+            sender=True, sender_spawn_dep=spawn_sender, clock=self.clock)
+        self.supervisor.start()
+
+    def tearDown(self):
+        for process in self.senders:
+            process.stdout.close()
+            if process.returncode is None:
+                os.close(process.wfd)
+
+    def test_sender_is_restarted(self):
+        self.assertEqual(len(self.senders), 1)
+        self.senders[0].exit(1)
+
+        self.supervisor.check()
+        self.clock.now = 1
+        self.assertEqual(self.supervisor.check(), 1)
+        self.assertEqual(len(self.senders), 2)
+
+    def test_sender_is_stopped(self):
+        self.supervisor.stop()
+
+        self.assertEqual(self.senders[0].signals, [balaio.signal.SIGTERM])
+
+    def test_sender_needs_the_manager_url(self):
+        settings = ConfigParser.ConfigParser()
+        settings.read(os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'config-test.ini'))
+        settings.set('monitor', 'watch_path', '/tmp')
+
+        self.assertEqual(len(balaio.Supervisor.from_settings(settings).children), 1)
+        settings.set('manager', 'api_url', 'http://localhost:8000/api/v1')
+        supervisor = balaio.Supervisor.from_settings(settings)
+        self.assertEqual([child.key for child in supervisor.children],
+                         [0, 'sender'])
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class PublisherTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'bus.sock')
+        self.signer = utils.Signer()
+        self.receiver = utils.FrameReceiver(self.signer)
+        self.sockets = []
+
+    def tearDown(self):
+        self.publisher.close(timeout=0)
+        for sock in self.sockets:
+            sock.close()
+        self.receiver.close()
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def _publish(self, *args, **kwargs):
+        self.publisher = bus.Publisher(self.path, *args, **kwargs)
+
+    def _subscribe(self, key):
+        sock = bus.subscribe(self.path)
+        self.sockets.append(sock)
+        self.receiver.register(sock, key)
+        wait_until(lambda: self.publisher.subscribers == len(self.sockets))
+        return sock
+
+    def _receive(self, count):
+        messages = []
+        while len(messages) < count:
+            messages.extend(self.receiver.poll(1))
+        return sorted(messages)
+
+    def test_messages_are_fanned_out(self):
+        self._publish()
+        self._subscribe('supervisor')
+        self._subscribe('exporter')
+
+        utils.send_frame(self.publisher, 'foo', self.signer)
+
+        self.assertEqual(self._receive(2),
+                         [('exporter', 'foo'), ('supervisor', 'foo')])
+
+    def test_writes_are_published_on_flush(self):
+        self._publish()
+        self._subscribe('supervisor')
+
+        utils.send_message(self.publisher, 'foo', utils.make_digest)
+
+        self.assertEqual(self.publisher.published, 1)
+
+    def test_slow_consumers_do_not_block_the_publisher(self):
+        self._publish(max_buffer=64 * 1024)
+        self._subscribe('stalled')
+
+        for i in range(1000):
+            utils.send_frame(self.publisher, 'x' * 1024, self.signer)
+
+        self.assertEqual(self.publisher.published, 1000)
+        self.assertTrue(self.publisher.dropped > 0)
+
+    def test_slow_consumers_may_be_disconnected(self):
+        self._publish(max_buffer=64 * 1024, policy='disconnect')
+        self._subscribe('stalled')
+
+        for i in range(1000):
+            utils.send_frame(self.publisher, 'x' * 1024, self.signer)
+
+        self.assertEqual(self.publisher.disconnected, 1)
+        self.assertEqual(self.publisher.subscribers, 0)
+
+    def test_messages_are_held_until_a_subscriber_connects(self):
+        self._publish()
+        for message in ['foo', 'bar']:
+            utils.send_frame(self.publisher, message, self.signer)
+        self._subscribe('supervisor')
+        utils.send_frame(self.publisher, 'baz', self.signer)
+
+        self.assertEqual(self._receive(3), [('supervisor', 'bar'),
+            ('supervisor', 'baz'), ('supervisor', 'foo')])
+
+    def test_held_messages_are_bounded(self):
+        self._publish(max_buffer=64 * 1024)
+        for i in range(100):
+            utils.send_frame(self.publisher, 'x' * 1024, self.signer)
+
+        self.assertTrue(self.publisher.dropped > 0)
+
+    def test_hung_up_subscribers_are_removed(self):
+        self._publish()
+        self.receiver.unregister(self._subscribe('supervisor'))
+        self.sockets.pop().close()
+
+        wait_until(lambda: self.publisher.subscribers == 0)
+
+    def test_unknown_policy(self):
+        self.publisher = bus.Publisher(self.path)
+        self.assertRaises(ValueError, bus.Publisher, self.path + '2',
+                          policy='foo')
+
+    def test_subscribe_without_publisher(self):
+        self._publish()
+        self.assertRaises(bus.socket.error, bus.subscribe, self.path + '2')
+
+
+class SupervisorBusTests(mocker.MockerTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.processes = []
+
+        def spawn(args, stdout=None):
+            process = FakeProcess(args)
+            self.processes.append(process)
+            return process
+
+        self.supervisor = balaio.Supervisor([[]],
+            bus_path=os.path.join(self.tmpdir, 'bus'), spawn_dep=spawn)
+        self.supervisor.start()
+
+    def tearDown(self):
+        for process in self.processes:
+            process.stdout.close()
+            os.close(process.wfd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_messages_are_read_from_the_bus(self):
+        bus_path = os.path.join(self.tmpdir, 'bus.0')
+        self.assertEqual(self.processes[0].args, ['--bus-path', bus_path])
+
+        # the monitor is not listening yet
+        self.supervisor.check()
+        self.assertEqual(self.supervisor.children[0].subscription, None)
+
+        publisher = bus.Publisher(bus_path)
+        try:
+            self.supervisor.check()
+            wait_until(lambda: publisher.subscribers == 1)
+            utils.send_frame(publisher, 'foo', utils.Signer())
+
+            self.assertEqual(self.supervisor.poll(1), [(0, 'foo')])
+        finally:
+            publisher.close()
+            self.supervisor._unsubscribe(self.supervisor.children[0])
+            self.supervisor.receiver.close()
@@ -1,18 +1,35 @@
 import types
+import io
 import os
 from ConfigParser import SafeConfigParser
 import weakref
 import hmac
 import hashlib
+import struct
+import select
+import errno
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 import threading
+from collections import OrderedDict
+from cStringIO import StringIO
 
 
 stdout_lock = threading.Lock()
 
+FAILED_PREFIX = '_failed_'
+
+# size of the chunks used to read packages
+READ_BUFFER_SIZE = 256 * 1024
+
+# binary frames: magic, version, payload length and the raw HMAC-SHA1
+# of the payload, followed by the payload.
+FRAME_MAGIC = 'BL'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('!2sBxI20s')
+
 
 class SingletonMixin(object):
     """
@@ -72,6 +89,85 @@ class Configuration(SingletonMixin):
         return getattr(self.conf, attr)
 
 
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping that evicts the least recently
+    used keys, counting hits, misses and evictions.
+    """
+    def __init__(self, maxsize):
+        """
+        ``maxsize`` is the max number of keys held.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Forgets ``key``, if present.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_value(self, value):
+        """
+        Forgets all keys mapped to ``value``.
+        """
+        with self._lock:
+            for key in [k for k, v in self._data.iteritems() if v == value]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data)}
+
+
+def get_extension(filename):
+    """
+    Returns the lowercase extension of ``filename``, without the dot,
+    or None if it has none. Used to classify the package members.
+    """
+    basename = filename.rsplit('/', 1)[-1]
+    if '.' not in basename:
+        return None
+
+    return basename.rsplit('.', 1)[1].lower()
+
+
 def make_digest(message, secret='sekretz'):
     """
     Returns a digest for the message based on the given secret
@@ -79,22 +175,52 @@ def make_digest(message, secret='sekretz'):
     ``message`` is the file object or byte string to be calculated
     ``secret`` is a shared key used by the hash algorithm
     """
-    hash = hmac.new(secret, '', hashlib.sha1)
-
     if hasattr(message, 'read'):
-        while True:
-            chunk = message.read(1024)
-            if not chunk:
-                break
-            hash.update(chunk)
+        digest, _ = make_digest_and_size(message, secret)
+        return digest
 
     elif isinstance(message, types.StringType):
+        hash = hmac.new(secret, '', hashlib.sha1)
         hash.update(message)
+        return hash.hexdigest()
 
     else:
         raise TypeError('Unsupported type %s' % type(message))
 
-    return hash.hexdigest()
+
+def make_digest_and_size(fp, secret='sekretz', bufsize=READ_BUFFER_SIZE):
+    """
+    Reads ``fp`` once, returning a tuple with its digest based on the
+    given secret and its size in bytes.
+
+    When ``fp`` supports ``readinto``, a single buffer is reused for
+    all reads.
+
+    ``fp`` is the file object to be calculated
+    ``secret`` is a shared key used by the hash algorithm
+    ``bufsize`` is the size of each read
+    """
+    hash = hmac.new(secret, '', hashlib.sha1)
+    size = 0
+
+    if hasattr(fp, 'readinto'):
+        buf = bytearray(bufsize)
+        view = memoryview(buf)
+        while True:
+            count = fp.readinto(buf)
+            if not count:
+                break
+            hash.update(view[:count])
+            size += count
+    else:
+        while True:
+            chunk = fp.read(bufsize)
+            if not chunk:
+                break
+            hash.update(chunk)
+            size += len(chunk)
+
+    return hash.hexdigest(), size
 
 
 def make_digest_file(filepath, secret='sekretz'):
@@ -104,7 +230,7 @@ def make_digest_file(filepath, secret='sekretz'):
     ``filepath`` is the file to have its bytes calculated
     ``secret`` is a shared key used by the hash algorithm
     """
-    with open(filepath, 'rb') as f:
+    with io.open(filepath, 'rb', buffering=0) as f:
         digest = make_digest(f, secret)
 
     return digest
@@ -164,6 +290,319 @@ def recv_messages(stream, digest, pickle_dep=pickle):
             continue
 
 
+class Signer(object):
+    """
+    Computes HMAC-SHA1 digests from a prebuilt HMAC object, that is
+    copied for each message instead of created from scratch.
+    """
+    def __init__(self, secret='sekretz'):
+        """
+        ``secret`` is a shared key used by the hash algorithm
+        """
+        self._hmac = hmac.new(secret, '', hashlib.sha1)
+
+    def sign(self, data):
+        """
+        Returns the raw digest of ``data``, a byte string or a buffer.
+        """
+        hash = self._hmac.copy()
+        hash.update(data)
+        return hash.digest()
+
+    def verify(self, data, digest):
+        return hmac.compare_digest(self.sign(data), digest)
+
+
+def send_frame(stream, message, signer, pickle_dep=pickle):
+    """
+    Serializes the message and flushes it through ``stream``, in a
+    binary frame. Writes to stream are synchronized in order to keep
+    data integrity.
+
+    ``stream`` is a writable socket, pipe, buffer of something like that.
+    ``message`` is the object to be dispatched.
+    ``signer`` is a Signer instance.
+    """
+    serialized = pickle_dep.dumps(message, pickle_dep.HIGHEST_PROTOCOL)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, len(serialized),
+                               signer.sign(serialized))
+
+    with stdout_lock:
+        stream.write(header + serialized)
+        stream.flush()
+
+
+def _readinto_exactly(stream, view):
+    """
+    Fills ``view`` with data read from ``stream``. Returns False if
+    the stream is exhausted before.
+    """
+    filled = 0
+    size = len(view)
+    while filled < size:
+        if hasattr(stream, 'readinto'):
+            count = stream.readinto(view[filled:])
+        else:
+            chunk = stream.read(size - filled)
+            count = len(chunk)
+            view[filled:filled + count] = chunk
+
+        if not count:
+            return False
+        filled += count
+
+    return True
+
+
+def recv_frames(stream, signer, pickle_dep=pickle):
+    """
+    Returns an iterator that retrieves messages written by
+    ``send_frame`` from the ``stream`` on its deserialized form.
+    When the stream is exhausted the iterator stops, raising
+    StopIteration.
+
+    Payloads are read into a single buffer, that is reused while
+    large enough, and are not copied before being deserialized.
+
+    ``stream`` is a readable socket, pipe, buffer of something like that.
+    ``signer`` is a Signer instance.
+    """
+    header = bytearray(FRAME_HEADER.size)
+    header_view = memoryview(header)
+    payload = bytearray(READ_BUFFER_SIZE)
+
+    while True:
+        if not _readinto_exactly(stream, header_view):
+            raise StopIteration()
+
+        magic, version, length, in_digest = FRAME_HEADER.unpack_from(header)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise ValueError('Unsupported frame %r version %s' % (magic, version))
+
+        if length > len(payload):
+            payload = bytearray(length)
+        view = memoryview(payload)[:length]
+
+        if not _readinto_exactly(stream, view):
+            raise StopIteration()
+
+        if signer.verify(view, in_digest):
+            yield pickle_dep.load(StringIO(view))
+        else:
+            # log the failure
+            continue
+
+
+class FrameDecoder(object):
+    """
+    Reassembles the frames written by ``send_frame`` from chunks of
+    arbitrary sizes, e.g. the partial reads of a pipe.
+    """
+    def __init__(self, signer, pickle_dep=pickle):
+        """
+        ``signer`` is a Signer instance.
+        """
+        self._signer = signer
+        self._pickle = pickle_dep
+        self._buffer = bytearray()
+        self._offset = 0
+
+        self.corrupted = 0
+        self.skipped = 0
+
+    def _decode(self, start, length, in_digest):
+        payload = memoryview(self._buffer)[start:start + length]
+        if self._signer.verify(payload, in_digest):
+            return True, self._pickle.load(StringIO(payload))
+
+        self.corrupted += 1
+        return False, None
+
+    def _resync(self):
+        """
+        Skips the bytes up to the next frame magic, e.g. after stray
+        writes to the stream.
+        """
+        position = self._buffer.find(FRAME_MAGIC, self._offset + 1)
+        if position == -1:
+            # the last byte may start a magic
+            position = max(self._offset + 1,
+                           len(self._buffer) - len(FRAME_MAGIC) + 1)
+
+        self.skipped += position - self._offset
+        self._offset = position
+
+    def feed(self, data):
+        """
+        Appends ``data`` to the buffer and returns the list of messages
+        whose frames are complete. Bytes that are not part of a frame
+        are skipped.
+        """
+        self._buffer.extend(data)
+        messages = []
+
+        while True:
+            available = len(self._buffer) - self._offset
+            if available < FRAME_HEADER.size:
+                break
+
+            magic, version, length, in_digest = FRAME_HEADER.unpack_from(
+                self._buffer, self._offset)
+            if magic != FRAME_MAGIC or version != FRAME_VERSION:
+                self._resync()
+                continue
+
+            if available < FRAME_HEADER.size + length:
+                break
+
+            start = self._offset + FRAME_HEADER.size
+            is_valid, message = self._decode(start, length, in_digest)
+            if is_valid:
+                messages.append(message)
+            self._offset = start + length
+
+        # drop the consumed frames, keeping the partial one
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+        return messages
+
+    @property
+    def pending(self):
+        """
+        Number of bytes of incomplete frames.
+        """
+        return len(self._buffer)
+
+
+class _Poller(object):
+    """
+    Readiness notification for reading, backed by select.epoll when
+    available, or select.poll.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._flags = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._flags = select.POLLIN | select.POLLHUP | select.POLLERR
+            self._scale = 1000
+
+    def register(self, fd):
+        self._poller.register(fd, self._flags)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """
+        Returns the ready file descriptors. ``timeout`` is in seconds,
+        None blocks until one is ready.
+        """
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self._scale
+
+        while True:
+            try:
+                return [fd for fd, event in self._poller.poll(timeout)]
+            except (IOError, select.error), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+
+class FrameReceiver(object):
+    """
+    Receives the frames written by ``send_frame`` to many streams,
+    e.g. the stdout of many child processes, from a single thread.
+
+    Streams are read in large chunks as soon as they have data, so a
+    slow or stalled writer does not block the others. Exhausted
+    streams are unregistered.
+    """
+    def __init__(self, signer, pickle_dep=pickle, chunk_size=READ_BUFFER_SIZE):
+        """
+        ``signer`` is a Signer instance.
+        ``chunk_size`` is the max number of bytes read at once.
+        """
+        self._signer = signer
+        self._pickle = pickle_dep
+        self.chunk_size = chunk_size
+        self._poller = _Poller()
+        # fd -> (key, decoder)
+        self._streams = {}
+
+    def register(self, stream, key=None):
+        """
+        ``stream`` is a file object or a file descriptor.
+        ``key`` identifies the stream in the received messages.
+        Defaults to the stream itself.
+        """
+        fd = stream if isinstance(stream, int) else stream.fileno()
+        self._streams[fd] = (stream if key is None else key,
+                             FrameDecoder(self._signer, self._pickle))
+        self._poller.register(fd)
+
+    def unregister(self, stream):
+        """
+        Stops reading ``stream``, if registered.
+        """
+        fd = stream if isinstance(stream, int) else stream.fileno()
+        if self._streams.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def keys(self):
+        return [key for key, decoder in self._streams.values()]
+
+    def __len__(self):
+        return len(self._streams)
+
+    def poll(self, timeout=None):
+        """
+        Reads the streams that are ready and returns a list of
+        (key, message) tuples, for the frames that were completed.
+
+        ``timeout`` is the max number of seconds to wait. None blocks
+        until a stream is ready.
+        """
+        received = []
+        for fd in self._poller.poll(timeout):
+            key, decoder = self._streams[fd]
+            try:
+                data = os.read(fd, self.chunk_size)
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                data = ''
+
+            if data:
+                received.extend((key, message)
+                                for message in decoder.feed(data))
+            else:
+                self.unregister(fd)
+
+        return received
+
+    def __iter__(self):
+        """
+        Yields (key, message) tuples until every stream is exhausted.
+        """
+        while self._streams:
+            for item in self.poll():
+                yield item
+
+    def close(self):
+        self._poller.close()
+
+
 def prefix_file(filename, prefix):
     """
     Renames ``filename`` adding the prefix ``prefix``.
@@ -174,4 +613,4 @@ def prefix_file(filename, prefix):
 
 
 def mark_as_failed(filename):
-    prefix_file(filename, '_failed_')
+    prefix_file(filename, FAILED_PREFIX)
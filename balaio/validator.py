@@ -0,0 +1,387 @@
+# coding: utf-8
+"""
+Checks run on the packages after they are checked in.
+
+Validators are registered at ``registry`` and run concurrently by
+``run_validators``, sharing the package already opened and parsed by
+the caller.
+"""
+import os
+import re
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+import utils
+
+
+config = utils.Configuration.from_env()
+
+STATUSES = ('ok', 'warning', 'error')
+
+XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+
+# tags whose xlink:href refers to a member of the package
+MEMBER_REFERENCE_TAGS = ('graphic', 'inline-graphic', 'media',
+                         'supplementary-material')
+
+# label -> Validator instance, in the order of registration
+registry = OrderedDict()
+
+
+def register(validator_class):
+    """
+    Class decorator that adds an instance of ``validator_class`` to
+    the registry.
+    """
+    registry[validator_class.label] = validator_class()
+    return validator_class
+
+
+class Validator(object):
+    """
+    A check run on a package. Subclasses set ``label`` and implement
+    ``validate``.
+
+    ``inputs`` lists the extensions of the members the check depends
+    on, or is None if it depends on all of them. A resubmitted package
+    whose inputs did not change reuses the previous result.
+    """
+    label = None
+    inputs = None
+
+    def validate(self, package):
+        """
+        Returns a (status, description) tuple, where status is one
+        of STATUSES.
+
+        ``package`` is a checkin.PackageAnalyzer whose xml is already
+        parsed. Validators run concurrently, so the package members
+        must not be read.
+        """
+        raise NotImplementedError()
+
+
+def is_valid_issn(issn):
+    """
+    Tells if ``issn`` is in the form NNNN-NNNC with a valid check digit.
+    """
+    if not issn or not re.match(r'^\d{4}-\d{3}[\dX]$', issn):
+        return False
+
+    digits = issn.replace('-', '')
+    total = sum(int(digit) * weight
+                for digit, weight in zip(digits[:7], range(8, 1, -1)))
+    check = (11 - total % 11) % 11
+    return digits[7] == ('X' if check == 10 else str(check))
+
+
+@register
+class JournalISSNValidator(Validator):
+    label = 'journal_issn'
+    inputs = ('xml',)
+
+    def validate(self, package):
+        meta = package.meta
+        issns = [meta[field] for field in ('journal_pissn', 'journal_eissn')
+                 if meta[field]]
+
+        if not issns:
+            return 'error', 'missing journal issn'
+
+        invalid = [issn for issn in issns if not is_valid_issn(issn)]
+        if invalid:
+            return 'error', 'invalid issn: %s' % ', '.join(invalid)
+
+        return 'ok', None
+
+
+@register
+class ArticleTitleValidator(Validator):
+    label = 'article_title'
+    inputs = ('xml',)
+
+    def validate(self, package):
+        title = package.meta['article_title']
+        if not title or not title.strip():
+            return 'error', 'missing article title'
+
+        return 'ok', None
+
+
+@register
+class IssueYearValidator(Validator):
+    label = 'issue_year'
+    inputs = ('xml',)
+
+    def validate(self, package):
+        year = package.meta['issue_year']
+        if not year or not re.match(r'^\d{4}$', year.strip()):
+            return 'error', 'invalid issue year: %r' % year
+
+        return 'ok', None
+
+
+@register
+class PDFValidator(Validator):
+    """
+    Each xml must have a pdf with the same name.
+    """
+    label = 'xml_pdf_pair'
+    inputs = ('xml', 'pdf')
+
+    def validate(self, package):
+        pdfs = set(os.path.splitext(name)[0] for name in package.get_ext('pdf'))
+        unpaired = [name for name in package.get_ext('xml')
+                    if os.path.splitext(name)[0] not in pdfs]
+
+        if unpaired:
+            return 'warning', 'missing pdf for: %s' % ', '.join(unpaired)
+
+        return 'ok', None
+
+
+@register
+class MemberReferencesValidator(Validator):
+    """
+    The files referenced by the xml must be members of the package.
+    Extensions may be omitted.
+    """
+    label = 'member_references'
+    inputs = None
+
+    def validate(self, package):
+        names = set()
+        for name, crc, size in package.members:
+            names.add(name)
+            names.add(os.path.splitext(name)[0])
+
+        missing = []
+        for element in package.xml.getroot().iter():
+            if element.tag in MEMBER_REFERENCE_TAGS:
+                href = element.get(XLINK_HREF)
+                if href and href not in names:
+                    missing.append(href)
+
+        if missing:
+            return 'error', 'missing members: %s' % ', '.join(missing)
+
+        return 'ok', None
+
+
+def load_schema(path):
+    """
+    Returns the compiled schema at ``path``, a W3C XML Schema (.xsd),
+    RELAX NG (.rng) or DTD (.dtd) file.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.dtd':
+        return lxml_etree.DTD(path)
+    elif ext == '.rng':
+        return lxml_etree.RelaxNG(lxml_etree.parse(path))
+    elif ext == '.xsd':
+        return lxml_etree.XMLSchema(lxml_etree.parse(path))
+    else:
+        raise ValueError('Unsupported schema %s' % path)
+
+
+class SchemaCache(object):
+    """
+    Compiled schemas by SPS version. Each one is compiled on its first
+    use and kept for the lifetime of the process. Processes forked
+    after ``warm`` is called inherit the compiled schemas.
+    """
+    def __init__(self, paths, loader=load_schema):
+        """
+        ``paths`` is a mapping of SPS versions to schema files.
+        ``loader`` compiles the schema of a given file.
+        """
+        self.paths = dict(paths)
+        self._loader = loader
+        self._lock = threading.Lock()
+        # version -> (schema, lock)
+        self._schemas = {}
+
+        self.loads = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        The schemas are listed at the ``[schemas]`` section, as
+        ``version=path`` options.
+        """
+        if not settings.has_section('schemas'):
+            return cls({})
+
+        return cls(settings.items('schemas'))
+
+    def get(self, version):
+        """
+        Returns a tuple with the compiled schema of ``version`` and the
+        lock that must be held while using it. Raises KeyError for
+        unknown versions.
+        """
+        with self._lock:
+            try:
+                return self._schemas[version]
+            except KeyError:
+                schema = self._loader(self.paths[version])
+                self.loads += 1
+                self._schemas[version] = (schema, threading.Lock())
+                return self._schemas[version]
+
+    def warm(self):
+        """
+        Compiles the schemas of every version.
+        """
+        for version in self.paths:
+            self.get(version)
+
+    def validate(self, version, tree):
+        """
+        Returns a tuple telling if ``tree``, an lxml tree, is valid
+        against the schema of ``version``, and the list of errors.
+        """
+        schema, lock = self.get(version)
+        # lxml schemas keep the errors of the last validation
+        with lock:
+            is_valid = schema.validate(tree)
+            errors = [str(error) for error in schema.error_log]
+
+        return is_valid, errors
+
+
+schemas = SchemaCache.from_settings(config)
+
+
+class SchemaValidator(Validator):
+    """
+    The xml must be valid against the schema of its SPS version,
+    declared at the ``specific-use`` attribute of its root element.
+    """
+    label = 'schema'
+    inputs = ('xml',)
+
+    # errors reported in the description
+    max_errors = 10
+
+    def __init__(self, cache=None, default_version=None):
+        """
+        ``cache`` is a SchemaCache instance. Defaults to ``schemas``.
+        ``default_version`` is the SPS version of the documents that
+        do not declare one. Defaults to ``[app] default_sps_version``.
+        """
+        self.cache = cache or schemas
+        self.default_version = (default_version or
+                                config.get('app', 'default_sps_version'))
+
+    def validate(self, package):
+        root = package.xml.getroot()
+        version = root.get('specific-use') or self.default_version
+        if version not in self.cache.paths:
+            return 'warning', 'no schema for sps version %r' % version
+
+        # lxml can't validate the shared ElementTree, so it parses the
+        # bytes already read from the package
+        tree = lxml_etree.fromstring(package.xml_source)
+        is_valid, errors = self.cache.validate(version, tree)
+        if not is_valid:
+            return 'error', '\n'.join(errors[:self.max_errors])
+
+        return 'ok', None
+
+
+# schema validation is optional, depending on lxml and the schemas
+if lxml_etree is not None and schemas.paths:
+    register(SchemaValidator)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the thread pool of the current process, sized by
+    ``[app] validation_threads``, creating it on the first use.
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(config.getint('app', 'validation_threads'))
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def input_members(validator, members):
+    """
+    Returns the sorted (name, CRC32, size) tuples of ``members`` that
+    are inputs of ``validator``.
+    """
+    if validator.inputs is None:
+        return sorted(members)
+
+    return sorted(member for member in members
+                  if utils.get_extension(member[0]) in validator.inputs)
+
+
+def _run(validator, package):
+    try:
+        status, description = validator.validate(package)
+    except Exception:
+        status, description = 'error', traceback.format_exc()
+
+    return {'label': validator.label,
+            'status': status,
+            'description': description}
+
+
+def run_validators(package, validators=None, pool=None, previous=None):
+    """
+    Runs ``validators`` concurrently on ``package`` and returns a list
+    with the result of each one, as dicts with their label, status and
+    description. Validators that raise get an error status.
+
+    Validators whose input members are the same as in ``previous`` are
+    not run, and get their previous results instead.
+
+    ``package`` is a checkin.PackageAnalyzer instance. Its xml and meta
+    are loaded before the validators run, so they are shared.
+    ``validators`` is a list of Validator instances. Defaults to all
+    registered ones.
+    ``pool`` is a pool of threads. Defaults to the one of the process.
+    ``previous`` is the manifest and the results of a previous attempt
+    of the same article, as returned by models.get_latest_validations.
+    """
+    if validators is None:
+        validators = registry.values()
+
+    package.xml
+    package.meta
+
+    pending = []
+    for validator in validators:
+        if previous is not None:
+            manifest, results = previous
+            if (validator.label in results and
+                    input_members(validator, package.members) ==
+                    input_members(validator, manifest)):
+                status, description = results[validator.label]
+                pending.append({'label': validator.label,
+                                'status': status,
+                                'description': description})
+                continue
+
+        pending.append((pool or get_pool()).apply_async(
+            _run, (validator, package)))
+
+    return [result if isinstance(result, dict) else result.get()
+            for result in pending]